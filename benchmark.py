@@ -0,0 +1,109 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from update import DocxProcessor
+from planner import ConversionPlanner
+
+def gil_enabled():
+    # sys._is_gil_enabled only exists from 3.13, older builds always have the GIL
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled() if is_gil_enabled is not None else True
+
+def run(processor, docx_paths, content_type, threads):
+    """Convert every path on a pool of threads sharing one processor, returns (seconds, outputs)"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outputs = list(pool.map(lambda path: processor.process_docx(path, content_type), docx_paths))
+    return time.perf_counter() - start, outputs
+
+def best_seconds(converts, repeat=5):
+    """Best time of each convert, the runs interleaved so a burst of load on the machine hits all of them alike"""
+    seconds = [[] for _ in converts]
+    for _ in range(repeat):
+        for convert, times in zip(converts, seconds):
+            start = time.perf_counter()
+            convert()
+            times.append(time.perf_counter() - start)
+    return [min(times) for times in seconds]
+
+def calibrate(docx_paths, path, max_workers=4):
+    """Measure the ConversionPlanner thresholds on docx_paths and write them to path as JSON"""
+    planner = ConversionPlanner(max_workers=max_workers)
+    serial, parallel = DocxProcessor(max_workers=1), DocxProcessor(max_workers=max_workers)
+    measurements = []
+    for docx_path in docx_paths:
+        scan = planner.scan(docx_path)
+        tracemalloc.start()
+        try:
+            serial.process_docx(docx_path)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        serial_seconds, parallel_seconds = best_seconds(
+            [lambda: serial.process_docx(docx_path), lambda: parallel.process_docx(docx_path)])
+        measurements.append((scan, peak, serial_seconds, parallel_seconds))
+        print(f'{docx_path}: {scan.document_bytes} bytes, {peak / scan.document_bytes:.1f} bytes of memory per byte, '
+              f'{serial_seconds:.3f}s serial, {parallel_seconds:.3f}s with {max_workers} part workers')
+
+    thresholds = {}
+    # Small documents are dominated by fixed costs, judge the memory per byte on the larger ones when there are any
+    large = [(scan, peak) for scan, peak, _, _ in measurements if scan.document_bytes >= 256 * 1024]
+    thresholds['memory_per_byte'] = max(peak / scan.document_bytes
+                                        for scan, peak in large or [(m[0], m[1]) for m in measurements])
+    # Parallel parts from the smallest part size above which every document was clearly faster with them.
+    # Documents without parts have nothing to run beside the body, what they gain is the noise of the machine
+    noise = max([serial_seconds / parallel_seconds for scan, _, serial_seconds, parallel_seconds in measurements
+                 if not scan.parts] + [1.0])
+    parallel_part_bytes = None
+    for scan, _, serial_seconds, parallel_seconds in sorted(measurements, key=lambda m: m[0].part_bytes, reverse=True):
+        if not scan.parts or serial_seconds / parallel_seconds < max(1.1, noise * 1.05):
+            break
+        parallel_part_bytes = scan.part_bytes
+    thresholds['parallel_part_bytes'] = parallel_part_bytes
+    # Paragraphs (inside cells too) and cells over all documents, so the large ones weigh the most
+    elements = sum(scan.paragraphs + scan.cells for scan, _, _, _ in measurements)
+    seconds = sum(serial_seconds for _, _, serial_seconds, _ in measurements)
+    thresholds['seconds_per_element'] = seconds / max(elements, 1)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(thresholds, f, indent=2)
+    print(json.dumps(thresholds, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how DOCX conversion throughput scales with threads sharing one DocxProcessor')
+    parser.add_argument('docx_files', nargs='+', help='Documents to convert')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='Thread counts to measure')
+    parser.add_argument('--copies', type=int, default=8, help='Conversions of each document per measurement')
+    parser.add_argument('--content-type', choices=['auto', 'table', 'text', 'plain', 'markdown', 'semantic'], default='auto')
+    parser.add_argument('--part-workers', type=int, default=1,
+                        help='Threads each conversion uses for its own parts (DocxProcessor max_workers)')
+    parser.add_argument('--calibrate', metavar='JSON',
+                        help='Measure the conversion planner thresholds on the documents and write them here instead')
+    args = parser.parse_args()
+    if args.calibrate:
+        calibrate(args.docx_files, args.calibrate)
+        return
+
+    print(f'Python {platform.python_version()} ({platform.python_implementation()}), '
+          f'GIL {"enabled" if gil_enabled() else "disabled"}')
+    processor = DocxProcessor(max_workers=args.part_workers)
+    docx_paths = args.docx_files * args.copies
+    # Warm up and keep the reference outputs, every threaded run must reproduce them exactly
+    expected = {path: processor.process_docx(path, args.content_type) for path in args.docx_files}
+
+    baseline = None  # seconds of the first thread count, the speedups are relative to it
+    print(f'{"threads":>7} {"seconds":>9} {"docs/s":>8} {"speedup":>8}')
+    for threads in args.threads:
+        seconds, outputs = run(processor, docx_paths, args.content_type, threads)
+        if any(output != expected[path] for path, output in zip(docx_paths, outputs)):
+            sys.exit(f'Output with {threads} threads differs from the single-threaded output')
+        if baseline is None:
+            baseline = seconds
+        print(f'{threads:>7} {seconds:>9.2f} {len(docx_paths) / seconds:>8.2f} {baseline / seconds:>8.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import argparse
+import difflib
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from update import DocxProcessor
+
+# Elements Word adds or renumbers on every save without changing what is rendered
+IGNORED_TAGS = ['proofErr', 'bookmarkStart', 'bookmarkEnd', 'lastRenderedPageBreak']
+INSERTED_STYLE = 'background-color: #DDFFDD; text-decoration: none;'
+DELETED_STYLE = 'background-color: #FFDDDD;'
+
+def fingerprint(element, ns, targets):
+    """
+    Hash of everything the renderers read from element and its subtree: tags, attributes and text.
+    Revision ids (w:rsid*) and proofing and bookmark markers are left out, relationship ids are replaced by
+    their targets from targets ({id: target}), so renumbered ids do not count as changes but a changed link does.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    relationship_id = f'{{{ns["r"]}}}id'
+
+    def feed(el):
+        tag = el.tag.partition('}')[2]
+        if tag in IGNORED_TAGS:
+            return
+        digest.update(f'<{el.tag}'.encode())
+        for key, value in sorted(el.attrib.items()):
+            if key.partition('}')[2].startswith('rsid'):
+                continue
+            if key == relationship_id:
+                value = targets.get(value, value)
+            digest.update(f' {key}={value}'.encode())
+        digest.update(f'>{el.text or ""}'.encode())
+        for child in el:
+            feed(child)
+        digest.update(b'/')
+
+    feed(element)
+    return digest.digest()
+
+class DocumentComparer:
+    """
+    Compare two versions of a DOCX file block by block. Every top-level paragraph and table is fingerprinted and
+    the two fingerprint sequences are aligned; changed tables are aligned again row by row.
+    Unchanged blocks are rendered once, from a fragment cache keyed by fingerprint that is shared between comparisons.
+    """
+    def __init__(self, processor=None, max_cached_fragments=4096):
+        self.processor = processor or DocxProcessor()
+        self.namespaces = self.processor.namespaces
+        self.max_cached_fragments = max_cached_fragments
+        self._fragments = OrderedDict()  # fingerprints of a list-safe group of blocks -> HTML, least recently used first
+        self._lock = threading.Lock()
+
+    def load_blocks(self, docx_path):
+        """Returns the paragraphs and tables of the body, their fingerprints and the document relationships"""
+        ns = self.namespaces
+        budget = self.processor.limits.start()
+        document_xml, _, relationships = self.processor.read_docx(docx_path, budget, include_parts=False)
+        body = budget.parse(document_xml).find(f'{{{ns["w"]}}}body', ns)
+        blocks = [element for element in body if element.tag in [f'{{{ns["w"]}}}p', f'{{{ns["tbl"]}}}tbl']]
+        targets = relationships.get('document.xml.rels', {})
+        return blocks, [fingerprint(block, ns, targets) for block in blocks], relationships
+
+    def compare(self, old_path, new_path, context=None):
+        """
+        Render the body of new_path with the blocks and table rows inserted since old_path in <ins>
+        and the removed ones in <del>. With context set, unchanged stretches are collapsed to that many
+        blocks on each side of a change, and the collapsed blocks are never rendered.
+        Headers, footers and notes are not compared.
+        """
+        old_blocks, old_fingerprints, old_relationships = self.load_blocks(old_path)
+        new_blocks, new_fingerprints, new_relationships = self.load_blocks(new_path)
+        html_parts = []
+        matcher = difflib.SequenceMatcher(None, old_fingerprints, new_fingerprints, autojunk=False)
+        opcodes = matcher.get_opcodes()
+        for index, (op, i1, i2, j1, j2) in enumerate(opcodes):
+            if op == 'equal':
+                html_parts.extend(self.render_unchanged(
+                    new_blocks[j1:j2], new_fingerprints[j1:j2], new_relationships,
+                    context, index > 0, index < len(opcodes) - 1))
+                continue
+            if op == 'replace' and i2 - i1 == j2 - j1:
+                # Blocks edited in place: tables paired with tables get their changed rows marked,
+                # the other blocks between them are replaced as runs
+                tbl_tag = f'{{{self.namespaces["tbl"]}}}tbl'
+                start = 0
+                for offset in range(i2 - i1 + 1):
+                    if offset < i2 - i1 and not old_blocks[i1 + offset].tag == new_blocks[j1 + offset].tag == tbl_tag:
+                        continue
+                    html_parts.extend(self.render_replaced(
+                        old_blocks, old_fingerprints, old_relationships, i1 + start, i1 + offset,
+                        new_blocks, new_fingerprints, new_relationships, j1 + start, j1 + offset))
+                    if offset < i2 - i1:
+                        html_parts.append(self.render_table_diff(
+                            old_blocks[i1 + offset], new_blocks[j1 + offset], old_relationships, new_relationships))
+                    start = offset + 1
+                continue
+            html_parts.extend(self.render_replaced(
+                old_blocks, old_fingerprints, old_relationships, i1, i2,
+                new_blocks, new_fingerprints, new_relationships, j1, j2))
+        return '\n'.join(html_parts)
+
+    def render_replaced(self, old_blocks, old_fingerprints, old_relationships, i1, i2,
+                        new_blocks, new_fingerprints, new_relationships, j1, j2):
+        html_parts = []
+        if i1 < i2:
+            html = self.render_fragment(old_blocks[i1:i2], old_fingerprints[i1:i2], old_relationships)
+            html_parts.append(f'<del style="{DELETED_STYLE}">\n{html}\n</del>')
+        if j1 < j2:
+            html = self.render_fragment(new_blocks[j1:j2], new_fingerprints[j1:j2], new_relationships)
+            html_parts.append(f'<ins style="{INSERTED_STYLE}">\n{html}\n</ins>')
+        return html_parts
+
+    def render_unchanged(self, blocks, fingerprints, relationships, context, change_before, change_after):
+        if context is None or len(blocks) <= context * (change_before + change_after):
+            return [self.render_fragment(blocks, fingerprints, relationships)]
+        html_parts = []
+        head = context if change_before else 0
+        tail = context if change_after else 0
+        if head:
+            html_parts.append(self.render_fragment(blocks[:head], fingerprints[:head], relationships))
+        html_parts.append(f'<p style="color: #808080;">[{len(blocks) - head - tail} unchanged]</p>')
+        if tail:
+            html_parts.append(self.render_fragment(blocks[-tail:], fingerprints[-tail:], relationships))
+        return html_parts
+
+    def render_fragment(self, blocks, fingerprints, relationships):
+        """
+        Render consecutive blocks as the auto conversion would, so lists spanning them stay one list
+        Each list, and each block outside a list, is cached on its own, so a fragment is reused
+        wherever the diff boundaries fall around it
+        """
+        groups = []
+        start = 0
+        for index, block in enumerate(blocks):
+            # A list only continues from one list paragraph to the next, any other block closes it
+            if index > start and not (self.is_list_item(blocks[index - 1]) and self.is_list_item(block)):
+                groups.append((start, index))
+                start = index
+        if blocks:
+            groups.append((start, len(blocks)))
+        return '\n'.join(self.render_group(blocks[i:j], fingerprints[i:j], relationships) for i, j in groups)
+
+    def is_list_item(self, block):
+        return (block.tag == f'{{{self.namespaces["w"]}}}p'
+                and self.processor.text_processor.is_list_paragraph(block, self.namespaces))
+
+    def render_group(self, blocks, fingerprints, relationships):
+        """Fingerprints cover resolved hyperlink targets, so a cached fragment is valid for any document"""
+        key = tuple(fingerprints)
+        with self._lock:
+            html = self._fragments.get(key)
+            if html is not None:
+                self._fragments.move_to_end(key)
+                return html
+        container = ET.Element(f'{{{self.namespaces["w"]}}}body')
+        container.extend(blocks)
+        html = self.processor.render_blocks(container, self.namespaces, relationships, ['auto'])['auto']
+        with self._lock:
+            self._fragments[key] = html
+            while len(self._fragments) > self.max_cached_fragments:
+                self._fragments.popitem(last=False)
+        return html
+
+    def render_table_diff(self, old_tbl, new_tbl, old_relationships, new_relationships):
+        """Render new_tbl with the rows added since old_tbl marked as inserted and the removed rows as deleted"""
+        ns = self.namespaces
+        table_processor = self.processor.table_processor
+        old_targets = old_relationships.get('document.xml.rels', {})
+        new_targets = new_relationships.get('document.xml.rels', {})
+        old_rows, new_rows = old_tbl.findall('w:tr', ns), new_tbl.findall('w:tr', ns)
+        matcher = difflib.SequenceMatcher(
+            None, [fingerprint(tr, ns, old_targets) for tr in old_rows],
+            [fingerprint(tr, ns, new_targets) for tr in new_rows], autojunk=False)
+        old_layout = table_processor._get_table_tag(old_tbl, ns)
+        new_layout = table_processor._get_table_tag(new_tbl, ns)
+        html_table = [new_layout[0]]
+        # Cell style templates of each side, the widths they are computed from differ between the two tables
+        old_templates, new_templates = {}, {}
+
+        def add_rows(rows, relationships, layout, templates, extra_style=''):
+            _, width, cellmar = layout
+            for tr in rows:
+                cells, all_empty = table_processor.process_row_cells(
+                    tr, ns, relationships, width, 'document.xml.rels', None, cellmar, templates=templates)
+                html_table.append(table_processor._get_row_tag(tr, ns, all_empty, extra_style=extra_style))
+                html_table.extend(cells)
+                html_table.append('</tr>')
+
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == 'equal':
+                add_rows(new_rows[j1:j2], new_relationships, new_layout, new_templates)
+                continue
+            add_rows(old_rows[i1:i2], old_relationships, old_layout, old_templates, DELETED_STYLE)
+            add_rows(new_rows[j1:j2], new_relationships, new_layout, new_templates, INSERTED_STYLE)
+        # Same layout as TableProcessor.render_table for the auto conversion
+        return '\n\n'.join(html_table + ['</table>'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show what changed between two versions of a DOCX file as HTML')
+    parser.add_argument('old_docx')
+    parser.add_argument('new_docx')
+    parser.add_argument('-o', '--output', help='HTML file to write, defaults to standard output')
+    parser.add_argument('--context', type=int, help='unchanged blocks to keep around each change, default all')
+    args = parser.parse_args()
+
+    html = DocumentComparer().compare(args.old_docx, args.new_docx, context=args.context)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(html)
+    else:
+        print(html)
+
+if __name__ == '__main__':
+    main()
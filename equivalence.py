@@ -0,0 +1,440 @@
+import os
+import re
+import sys
+import html
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from docx import Document
+from docx.shared import Pt, RGBColor
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.opc.constants import RELATIONSHIP_TYPE
+from update import DocxProcessor
+from text import ListState
+from ir import DocumentIR
+from table_data import TableData
+from search_index import SearchIndex
+
+# Tags and text of an HTML string, see normalize
+TOKEN_PATTERN = re.compile(r'<[^>]*>|[^<]+')
+TAG_PATTERN = re.compile(r'<\s*(/?)\s*([\w:-]+)(.*?)/?\s*>', re.DOTALL)
+ATTRIBUTE_PATTERN = re.compile(r'([\w:-]+)\s*=\s*"([^"]*)"')
+# The id anchors SearchIndex adds to paragraphs and table cells
+ANCHOR_ID = re.compile(r' id="(?:p\d+|t\d+-\d+-\d+)"')
+ID_ATTRIBUTE = re.compile(r' id="([^"]*)"')
+SOURCE_LIMIT = 2000  # Characters of source XML shown for a difference
+# Inline wrappers the renderers put around runs, see merge_runs
+RUN_TAG = re.compile(r'<(/?)(span|b)[\s>]')
+
+def normalize(html_text, merge_runs=False):
+    """
+    Tokens of html_text that decide how it renders: tags with sorted attributes and tidied style declarations,
+    and text with entities decoded and whitespace collapsed. Whitespace that contains a line break only separates
+    blocks and is dropped, so outputs differing in layout alone have the same tokens
+    merge_runs: also merge neighbouring runs that look the same (see merge_runs_once), before text is collapsed
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(html_text):
+        match = TAG_PATTERN.fullmatch(token) if token.startswith('<') else None
+        if match is None:
+            tokens.append(token)
+            continue
+        closing, name, attributes = match.groups()
+        attrs = []
+        for key, value in sorted(ATTRIBUTE_PATTERN.findall(attributes)):
+            if key == 'style':
+                value = '; '.join(declaration.strip() for declaration in value.split(';') if declaration.strip())
+            attrs.append(f' {key}="{value}"')
+        tokens.append(f'<{closing}{name.lower()}{"".join(attrs)}>')
+    if merge_runs:
+        merged = merge_runs_once(tokens)
+        while merged != tokens:
+            tokens, merged = merged, merge_runs_once(merged)
+    return [token if token.startswith('<') else ' '.join(html.unescape(token).split()) or ' '
+            for token in tokens if token.startswith('<') or token.strip() or '\n' not in token]
+
+def is_space(token):
+    """Text that only renders as a space between two runs"""
+    return not token.startswith('<') and '\n' not in token and not html.unescape(token).strip()
+
+def merge_runs_once(tokens):
+    """
+    One pass of the run coalescing as a declared difference, over tags and raw text: drop <span>/<b> wrappers
+    around nothing and merge a wrapper closed and opened again with the same attributes, across a space between
+    them too. Text that ends up next to text is joined. Repeated until nothing changes, merging makes new neighbours
+    """
+    merged = []
+    wrappers = []  # Open <span>/<b> tokens with their position in merged
+
+    def add_text(text):
+        if merged and not merged[-1].startswith('<'):
+            merged[-1] += text
+        else:
+            merged.append(text)
+
+    is_closing = lambda token: (RUN_TAG.match(token) or [None, None])[1] == '/'
+    i = 0
+    while i < len(tokens):
+        match = RUN_TAG.match(tokens[i])
+        if match is None:
+            if tokens[i].startswith('<'):
+                merged.append(tokens[i])
+            else:
+                add_text(tokens[i])
+            i += 1
+        elif not match.group(1):
+            wrappers.append((tokens[i], len(merged)))
+            merged.append(tokens[i])
+            i += 1
+        else:
+            # A run of closing wrappers, merged away when the same wrappers open again right after it
+            end = i
+            while end < len(tokens) and is_closing(tokens[end]):
+                end += 1
+            count = end - i
+            openings = [opening for opening, _ in wrappers[-count:]]
+            gap = 1 if end < len(tokens) and is_space(tokens[end]) else 0
+            if len(openings) == count and tokens[end + gap:end + gap + count] == openings:
+                if gap:
+                    add_text(tokens[end])
+                i = end + gap + count
+                continue
+            for closing in tokens[i:end]:
+                _, position = wrappers.pop()
+                if position == len(merged) - 1:
+                    merged.pop()  # Nothing inside
+                else:
+                    merged.append(closing)
+            i = end
+    return merged
+
+class Candidate:
+    """
+    A conversion path that must reproduce DocxProcessor.process_docx
+    convert(docx_path, content_type, workdir) returns its HTML, declared(html) removes the differences it is
+    allowed to have and is applied to both outputs before they are compared
+    outputs: outputs rendered by one call of convert, the speedup is per output
+    reference: DocxProcessor whose process_docx the candidate is compared with, the one given to check by default
+    merge_runs: runs that look the same may be merged, see normalize
+    prepare(docx_path, workdir): work done once per document before convert, timed on its own so the speedup
+    is that of convert alone
+    """
+    def __init__(self, name, convert, declared=None, outputs=1, reference=None, merge_runs=False, prepare=None):
+        self.name = name
+        self.convert = convert
+        self.declared = declared
+        self.outputs = outputs
+        self.reference = reference
+        self.merge_runs = merge_runs
+        self.prepare = prepare
+
+def default_candidates(processor):
+    """Every alternative path in the tree, each one rendering with processor unless it needs its own"""
+    serial_processor = DocxProcessor(max_workers=1, limits=processor.limits)
+    # Every run rendered as Word split it, the output before neighbouring runs were merged
+    split_runs_processor = DocxProcessor(processor.max_workers, processor.limits, coalesce=False)
+
+    def build_ir(docx_path, workdir):
+        DocumentIR.from_docx(docx_path, processor).save(os.path.join(workdir, 'document.ir'))
+
+    def through_ir(docx_path, content_type, workdir):
+        # Loaded from the file build_ir saved, so the serialisation is covered too
+        document_ir = DocumentIR.load(os.path.join(workdir, 'document.ir'))
+        return processor.process_ir(document_ir, [content_type])[content_type]
+
+    def indexed(docx_path, content_type, workdir):
+        # Every anchor the index points to must be an id in the HTML it was built with
+        search_index = SearchIndex(os.path.basename(docx_path))
+        html_text = processor.process_docx(docx_path, content_type, search_index=search_index)
+        missing = missing_anchors(search_index, html_text)
+        if missing:
+            raise ValueError(f'{len(missing)} indexed anchors are not in the HTML: {", ".join(missing[:10])}')
+        return html_text
+
+    def threaded(docx_path, content_type, workdir):
+        # Four conversions of the same document at once on the shared processor, all four must match
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            outputs = list(pool.map(lambda _: processor.process_docx(docx_path, content_type), range(4)))
+        return next((output for output in outputs if output != outputs[0]), outputs[0])
+
+    return [
+        Candidate('outputs', lambda docx_path, content_type, workdir: processor.process_docx_outputs(
+            docx_path, ['auto', 'table', 'text'])[content_type], outputs=3),
+        Candidate('ir', through_ir, prepare=build_ir),
+        Candidate('streaming', lambda docx_path, content_type, workdir: ''.join(
+            processor.iter_docx(docx_path, content_type))),
+        Candidate('serial', lambda docx_path, content_type, workdir: serial_processor.process_docx(
+            docx_path, content_type)),
+        Candidate('threaded', threaded, outputs=4),
+        Candidate('table_data', lambda docx_path, content_type, workdir: processor.process_docx(
+            docx_path, content_type, table_data=TableData())),
+        Candidate('search_index', indexed, declared=lambda html_text: ANCHOR_ID.sub('', html_text)),
+        Candidate('coalesce', lambda docx_path, content_type, workdir: processor.process_docx(
+            docx_path, content_type), reference=split_runs_processor, merge_runs=True),
+    ]
+
+def missing_anchors(search_index, html_text):
+    """Anchors in the postings of search_index without an element of that id in html_text, in index order"""
+    ids = set(ID_ATTRIBUTE.findall(html_text))
+    anchors = dict.fromkeys(anchor for postings in search_index.postings.values() for anchor in postings)
+    return [anchor for anchor in anchors if anchor not in ids]
+
+def reference_pieces(processor, docx_path, content_type):
+    """
+    The reference output cut at its sources: (label, source element or None, HTML) for every header part,
+    body block and remaining part, in output order. The pieces have the same tokens as process_docx's output
+    """
+    ns = processor.namespaces
+    budget = processor.limits.start()
+    document_xml, part_sources, relationships = processor.read_docx(docx_path, budget, content_type != 'table')
+    order = ['header', 'body', 'footnotes', 'endnotes', 'comments', 'footer']
+    part_sources.sort(key=lambda part: order.index(part[0]))
+
+    def part_piece(kind, name, source):
+        root = budget.parse(source)
+        part_html = processor.render_part(kind, root, [content_type], relationships, f'{name}.rels', budget)
+        return f'word/{name}', root, part_html[content_type]
+
+    pieces = [part_piece(*part) for part in part_sources if part[0] == 'header']
+    body = budget.parse(document_xml).find(f'{{{ns["w"]}}}body', ns)
+    html_parts = {content_type: []}
+    list_state = ListState()
+    for n, element in enumerate(list(body), 1):
+        processor.render_block(element, ns, relationships, html_parts, list_state, budget=budget)
+        pieces.append((f'word/document.xml body block {n}', element, ''.join(html_parts[content_type])))
+        html_parts[content_type].clear()
+    if content_type == 'auto':
+        pieces.append(('end of the last list in word/document.xml', None, ''.join(list_state.close())))
+    pieces.extend(part_piece(*part) for part in part_sources if part[0] != 'header')
+    return pieces
+
+def first_difference(reference_tokens, candidate_tokens):
+    """Index of the first differing token, None when both are the same"""
+    for index, (expected, actual) in enumerate(zip(reference_tokens, candidate_tokens)):
+        if expected != actual:
+            return index
+    if len(reference_tokens) != len(candidate_tokens):
+        return min(len(reference_tokens), len(candidate_tokens))
+    return None
+
+def locate(processor, docx_path, content_type, index, declared, merge_runs=False):
+    """The reference piece holding token index: (label, source XML), or None if the pieces do not add up"""
+    pieces = reference_pieces(processor, docx_path, content_type)
+    declared = declared or (lambda html_text: html_text)
+    start = 0
+    for label, element, piece_html in pieces:
+        end = start + len(normalize(declared(piece_html), merge_runs))
+        if index < end:
+            source = ET.tostring(element, encoding='unicode') if element is not None else ''
+            return label, source[:SOURCE_LIMIT]
+        start = end
+    return None
+
+def measure(convert, repeat):
+    """Run convert repeat times and once more under tracemalloc, returns (output, best seconds, peak bytes)"""
+    seconds = None
+    output = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = convert()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    tracemalloc.start()
+    try:
+        convert()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return output, seconds, peak
+
+def check(processor, candidates, docx_paths, content_types, repeat=1, workdir=None):
+    """
+    Compare every candidate with process_docx (of processor, or of the candidate's own reference processor)
+    on every document and content type
+    Returns one result dict per comparison, with the speedup and peak memory relative to the reference
+    and the seconds of the candidate's prepare step for the document, None without one
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='equivalence_')
+    results = []
+    for docx_path in docx_paths:
+        prepared = {}  # Candidate name -> seconds of its prepare step, or the error it raised
+        for candidate in candidates:
+            if candidate.prepare is not None:
+                try:
+                    prepared[candidate.name] = measure(lambda: candidate.prepare(docx_path, workdir), repeat)[1]
+                except Exception as e:
+                    prepared[candidate.name] = f'{type(e).__name__}: {e}'
+        for content_type in content_types:
+            references = {}  # Reference processor -> (output, seconds, peak bytes)
+            for candidate in candidates:
+                reference_processor = candidate.reference or processor
+                if reference_processor not in references:
+                    references[reference_processor] = measure(
+                        lambda: reference_processor.process_docx(docx_path, content_type), repeat)
+                reference, reference_seconds, reference_peak = references[reference_processor]
+                result = {'document': docx_path, 'content_type': content_type, 'candidate': candidate.name,
+                          'prepare_seconds': prepared.get(candidate.name)}
+                if isinstance(result['prepare_seconds'], str):
+                    result.update(equal=False, error=result.pop('prepare_seconds'))
+                    results.append(result)
+                    continue
+                try:
+                    output, seconds, peak = measure(
+                        lambda: candidate.convert(docx_path, content_type, workdir), repeat)
+                except Exception as e:
+                    result.update(equal=False, error=f'{type(e).__name__}: {e}')
+                    results.append(result)
+                    continue
+                declared = candidate.declared or (lambda html_text: html_text)
+                reference_tokens = normalize(declared(reference), candidate.merge_runs)
+                candidate_tokens = normalize(declared(output), candidate.merge_runs)
+                index = first_difference(reference_tokens, candidate_tokens)
+                result.update(
+                    equal=index is None,
+                    speedup=reference_seconds * candidate.outputs / seconds if seconds else None,
+                    seconds=seconds, reference_seconds=reference_seconds,
+                    peak_bytes=peak, reference_peak_bytes=reference_peak,
+                )
+                if index is not None:
+                    context = slice(max(0, index - 3), index + 4)
+                    result.update(
+                        token=index,
+                        expected=reference_tokens[context],
+                        actual=candidate_tokens[context],
+                        source=locate(reference_processor, docx_path, content_type, index, candidate.declared,
+                                      candidate.merge_runs),
+                    )
+                results.append(result)
+    return results
+
+def add_numbering(paragraph, level):
+    """Make paragraph a list item at level, the way Word marks list paragraphs (w:numPr)"""
+    num_pr = OxmlElement('w:numPr')
+    ilvl = OxmlElement('w:ilvl')
+    ilvl.set(qn('w:val'), str(level))
+    num_id = OxmlElement('w:numId')
+    num_id.set(qn('w:val'), '1')
+    num_pr.append(ilvl)
+    num_pr.append(num_id)
+    paragraph._p.get_or_add_pPr().append(num_pr)
+
+def add_hyperlink(paragraph, text, url):
+    r_id = paragraph.part.relate_to(url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
+    hyperlink = OxmlElement('w:hyperlink')
+    hyperlink.set(qn('r:id'), r_id)
+    run = OxmlElement('w:r')
+    t = OxmlElement('w:t')
+    t.text = text
+    run.append(t)
+    hyperlink.append(run)
+    paragraph._p.append(hyperlink)
+
+def generate_document(path, seed=0, blocks=200):
+    """
+    Write a DOCX file exercising the renderers: formatted runs, hyperlinks, tabs and breaks, nested lists,
+    tables with amounts, merged, empty and nested cells, and a header and footer. The same seed gives the same file
+    """
+    rng = random.Random(seed)
+    vocabulary = ['revenue', 'cost', 'net', 'income', 'Total', 'café', 'A&B', '<note>', 'déjà', '—', 'Q4',
+                  'shares', 'per', 'year', 'ended', 'December']
+    amounts = ['1,234', '(5,678)', '$', ')', '—', '12.5%', '', '0']
+    words = lambda count: ' '.join(rng.choice(vocabulary) for _ in range(count))
+    document = Document()
+    section = document.sections[0]
+    section.header.paragraphs[0].text = f'Generated document {seed}'
+    section.footer.paragraphs[0].text = 'Footer ' + words(3)
+    for _ in range(blocks):
+        choice = rng.random()
+        if choice < 0.05:
+            document.add_heading(words(4), level=rng.randint(1, 3))
+        elif choice < 0.25:
+            add_numbering(document.add_paragraph(words(rng.randint(2, 8))), rng.randint(0, 2))
+        elif choice < 0.35:
+            rows, cols = rng.randint(1, 6), rng.randint(2, 5)
+            table = document.add_table(rows=rows, cols=cols)
+            table.style = 'Table Grid'
+            for r, row in enumerate(table.rows):
+                if rng.random() < 0.1:
+                    continue  # An empty row
+                for c, cell in enumerate(row.cells):
+                    cell.text = words(2) if c == 0 else rng.choice(amounts)
+            if cols > 2 and rng.random() < 0.3:
+                table.cell(0, 1).merge(table.cell(0, 2))
+            if rng.random() < 0.1:
+                table.cell(rows - 1, 0).add_table(rows=2, cols=2).cell(0, 0).text = words(2)
+        else:
+            paragraph = document.add_paragraph()
+            for _ in range(rng.randint(1, 6)):
+                run = paragraph.add_run(words(rng.randint(1, 5)) + ' ')
+                run.bold = rng.random() < 0.2
+                run.italic = rng.random() < 0.2
+                run.underline = rng.random() < 0.1
+                if rng.random() < 0.2:
+                    run.font.size = Pt(rng.choice([8, 10, 12, 14]))
+                if rng.random() < 0.1:
+                    run.font.color.rgb = RGBColor(0x80, 0x00, 0x00)
+                if rng.random() < 0.05:
+                    run.add_tab()
+                if rng.random() < 0.05:
+                    run.add_break()
+            if rng.random() < 0.1:
+                add_hyperlink(paragraph, words(2), f'https://example.com/{rng.randint(1, 99)}')
+    document.save(path)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that every alternative conversion path reproduces DocxProcessor.process_docx')
+    parser.add_argument('docx_files', nargs='*', help='Sample documents')
+    parser.add_argument('--generate', type=int, default=3, help='Generated documents added to the samples')
+    parser.add_argument('--blocks', type=int, default=200, help='Blocks in each generated document')
+    parser.add_argument('--content-types', nargs='+', choices=['auto', 'table', 'text'], default=['auto', 'table', 'text'])
+    parser.add_argument('--candidates', nargs='+', help='Candidate names to run, all by default')
+    parser.add_argument('--repeat', type=int, default=1, help='Timed runs of each conversion, the best one counts')
+    parser.add_argument('--report', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    ET.register_namespace('w', 'http://schemas.openxmlformats.org/wordprocessingml/2006/main')
+    ET.register_namespace('r', 'http://schemas.openxmlformats.org/officeDocument/2006/relationships')
+    processor = DocxProcessor()
+    candidates = default_candidates(processor)
+    if args.candidates:
+        candidates = [candidate for candidate in candidates if candidate.name in args.candidates]
+    with tempfile.TemporaryDirectory(prefix='equivalence_') as workdir:
+        docx_paths = list(args.docx_files)
+        for seed in range(args.generate):
+            docx_paths.append(os.path.join(workdir, f'generated_{seed}.docx'))
+            generate_document(docx_paths[-1], seed, args.blocks)
+        results = check(processor, candidates, docx_paths, args.content_types, args.repeat, workdir)
+
+    print(f'{"document":<30} {"type":<6} {"candidate":<13} {"result":<6} {"speedup":>8} {"peak MB":>8} {"ref MB":>7} '
+          f'{"prepare s":>9}')
+    for result in results:
+        name = os.path.basename(result['document'])
+        if 'error' in result:
+            print(f'{name:<30} {result["content_type"]:<6} {result["candidate"]:<13} ERROR  {result["error"]}')
+            continue
+        print(f'{name:<30} {result["content_type"]:<6} {result["candidate"]:<13} '
+              f'{"same" if result["equal"] else "DIFF":<6} {result["speedup"]:>8.2f} '
+              f'{result["peak_bytes"] / 2**20:>8.1f} {result["reference_peak_bytes"] / 2**20:>7.1f} '
+              + (f'{result["prepare_seconds"]:>9.2f}' if result['prepare_seconds'] is not None else f'{"":>9}'))
+        if not result['equal']:
+            print(f'    first difference at token {result["token"]}')
+            print(f'    expected: {result["expected"]}')
+            print(f'    actual:   {result["actual"]}')
+            if result['source']:
+                label, source = result['source']
+                print(f'    source: {label}\n    {source}')
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if not all(result['equal'] for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import re
+import html
+from text import TextProcessor, ListState
+
+# Content types rendered by FastTextProcessor instead of the styled renderers
+FAST_CONTENT_TYPES = ['plain', 'markdown', 'semantic']
+HEADING_STYLE = re.compile(r'Heading([1-6])|Title', re.IGNORECASE)
+MARKDOWN_SPECIAL = re.compile(r'([\\`*_\[\]<>|#])')
+
+class FastTextProcessor:
+    """
+    Extract the text and block structure of the body (headings, paragraphs, list items and table cells)
+    without reading any formatting. document.xml is walked while it is parsed and every block is dropped
+    from the tree once it is written, so memory stays bounded by the largest block
+    content_type: 'plain' (text, tab separated cells), 'markdown' or 'semantic' (HTML without any style)
+    """
+    def __init__(self):
+        # Only the list helpers are used, the same ones the styled renderers nest lists with
+        self.text_processor = TextProcessor()
+
+    def process_document(self, document_xml, ns, content_type='plain', budget=None):
+        """Render the body of document_xml (path or file object), budget: limits.DocumentBudget to parse under"""
+        if content_type not in FAST_CONTENT_TYPES:
+            raise ValueError("Invalid content type. Must be 'plain', 'markdown' or 'semantic'")
+        blocks = []
+        items = []  # List items of the list being written, joined into one block
+        list_state = ListState()
+        depth = 0
+        body = None
+        body_tag = f'{{{ns["w"]}}}body'
+        for event, element in budget.iterparse(document_xml):
+            # Called for every element of the document, so the common case returns first
+            if event == 'start':
+                depth += 1
+                if depth == 2 and element.tag == body_tag:
+                    body = element
+                continue
+            depth -= 1
+            # Only the end of a block directly under the body, by then the whole block is parsed
+            if depth != 2 or body is None:
+                continue
+            budget.rendered(blocks=1)
+            if element.tag == f'{{{ns["w"]}}}p' and self.text_processor.is_list_paragraph(element, ns):
+                ilvl = self.text_processor.get_list_level(element, ns)
+                list_tag = self.text_processor.get_list_tag(element, ns)
+                items.extend(self.list_item(element, ns, content_type, ilvl, list_state.open(ilvl, list_tag)))
+            else:
+                if items:
+                    blocks.append(self.list_block(items, list_state.close(), content_type))
+                    items = []
+                if element.tag == f'{{{ns["w"]}}}p':
+                    block = self.paragraph(element, ns, content_type)
+                elif element.tag == f'{{{ns["tbl"]}}}tbl':
+                    block = self.table(element, ns, content_type, budget)
+                else:
+                    block = None
+                if block:
+                    blocks.append(block)
+            body.remove(element)
+        if items:
+            blocks.append(self.list_block(items, list_state.close(), content_type))
+        return '\n\n'.join(blocks)
+
+    def paragraph_text(self, p, ns):
+        """
+        Text of a paragraph and its hyperlinks: tabs and line breaks kept, deleted text, field codes and hidden runs
+        left out
+        """
+        text = []
+        # Runs at any depth, inside hyperlinks, insertions and smart tags too. Only run children are read,
+        # the tab stops in the paragraph properties are w:tab elements as well
+        for run in p.iter(f'{{{ns["w"]}}}r'):
+            # Hidden runs, display: none in the styled renderers
+            r_pr = run.find(f'{{{ns["w"]}}}rPr')
+            if r_pr is not None and r_pr.find(f'{{{ns["w"]}}}vanish') is not None:
+                continue
+            for child in run:
+                tag = child.tag
+                if tag == f'{{{ns["w"]}}}t':
+                    text.append(child.text or '')
+                elif tag == f'{{{ns["w"]}}}tab':
+                    text.append('\t')
+                elif tag in [f'{{{ns["w"]}}}br', f'{{{ns["w"]}}}cr']:
+                    text.append('\n')
+        return ''.join(text)
+
+    def heading_level(self, p, ns):
+        p_pr = p.find(f'{{{ns["w"]}}}pPr')
+        p_style = p_pr.find(f'{{{ns["w"]}}}pStyle') if p_pr is not None else None
+        if p_style is None:
+            return 0
+        match = HEADING_STYLE.fullmatch(p_style.get(f'{{{ns["w"]}}}val', ''))
+        if match is None:
+            return 0
+        return int(match.group(1)) if match.group(1) else 1
+
+    def escape(self, text, content_type):
+        if content_type == 'markdown':
+            return MARKDOWN_SPECIAL.sub(r'\\\1', text)
+        if content_type == 'semantic':
+            return html.escape(text, quote=False).replace('\n', '<br/>')
+        return text
+
+    def paragraph(self, p, ns, content_type):
+        """A heading or paragraph block, '' for a paragraph without text"""
+        text = self.paragraph_text(p, ns)
+        if not text.strip():
+            return ''
+        text = self.escape(text.strip(), content_type)
+        level = self.heading_level(p, ns)
+        if content_type == 'semantic':
+            tag = f'h{level}' if level else 'p'
+            return f'<{tag}>{text}</{tag}>'
+        if content_type == 'markdown':
+            if level:
+                return f'{"#" * level} {text.replace(chr(10), " ")}'
+            # Markdown joins lines, a trailing backslash keeps the break
+            return text.replace('\n', '\\\n')
+        return text
+
+    def list_item(self, p, ns, content_type, ilvl, tags):
+        """Lines of one list paragraph: tags are the <ul>/</ul> ListState emitted for it, used by 'semantic' only"""
+        text = self.escape(self.paragraph_text(p, ns).strip(), content_type)
+        if content_type == 'semantic':
+            return tags + [f'<li>{text}</li>']
+        return [f'{"  " * ilvl}- {text.replace(chr(10), " ")}']
+
+    def list_block(self, items, closing_tags, content_type):
+        """One block of consecutive list items, closing_tags: the tags ListState.close returned after them"""
+        if content_type == 'semantic':
+            items = items + closing_tags
+        return '\n'.join(items)
+
+    def cell_text(self, tc, ns):
+        """Text of a table cell on one line: its paragraphs and nested tables joined by spaces"""
+        text = []
+        for child in tc:
+            if child.tag == f'{{{ns["w"]}}}p':
+                text.append(self.paragraph_text(child, ns))
+            elif child.tag == f'{{{ns["tbl"]}}}tbl':
+                for tr in child.iter(f'{{{ns["w"]}}}tr'):
+                    text.extend(self.cell_text(nested_tc, ns) for nested_tc in tr.findall(f'{{{ns["w"]}}}tc'))
+        return ' '.join(' '.join(text).split())
+
+    def table(self, tbl, ns, content_type, budget=None):
+        """A table block, one row per line and a cell per column spanned (one <td colspan> in 'semantic')"""
+        rows = []
+        # Full tag names rather than 'w:' prefixes keep find and findall on their fast path
+        for tr in tbl.findall(f'{{{ns["w"]}}}tr'):
+            if budget is not None:
+                budget.rendered(rows=1)
+            cells = []
+            for tc in tr.findall(f'{{{ns["w"]}}}tc'):
+                tc_pr = tc.find(f'{{{ns["w"]}}}tcPr')
+                grid_span = tc_pr.find(f'{{{ns["w"]}}}gridSpan') if tc_pr is not None else None
+                span = int(grid_span.get(f'{{{ns["w"]}}}val', '1')) if grid_span is not None else 1
+                cells.append((self.escape(self.cell_text(tc, ns), content_type), span))
+            rows.append(cells)
+        if not rows:
+            return ''
+        if content_type == 'semantic':
+            lines = ['<table>']
+            for cells in rows:
+                tds = ''.join(f'<td colspan="{span}">{text}</td>' if span > 1 else f'<td>{text}</td>'
+                              for text, span in cells)
+                lines.append(f'<tr>{tds}</tr>')
+            return '\n'.join(lines + ['</table>'])
+        # Spanned columns become empty cells so the columns line up
+        rows = [[text for text, span in cells for text in [text] + [''] * (span - 1)] for cells in rows]
+        if content_type == 'plain':
+            return '\n'.join('\t'.join(cells) for cells in rows)
+        # Markdown tables need a header row and the same number of cells on every row, the first row is the header
+        columns = max(len(cells) for cells in rows)
+        if not columns:
+            return ''
+        rows = [cells + [''] * (columns - len(cells)) for cells in rows]
+        lines = ['| ' + ' | '.join(cells) + ' |' for cells in rows]
+        lines.insert(1, '|' + ' --- |' * columns)
+        return '\n'.join(lines)
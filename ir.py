@@ -0,0 +1,202 @@
+import struct
+import marshal
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from array import array
+from update import DocxProcessor
+
+IR_MAGIC = b'DOCXIR\0'
+# Bump whenever the layout below changes, older files are then rejected on load
+IR_VERSION = 1
+HEADER = struct.Struct('<7sHH')
+# Arrays stored per tree, one entry per node in document order
+TREE_FIELDS = ['tag', 'attrs', 'text', 'children', 'props']
+
+class IRVersionError(ValueError):
+    """Raised when an IR file is truncated or damaged, or was written by another IR_VERSION or Python marshal format"""
+
+class DocumentIR:
+    """
+    Compact intermediate representation of a parsed DOCX body and its header, footer and note parts.
+
+    Each tree is stored as flat arrays with one entry per element in document order: tag, attribute record,
+    text and child count, all as ids into interned tables. Property elements (pPr, rPr, tcPr, trPr, tblPr, ...)
+    are interned as whole records, so the thousands of runs sharing one rPr store a single id. Hyperlink
+    targets are kept too, so DocxProcessor.process_ir renders without touching the zip or any XML.
+    """
+    def __init__(self):
+        self.strings = []
+        self.attr_records = []
+        self.prop_records = []
+        self.body = None
+        self.parts = []  # (kind, rels_name, tree)
+        self.relationships = {}  # rels_name -> {id: target}
+        self._string_ids = {}
+        self._attr_ids = {}
+        self._prop_ids = {}
+        self._prop_elements = {}
+
+    @classmethod
+    def from_docx(cls, docx_path, processor=None):
+        """
+        Read document.xml, the header/footer/note parts and their relationships straight from the zip,
+        under the processor's resource limits
+        """
+        processor = processor or DocxProcessor()
+        ns = processor.namespaces
+        budget = processor.limits.start()
+        document_ir = cls()
+        with zipfile.ZipFile(docx_path, 'r') as zip_ref:
+            names = zip_ref.namelist()
+            root = budget.parse(budget.read(zip_ref, 'word/document.xml'))
+            document_ir.body = document_ir.add_tree(root.find(f'{{{ns["w"]}}}body', ns))
+            word_names = [posixpath.basename(name) for name in names if posixpath.dirname(name) == 'word']
+            for kind, name in processor.order_parts(word_names):
+                part_root = budget.parse(budget.read(zip_ref, f'word/{name}'))
+                document_ir.parts.append((kind, f'{name}.rels', document_ir.add_tree(part_root)))
+            document_ir.relationships = processor.read_relationships(zip_ref, budget)
+        return document_ir
+
+    def _intern_string(self, value):
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = self._string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def _intern_attrs(self, element):
+        if not element.attrib:
+            return -1
+        record = tuple(self._intern_string(part) for item in element.attrib.items() for part in item)
+        attr_id = self._attr_ids.get(record)
+        if attr_id is None:
+            attr_id = self._attr_ids[record] = len(self.attr_records)
+            self.attr_records.append(record)
+        return attr_id
+
+    def _prop_record(self, element):
+        text = self._intern_string(element.text) if element.text is not None else -1
+        children = tuple(self._prop_record(child) for child in element)
+        return (self._intern_string(element.tag), self._intern_attrs(element), text, children)
+
+    def add_tree(self, root):
+        """Flatten an element tree into arrays; tails are dropped, the renderers never read them"""
+        tree = {field: array('i') for field in TREE_FIELDS}
+        stack = [root]
+        while stack:
+            element = stack.pop()
+            if element.tag.endswith('Pr') or element.tag.endswith('}tblGrid'):
+                record = self._prop_record(element)
+                prop_id = self._prop_ids.get(record)
+                if prop_id is None:
+                    prop_id = self._prop_ids[record] = len(self.prop_records)
+                    self.prop_records.append(record)
+                tree['tag'].append(-1)
+                tree['attrs'].append(-1)
+                tree['text'].append(-1)
+                tree['children'].append(0)
+                tree['props'].append(prop_id)
+                continue
+            tree['tag'].append(self._intern_string(element.tag))
+            tree['attrs'].append(self._intern_attrs(element))
+            tree['text'].append(self._intern_string(element.text) if element.text is not None else -1)
+            tree['children'].append(len(element))
+            tree['props'].append(-1)
+            stack.extend(reversed(element))
+        return tree
+
+    def _attrs(self, attr_id):
+        if attr_id < 0:
+            return {}
+        record = self.attr_records[attr_id]
+        strings = self.strings
+        return {strings[record[i]]: strings[record[i + 1]] for i in range(0, len(record), 2)}
+
+    def _prop_element(self, prop_id):
+        # Each distinct property record becomes one element shared by every node that uses it
+        element = self._prop_elements.get(prop_id)
+        if element is None:
+            element = self._prop_elements[prop_id] = self._build_prop(self.prop_records[prop_id])
+        return element
+
+    def _build_prop(self, record):
+        tag, attr_id, text, children = record
+        element = ET.Element(self.strings[tag], self._attrs(attr_id))
+        if text >= 0:
+            element.text = self.strings[text]
+        element.extend(self._build_prop(child) for child in children)
+        return element
+
+    def to_element(self, tree):
+        """Rebuild the element tree the renderers walk"""
+        strings = self.strings
+        tags, attrs, texts, children, props = (tree[field] for field in TREE_FIELDS)
+        root = None
+        stack = []  # [parent, children still to attach]
+        for i in range(len(tags)):
+            if props[i] >= 0:
+                element = self._prop_element(props[i])
+            else:
+                element = ET.Element(strings[tags[i]], self._attrs(attrs[i]))
+                if texts[i] >= 0:
+                    element.text = strings[texts[i]]
+            if stack:
+                parent = stack[-1]
+                parent[0].append(element)
+                parent[1] -= 1
+                if parent[1] == 0:
+                    stack.pop()
+            else:
+                root = element
+            if props[i] < 0 and children[i]:
+                stack.append([element, children[i]])
+        return root
+
+    def save(self, path):
+        payload = {
+            'strings': self.strings,
+            'attr_records': self.attr_records,
+            'prop_records': self.prop_records,
+            'body': {field: values.tobytes() for field, values in self.body.items()},
+            'parts': [(kind, rels_name, {field: values.tobytes() for field, values in tree.items()})
+                      for kind, rels_name, tree in self.parts],
+            'relationships': self.relationships,
+        }
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(IR_MAGIC, IR_VERSION, marshal.version))
+            f.write(marshal.dumps(payload))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            raise IRVersionError(f'{path} is truncated, rebuild it from the DOCX file')
+        magic, version, marshal_version = HEADER.unpack_from(data)
+        if magic != IR_MAGIC:
+            raise IRVersionError(f'{path} is not a document IR file')
+        if version != IR_VERSION or marshal_version != marshal.version:
+            raise IRVersionError(
+                f'{path} has IR version {version} (marshal {marshal_version}), '
+                f'expected {IR_VERSION} (marshal {marshal.version}); rebuild it from the DOCX file')
+        try:
+            payload = marshal.loads(data[HEADER.size:])
+        except (EOFError, ValueError, TypeError) as e:
+            raise IRVersionError(f'{path} is truncated or damaged ({e}), rebuild it from the DOCX file') from e
+
+        def load_tree(fields):
+            tree = {}
+            for field, raw in fields.items():
+                tree[field] = array('i')
+                tree[field].frombytes(raw)
+            return tree
+
+        document_ir = cls()
+        document_ir.strings = payload['strings']
+        document_ir.attr_records = payload['attr_records']
+        document_ir.prop_records = payload['prop_records']
+        document_ir.body = load_tree(payload['body'])
+        document_ir.parts = [(kind, rels_name, load_tree(tree)) for kind, rels_name, tree in payload['parts']]
+        document_ir.relationships = payload['relationships']
+        return document_ir
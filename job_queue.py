@@ -0,0 +1,317 @@
+import os
+import time
+import socket
+import random
+import sqlite3
+import logging
+import argparse
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from watcher import convert_file, init_worker, load_thresholds, is_permanent_error
+from limits import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    docx_path TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    enqueued_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+"""
+
+def worker_id():
+    # Unique across hosts sharing the queue file
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+class JobQueue:
+    """
+    Durable conversion queue in one SQLite file. Jobs move queued -> leased -> done, a failed job is queued again
+    after an exponential backoff and moved to 'dead' (the dead-letter state) once max_attempts is used up.
+    A lease expires unless the worker heartbeats, so jobs of a crashed worker or host are picked up again.
+    Every state change is a single transaction, any number of processes on any host can use the same file.
+    """
+    def __init__(self, path, max_attempts=5, backoff=30.0, max_backoff=3600.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        conn = self.connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def connect(self):
+        # Rollback journal rather than WAL, WAL needs shared memory that network filesystems do not provide
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        A connection per transaction, connections cannot be shared between threads or forked processes
+        The write lock is taken up front so two workers never lease the same job
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def enqueue(self, docx_path, output_path=None, content_type='auto', max_attempts=None):
+        """Add one conversion, returns the job id. output_path defaults to the DOCX path with .html"""
+        return self.enqueue_many([(docx_path, output_path, content_type)], max_attempts)[0]
+
+    def enqueue_many(self, jobs, max_attempts=None):
+        """Add (docx_path, output_path, content_type) conversions in one transaction, returns their ids"""
+        now = time.time()
+        ids = []
+        with self.transaction() as conn:
+            for docx_path, output_path, content_type in jobs:
+                output_path = output_path or os.path.splitext(docx_path)[0] + '.html'
+                cursor = conn.execute(
+                    'INSERT INTO jobs (docx_path, output_path, content_type, max_attempts, available_at, enqueued_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (os.path.abspath(docx_path), os.path.abspath(output_path), content_type,
+                     max_attempts or self.max_attempts, now, now))
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def lease(self, owner, lease_seconds=300.0):
+        """Claim the next job that is due, or one whose lease expired, returns its row or None"""
+        now = time.time()
+        with self.transaction() as conn:
+            # A job whose worker died on its last attempt is not retried again
+            conn.execute(
+                "UPDATE jobs SET status = 'dead', finished_at = ?, lease_owner = NULL, "
+                "last_error = coalesce(last_error, 'lease expired') "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= max_attempts", (now, now))
+            job = conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'queued' AND available_at <= ?) "
+                "OR (status = 'leased' AND lease_expires < ?) ORDER BY available_at, id LIMIT 1", (now, now)).fetchone()
+            if job is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?", (owner, now + lease_seconds, job['id']))
+            return conn.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+
+    def heartbeat(self, job_id, owner, lease_seconds=300.0):
+        """Extend a lease, returns False if the lease was lost to another worker"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (time.time() + lease_seconds, job_id, owner))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, owner):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', finished_at = ?, lease_owner = NULL, last_error = NULL "
+                "WHERE id = ? AND status = 'leased' AND lease_owner = ?", (time.time(), job_id, owner))
+
+    def fail(self, job_id, owner, error, permanent=False):
+        """
+        Queue the job again after a backoff, or move it to the dead-letter state once out of attempts
+        permanent: the error would repeat on every attempt, the job goes to the dead-letter state right away
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            job = conn.execute('SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ?',
+                               (job_id, owner)).fetchone()
+            if job is not None:
+                if permanent or job['attempts'] >= job['max_attempts']:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'dead', finished_at = ?, lease_owner = NULL, last_error = ? "
+                        "WHERE id = ?", (now, error, job_id))
+                else:
+                    # Exponential backoff with jitter, so jobs failing together do not retry together
+                    delay = min(self.max_backoff, self.backoff * 2 ** (job['attempts'] - 1)) * random.uniform(0.5, 1.0)
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', available_at = ?, lease_owner = NULL, last_error = ? "
+                        "WHERE id = ?", (now + delay, error, job_id))
+
+    def retry_dead(self):
+        """Queue every dead-letter job again with a fresh set of attempts, returns how many"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, available_at = ?, finished_at = NULL "
+                "WHERE status = 'dead'", (time.time(),))
+            return cursor.rowcount
+
+    def stats(self, window=600.0):
+        """Jobs per status, age of the oldest queued job and jobs finished per minute over the last window seconds"""
+        now = time.time()
+        with self.transaction() as conn:
+            counts = {row['status']: row['count'] for row in
+                      conn.execute('SELECT status, count(*) AS count FROM jobs GROUP BY status')}
+            oldest = conn.execute("SELECT min(enqueued_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            finished = conn.execute("SELECT count(*) FROM jobs WHERE status = 'done' AND finished_at >= ?",
+                                    (now - window,)).fetchone()[0]
+        return {
+            'counts': {status: counts.get(status, 0) for status in ['queued', 'leased', 'done', 'dead']},
+            'oldest_queued_seconds': now - oldest if oldest is not None else 0.0,
+            'per_minute': finished * 60.0 / window,
+        }
+
+    def dead_jobs(self):
+        with self.transaction() as conn:
+            return conn.execute("SELECT id, docx_path, attempts, last_error FROM jobs WHERE status = 'dead' "
+                                "ORDER BY id").fetchall()
+
+class QueueWorker:
+    """Lease jobs and convert them one at a time, heartbeating from a background thread while converting"""
+    def __init__(self, queue, lease_seconds=300.0, poll_interval=5.0, write_index=False, max_seconds=None,
+                 thresholds=None):
+        self.queue = queue
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.write_index = write_index
+        # A conversion over its time budget is retried, then dead-lettered. Damaged documents and the other
+        # resource limits fail the same way every time, they are dead-lettered on the first attempt
+        self.max_seconds = max_seconds
+        self.thresholds = thresholds  # See planner.ConversionPlanner
+        self.owner = worker_id()
+
+    def run(self, drain=False):
+        """Work until stopped, or with drain until no job is left to lease"""
+        while True:
+            job = self.queue.lease(self.owner, self.lease_seconds)
+            if job is None:
+                if drain:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            self.process(job)
+
+    def process(self, job):
+        stop = threading.Event()
+        # Cancelled by the heartbeat once the lease is lost, the job then belongs to whichever worker leased it next
+        lease_lost = CancellationToken()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job['id'], job['lease_expires'], stop, lease_lost),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            report = convert_file(job['docx_path'], job['output_path'], job['content_type'], self.write_index,
+                                  self.max_seconds, self.thresholds, lease_lost)
+        except Exception as e:
+            if lease_lost.cancelled:
+                logger.warning('Job %s (%s) abandoned after losing its lease', job['id'], job['docx_path'])
+                return
+            logger.warning('Job %s (%s) failed on attempt %s: %s', job['id'], job['docx_path'], job['attempts'], e)
+            self.queue.fail(job['id'], self.owner, f'{type(e).__name__}: {e}', is_permanent_error(e))
+        else:
+            logger.info('Job %s converted with the %s plan in %.2fs', job['id'], report['plan']['strategy'],
+                        report['seconds'])
+            self.queue.complete(job['id'], self.owner)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def heartbeat(self, job_id, expires, stop, lease_lost):
+        """
+        Renew the lease every lease_seconds / 3 until stop is set. A renewal that fails, for example on a database
+        locked for longer than the connection timeout, is retried until the lease expires (time.time() of expires),
+        then the conversion is stopped: from then on another worker may lease the job
+        """
+        while not stop.wait(min(self.lease_seconds / 3, max(0.0, expires - time.time()))):
+            started = time.time()
+            try:
+                renewed = self.queue.heartbeat(job_id, self.owner, self.lease_seconds)
+            except sqlite3.Error as e:
+                if time.time() < expires:
+                    logger.warning('Could not renew the lease on job %s, trying again: %s', job_id, e)
+                    continue
+                logger.warning('Could not renew the lease on job %s before it expired, stopping its conversion: %s',
+                               job_id, e)
+                lease_lost.cancel()
+                return
+            if not renewed:
+                logger.warning('Lost the lease on job %s, stopping its conversion', job_id)
+                lease_lost.cancel()
+                return
+            # The queue set the new expiry after started, this is the earliest it can be
+            expires = started + self.lease_seconds
+
+def work(queue_path, lease_seconds, poll_interval, write_index, max_seconds, drain, thresholds=None):
+    """Entry point of one worker process"""
+    init_worker()
+    QueueWorker(JobQueue(queue_path), lease_seconds, poll_interval, write_index, max_seconds, thresholds).run(drain)
+
+def main():
+    parser = argparse.ArgumentParser(description='Durable DOCX conversion queue shared by workers on any host')
+    parser.add_argument('queue', help='SQLite queue file, on a filesystem every worker host can lock')
+    commands = parser.add_subparsers(dest='command', required=True)
+    enqueue_parser = commands.add_parser('enqueue', help='add DOCX files to the queue')
+    enqueue_parser.add_argument('docx_files', nargs='+')
+    enqueue_parser.add_argument('--output-dir', help='write HTML here instead of next to each DOCX file')
+    enqueue_parser.add_argument('--content-type', default='auto', choices=['auto', 'table', 'text'])
+    enqueue_parser.add_argument('--max-attempts', type=int, default=5)
+    work_parser = commands.add_parser('work', help='convert queued files until stopped')
+    work_parser.add_argument('--processes', type=int, default=1, help='worker processes on this host')
+    work_parser.add_argument('--lease', type=float, default=300.0, help='seconds a job stays leased without a heartbeat')
+    work_parser.add_argument('--interval', type=float, default=5.0, help='seconds between polls of an empty queue')
+    work_parser.add_argument('--search-index', action='store_true', help='write a search index next to each HTML file')
+    work_parser.add_argument('--timeout', type=float, help='seconds a single conversion may take')
+    work_parser.add_argument('--drain', action='store_true', help='exit once no job is left to lease')
+    work_parser.add_argument('--thresholds', help='conversion planner thresholds written by benchmark.py --calibrate')
+    commands.add_parser('stats', help='show backlog and throughput')
+    commands.add_parser('retry-dead', help='queue dead-letter jobs again')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    queue = JobQueue(args.queue)
+    if args.command == 'enqueue':
+        jobs = []
+        for docx_path in args.docx_files:
+            output_path = None
+            if args.output_dir:
+                output_path = os.path.join(args.output_dir, os.path.splitext(os.path.basename(docx_path))[0] + '.html')
+            jobs.append((docx_path, output_path, args.content_type))
+        print(f'Enqueued {len(queue.enqueue_many(jobs, args.max_attempts))} job(s)')
+    elif args.command == 'work':
+        processes = [multiprocessing.Process(target=work, args=(args.queue, args.lease, args.interval,
+                                                               args.search_index, args.timeout, args.drain,
+                                                               load_thresholds(args.thresholds)))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # Leased jobs of the stopped workers become available again when their leases expire
+            for process in processes:
+                process.terminate()
+    elif args.command == 'stats':
+        stats = queue.stats()
+        print(' '.join(f'{status}={count}' for status, count in stats['counts'].items()))
+        print(f'oldest queued {stats["oldest_queued_seconds"]:.0f}s, {stats["per_minute"]:.1f} done/min')
+        for job in queue.dead_jobs():
+            print(f'dead {job["id"]} {job["docx_path"]} after {job["attempts"]} attempt(s): {job["last_error"]}')
+    elif args.command == 'retry-dead':
+        print(f'Requeued {queue.retry_dead()} job(s)')
+
+if __name__ == '__main__':
+    main()
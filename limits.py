@@ -0,0 +1,191 @@
+import io
+import time
+import threading
+import xml.etree.ElementTree as ET
+
+MB = 1024 * 1024
+
+class ResourceLimitError(ValueError):
+    """
+    A document exceeded one of the ResourceLimits, raised as soon as the limit is crossed
+    progress: how far the conversion got, see DocumentBudget.snapshot
+    """
+    def __init__(self, message, progress=None):
+        super().__init__(message)
+        self.progress = progress or {}
+
+class DecompressedSizeError(ResourceLimitError):
+    pass
+
+class CompressionRatioError(ResourceLimitError):
+    pass
+
+class ElementLimitError(ResourceLimitError):
+    pass
+
+class NestingDepthError(ResourceLimitError):
+    pass
+
+class ConversionTimeoutError(ResourceLimitError):
+    pass
+
+class ConversionCancelled(Exception):
+    """The conversion was stopped through its CancellationToken, progress as in ResourceLimitError"""
+    def __init__(self, message, progress=None):
+        super().__init__(message)
+        self.progress = progress or {}
+
+class CancellationToken:
+    """Set from any thread to stop a running conversion at its next check"""
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+class ResourceLimits:
+    """
+    Limits applied to each document while it is unzipped and parsed, None disables a limit
+    The defaults stop zip bombs and runaway XML but leave room for very large legitimate filings
+    """
+    def __init__(self, max_total_bytes=1024 * MB, max_part_bytes=512 * MB, max_compression_ratio=200,
+                 max_elements=20_000_000, max_depth=256, max_seconds=None):
+        self.max_total_bytes = max_total_bytes
+        self.max_part_bytes = max_part_bytes
+        self.max_compression_ratio = max_compression_ratio
+        self.max_elements = max_elements
+        self.max_depth = max_depth
+        self.max_seconds = max_seconds
+
+    def start(self, token=None):
+        """Start the budget of one document, its clock starts now. token: optional CancellationToken"""
+        return DocumentBudget(self, token)
+
+class DocumentBudget:
+    """
+    Running totals of one document checked against its ResourceLimits and its cancellation token,
+    safe to share between the part threads. The renderers call check once per block and table row
+    """
+    CHUNK_SIZE = 64 * 1024
+    # Check the clock and publish the element count every this many parsed elements
+    CHECK_INTERVAL = 10_000
+
+    def __init__(self, limits, token=None):
+        self.limits = limits
+        self.token = token
+        self.deadline = time.monotonic() + limits.max_seconds if limits.max_seconds is not None else None
+        self.total_bytes = 0
+        self.elements = 0
+        self.blocks = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """Progress so far: decompressed bytes, parsed elements and rendered blocks and table rows"""
+        with self._lock:
+            return {'bytes': self.total_bytes, 'elements': self.elements, 'blocks': self.blocks, 'rows': self.rows}
+
+    def describe_progress(self):
+        progress = self.snapshot()
+        return f'after {progress["elements"]} elements parsed, {progress["blocks"]} blocks and {progress["rows"]} rows rendered'
+
+    def check(self):
+        """Raise ConversionCancelled or ConversionTimeoutError if the conversion has to stop"""
+        if self.token is not None and self.token.cancelled:
+            raise ConversionCancelled(f'Conversion cancelled {self.describe_progress()}', self.snapshot())
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise ConversionTimeoutError(
+                f'Conversion took longer than {self.limits.max_seconds}s, stopped {self.describe_progress()}',
+                self.snapshot())
+
+    def rendered(self, blocks=0, rows=0):
+        """Count rendered blocks or table rows, then check"""
+        with self._lock:
+            self.blocks += blocks
+            self.rows += rows
+        self.check()
+
+    def _add_bytes(self, count):
+        with self._lock:
+            self.total_bytes += count
+            total = self.total_bytes
+        if self.limits.max_total_bytes is not None and total > self.limits.max_total_bytes:
+            raise DecompressedSizeError(f'Document decompresses to more than {self.limits.max_total_bytes} bytes')
+
+    def _add_elements(self, count):
+        with self._lock:
+            self.elements += count
+            total = self.elements
+        if self.limits.max_elements is not None and total > self.limits.max_elements:
+            raise ElementLimitError(f'Document has more than {self.limits.max_elements} XML elements')
+
+    def copy_member(self, zip_ref, info, target):
+        """Decompress one zip member into the file object target, counting the bytes actually produced"""
+        limits = self.limits
+        # The sizes in the zip directory can lie, so they are only a cheap early rejection
+        if limits.max_part_bytes is not None and info.file_size > limits.max_part_bytes:
+            raise DecompressedSizeError(f'{info.filename} is larger than {limits.max_part_bytes} bytes')
+        part_bytes = 0
+        with zip_ref.open(info) as source:
+            while True:
+                chunk = source.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                part_bytes += len(chunk)
+                if limits.max_part_bytes is not None and part_bytes > limits.max_part_bytes:
+                    raise DecompressedSizeError(f'{info.filename} is larger than {limits.max_part_bytes} bytes')
+                # Small members compress poorly, only judge the ratio once there is something to judge
+                if (limits.max_compression_ratio is not None and part_bytes > MB
+                        and part_bytes > limits.max_compression_ratio * max(info.compress_size, 1)):
+                    raise CompressionRatioError(
+                        f'{info.filename} expands more than {limits.max_compression_ratio} times')
+                self._add_bytes(len(chunk))
+                self.check()
+                target.write(chunk)
+
+    def read(self, zip_ref, name):
+        """Decompress one zip member into memory under the same limits"""
+        buffer = io.BytesIO()
+        self.copy_member(zip_ref, zip_ref.getinfo(name), buffer)
+        buffer.seek(0)
+        return buffer
+
+    def parse(self, source):
+        """
+        Parse an XML file (path or file object) like ET.parse(source).getroot(),
+        stopping as soon as the element count, nesting depth or deadline is exceeded
+        """
+        root = None
+        for event, element in self.iterparse(source):
+            if root is None:
+                root = element
+        return root
+
+    def iterparse(self, source):
+        """
+        ET.iterparse(source, events=('start', 'end')) under the element, depth and time limits, for callers that
+        process the tree while it is parsed. The limits are checked before each event is yielded
+        """
+        max_depth = self.limits.max_depth
+        depth = 0
+        pending = 0
+        for event, element in ET.iterparse(source, events=('start', 'end')):
+            if event == 'end':
+                depth -= 1
+                yield event, element
+                continue
+            depth += 1
+            if max_depth is not None and depth > max_depth:
+                raise NestingDepthError(f'XML nesting deeper than {max_depth} levels')
+            pending += 1
+            if pending == self.CHECK_INTERVAL:
+                self._add_elements(pending)
+                pending = 0
+                self.check()
+            yield event, element
+        self._add_elements(pending)
+        self.check()
@@ -1,44 +1,188 @@
+import os
+import re
 import sys
+import time
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QFileDialog, 
-                            QVBoxLayout, QWidget, QLabel, QProgressBar, QMessageBox)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
+                            QVBoxLayout, QHBoxLayout, QWidget, QLabel, QProgressBar, QMessageBox,
+                            QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView,
+                            QLineEdit, QSpinBox, QTextBrowser, QSplitter)
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtGui import QTextCursor
 from update import DocxProcessor
+from xlsx import XlsxProcessor
+from limits import CancellationToken, ConversionCancelled
 
-class ConversionWorker(QThread):
-    finished = pyqtSignal(str)
-    error = pyqtSignal(str)
-    progress = pyqtSignal(int)
+# Preview HTML sent to the GUI thread at most this often, the first chunk is sent as soon as it is rendered
+PREVIEW_INTERVAL = 0.2
+# The preview stops growing after this many characters, the output file always has everything
+PREVIEW_LIMIT = 2_000_000
+# Characters of a finished output file the preview inserts at a time, one batch per turn of the event loop
+PREVIEW_BATCH = 100_000
+# Tables and lists, the blocks a preview batch must not cut through without closing them
+BLOCK_TAG = re.compile(r'<(/?)(table|ul|ol)\b[^>]*>')
 
-    def __init__(self, file_path, content_type):
+class ConversionSignals(QObject):
+    # QRunnable is not a QObject, so the worker reports through this object; every signal carries the queue row
+    started = pyqtSignal(int)
+    finished = pyqtSignal(int, str)
+    error = pyqtSignal(int, str)
+    cancelled = pyqtSignal(int, str)
+    progress = pyqtSignal(int, int)
+    preview = pyqtSignal(int, str)
+
+class PreviewSignals(QObject):
+    # Row, preview generation (see MainWindow.show_preview) and a batch of complete HTML
+    loaded = pyqtSignal(int, int, str)
+    finished = pyqtSignal(int)  # Preview generation
+
+def preview_batches(lines, limit=PREVIEW_LIMIT, batch_size=PREVIEW_BATCH):
+    """
+    Group the lines of an output file into batches of complete HTML for the preview. A batch ends between blocks,
+    or between the rows of a table and the items of a list, closing them and opening them again in the next batch
+    Stops before the line that would take the batches past limit characters
+    """
+    batch = []
+    size = 0
+    total = 0
+    open_tags = []  # (name, opening tag) of the tables and lists open at the end of batch
+    for line in lines:
+        if total + len(line) > limit:
+            break
+        batch.append(line)
+        size += len(line)
+        total += len(line)
+        for match in BLOCK_TAG.finditer(line):
+            if not match.group(1):
+                open_tags.append((match.group(2), match.group(0)))
+            elif open_tags:
+                open_tags.pop()
+        at_boundary = not open_tags or line.rstrip().endswith('</tr>' if open_tags[-1][0] == 'table' else '</li>')
+        if size >= batch_size and at_boundary:
+            yield ''.join(batch + [f'</{name}>' for name, _ in reversed(open_tags)])
+            batch = [tag for _, tag in open_tags]
+            size = 0
+    if batch:
+        yield ''.join(batch + [f'</{name}>' for name, _ in reversed(open_tags)])
+
+class PreviewLoader(QRunnable):
+    """Read a finished output file for the preview off the GUI thread, in batches of complete HTML"""
+    def __init__(self, row, generation, output_path):
         super().__init__()
+        self.row = row
+        self.generation = generation
+        self.output_path = output_path
+        self.cancelled = False
+        self.signals = PreviewSignals()
+        self.setAutoDelete(False)
+
+    def run(self):
+        try:
+            with open(self.output_path, 'r', encoding='utf-8') as f:
+                for html in preview_batches(f):
+                    if self.cancelled:
+                        return
+                    self.signals.loaded.emit(self.row, self.generation, html)
+        except OSError:
+            # Moved or deleted since it was written, there is nothing to preview
+            pass
+        finally:
+            self.signals.finished.emit(self.generation)
+
+class ConversionWorker(QRunnable):
+    def __init__(self, row, file_path, output_path, content_type, docx_processor, xlsx_processor):
+        super().__init__()
+        self.row = row
         self.file_path = file_path
+        self.output_path = output_path
         self.content_type = content_type
-        self.processor = DocxProcessor()
+        # Shared by every worker of the window, the processors keep no per-document state
+        self.docx_processor = docx_processor
+        self.xlsx_processor = xlsx_processor
+        self.cancelled = False
+        # Stops the conversion from the GUI thread once it is running
+        self.token = CancellationToken()
+        self.signals = ConversionSignals()
+        # The window keeps a reference until the task is done, Qt must not delete it behind our back
+        self.setAutoDelete(False)
 
     def run(self):
+        if self.cancelled:
+            return
+        self.signals.started.emit(self.row)
+        # Save output through a temporary file, so the output never holds a partial or interleaved write
+        tmp_path = self.output_path + '.tmp'
         try:
-            self.progress.emit(10)
-            # Process the document
-            html_content = self.processor.process_docx(self.file_path, self.content_type)
-            self.progress.emit(70)
-
-            # Save output
-            with open('output.html', 'w', encoding='utf-8') as f:
-                f.write(html_content)
-            self.progress.emit(100)
-            
-            self.finished.emit('Conversion completed successfully!')
+            self.signals.progress.emit(self.row, 10)
+            if self.file_path.lower().endswith('.xlsx'):
+                # Spreadsheets are all tables, the content type does not apply
+                # Their chunks are not complete HTML, the window previews the output file once it is written
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for chunk in self.xlsx_processor.iter_html(self.file_path, token=self.token):
+                        f.write(chunk)
+            else:
+                self.write_docx(tmp_path)
+            self.signals.progress.emit(self.row, 70)
+            os.replace(tmp_path, self.output_path)
+            self.signals.progress.emit(self.row, 100)
+
+            self.signals.finished.emit(self.row, self.output_path)
+        except ConversionCancelled as e:
+            self.remove_tmp(tmp_path)
+            self.signals.cancelled.emit(self.row, str(e))
         except Exception as e:
-            self.error.emit(str(e))
+            self.remove_tmp(tmp_path)
+            self.signals.error.emit(self.row, str(e))
+
+    def write_docx(self, tmp_path):
+        """Write the HTML chunk by chunk as the document is rendered, sending the chunks to the preview in batches"""
+        pending = []
+        last_sent = None
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for chunk in self.docx_processor.iter_docx(self.file_path, self.content_type, token=self.token):
+                f.write(chunk)
+                pending.append(chunk)
+                # Batched so a document of thousands of blocks does not flood the GUI thread with signals
+                if last_sent is None or time.monotonic() - last_sent >= PREVIEW_INTERVAL:
+                    self.signals.preview.emit(self.row, ''.join(pending))
+                    pending = []
+                    last_sent = time.monotonic()
+        if pending:
+            self.signals.preview.emit(self.row, ''.join(pending))
+
+    def remove_tmp(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
 class MainWindow(QMainWindow):
+    # Columns of the queue table
+    FILE_COLUMN, TYPE_COLUMN, STATUS_COLUMN, PROGRESS_COLUMN = range(4)
+
     def __init__(self):
         super().__init__()
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(max(1, min(4, QThreadPool.globalInstance().maxThreadCount())))
+        self.workers = {}  # row -> ConversionWorker, for items that are queued or running
+        self.output_paths = set()
+        self.previews = {}  # row -> preview HTML received so far, for conversions that are running
+        self.preview_sizes = {}  # row -> characters in previews[row], PREVIEW_LIMIT once a chunk did not fit
+        self.finished_outputs = {}  # row -> output file of a finished conversion
+        self.preview_row = None  # Row shown in the preview pane
+        # The chunks of the preview pane, inserted in order by insert_preview, and how many are shown
+        self.preview_chunks = []
+        self.preview_shown = 0
+        self.preview_feeding = False
+        # Bumped by show_preview, so batches and timers meant for the previous row are ignored
+        self.preview_generation = 0
+        self.preview_loaders = {}  # generation -> PreviewLoader, kept until it finishes like workers
+        self.docx_processor = DocxProcessor()
+        self.xlsx_processor = XlsxProcessor()
         self.init_ui()
 
     def init_ui(self):
         self.setWindowTitle('DOCX to HTML Converter')
-        self.setGeometry(100, 100, 500, 400)
+        self.setGeometry(100, 100, 700, 800)
 
         # Create central widget and layout
         central_widget = QWidget()
@@ -75,74 +219,258 @@ class MainWindow(QMainWindow):
 
         self.auto_button = QPushButton('Convert Auto-Detect')
         self.auto_button.setStyleSheet(button_style)
-        self.auto_button.clicked.connect(lambda: self.select_file('auto'))
+        self.auto_button.clicked.connect(lambda: self.select_files('auto'))
         layout.addWidget(self.auto_button)
 
         self.table_button = QPushButton('Convert Tables Only')
         self.table_button.setStyleSheet(button_style)
-        self.table_button.clicked.connect(lambda: self.select_file('table'))
+        self.table_button.clicked.connect(lambda: self.select_files('table'))
         layout.addWidget(self.table_button)
 
         self.text_button = QPushButton('Convert Text Only')
         self.text_button.setStyleSheet(button_style)
-        self.text_button.clicked.connect(lambda: self.select_file('text'))
+        self.text_button.clicked.connect(lambda: self.select_files('text'))
         layout.addWidget(self.text_button)
 
+        # Add output directory and concurrency settings
+        settings_layout = QHBoxLayout()
+        settings_layout.addWidget(QLabel('Output folder:'))
+        self.output_dir_edit = QLineEdit(os.getcwd())
+        settings_layout.addWidget(self.output_dir_edit)
+        browse_button = QPushButton('Browse...')
+        browse_button.clicked.connect(self.select_output_dir)
+        settings_layout.addWidget(browse_button)
+        settings_layout.addWidget(QLabel('Workers:'))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, max(1, QThreadPool.globalInstance().maxThreadCount()))
+        self.workers_spin.setValue(self.thread_pool.maxThreadCount())
+        self.workers_spin.valueChanged.connect(self.thread_pool.setMaxThreadCount)
+        settings_layout.addWidget(self.workers_spin)
+        layout.addLayout(settings_layout)
+
+        # Add queue view
+        self.queue_table = QTableWidget(0, 4)
+        self.queue_table.setHorizontalHeaderLabels(['File', 'Type', 'Status', 'Progress'])
+        self.queue_table.horizontalHeader().setSectionResizeMode(self.FILE_COLUMN, QHeaderView.Stretch)
+        self.queue_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.queue_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.queue_table.itemSelectionChanged.connect(self.selection_changed)
+
+        # Preview of the selected item, or of the first conversion started while nothing is selected
+        self.preview = QTextBrowser()
+        self.preview.setOpenLinks(False)
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.queue_table)
+        splitter.addWidget(self.preview)
+        layout.addWidget(splitter)
+
+        self.cancel_button = QPushButton('Cancel Selected')
+        self.cancel_button.clicked.connect(self.cancel_selected)
+        layout.addWidget(self.cancel_button)
+
         # Add status label
         self.status_label = QLabel('No file selected')
         self.status_label.setAlignment(Qt.AlignCenter)
         self.status_label.setStyleSheet('margin: 10px;')
         layout.addWidget(self.status_label)
 
-        # Add progress bar
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setVisible(False)
-        layout.addWidget(self.progress_bar)
-
-        # Add some spacing at the bottom
-        layout.addStretch()
+    def select_output_dir(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Select Output Folder', self.output_dir_edit.text())
+        if directory:
+            self.output_dir_edit.setText(directory)
 
-    def select_file(self, content_type):
-        file_name, _ = QFileDialog.getOpenFileName(
+    def select_files(self, content_type):
+        file_names, _ = QFileDialog.getOpenFileNames(
             self,
-            "Select DOCX File",
+            "Select DOCX or XLSX Files",
             "",
-            "DOCX Files (*.docx)"
+            "Documents (*.docx *.xlsx);;DOCX Files (*.docx);;XLSX Files (*.xlsx)"
         )
         
-        if file_name:
-            self.status_label.setText('Processing...')
-            self.auto_button.setEnabled(False)
-            self.table_button.setEnabled(False)
-            self.text_button.setEnabled(False)
-            self.progress_bar.setVisible(True)
-            self.progress_bar.setValue(0)
-
-            # Create and start worker thread
-            self.worker = ConversionWorker(file_name, content_type)
-            self.worker.finished.connect(self.conversion_finished)
-            self.worker.error.connect(self.conversion_error)
-            self.worker.progress.connect(self.update_progress)
-            self.worker.start()
-
-    def conversion_finished(self, message):
-        self.status_label.setText(message)
-        self.auto_button.setEnabled(True)
-        self.table_button.setEnabled(True)
-        self.text_button.setEnabled(True)
-        self.progress_bar.setVisible(False)
-        QMessageBox.information(self, 'Success', 'Conversion completed! Check output.html')
-
-    def conversion_error(self, error_message):
-        self.status_label.setText(f'Error: {error_message}')
-        self.auto_button.setEnabled(True)
-        self.table_button.setEnabled(True)
-        self.text_button.setEnabled(True)
-        self.progress_bar.setVisible(False)
-        QMessageBox.critical(self, 'Error', f'An error occurred: {error_message}')
-
-    def update_progress(self, value):
-        self.progress_bar.setValue(value)
+        if not file_names:
+            return
+        output_dir = self.output_dir_edit.text() or os.getcwd()
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+        except OSError as e:
+            QMessageBox.critical(self, 'Error', f'Cannot use output folder: {e}')
+            return
+        for file_name in file_names:
+            self.enqueue(file_name, content_type, output_dir)
+        self.update_status()
+
+    def enqueue(self, file_name, content_type, output_dir):
+        row = self.queue_table.rowCount()
+        self.queue_table.insertRow(row)
+        file_item = QTableWidgetItem(os.path.basename(file_name))
+        file_item.setToolTip(file_name)
+        self.queue_table.setItem(row, self.FILE_COLUMN, file_item)
+        self.queue_table.setItem(row, self.TYPE_COLUMN, QTableWidgetItem(content_type))
+        self.queue_table.setItem(row, self.STATUS_COLUMN, QTableWidgetItem('Queued'))
+        progress_bar = QProgressBar()
+        progress_bar.setValue(0)
+        self.queue_table.setCellWidget(row, self.PROGRESS_COLUMN, progress_bar)
+
+        # Create and start worker on the thread pool
+        worker = ConversionWorker(row, file_name, self.unique_output_path(file_name, output_dir), content_type,
+                                  self.docx_processor, self.xlsx_processor)
+        worker.signals.started.connect(self.conversion_started)
+        worker.signals.finished.connect(self.conversion_finished)
+        worker.signals.error.connect(self.conversion_error)
+        worker.signals.cancelled.connect(self.conversion_cancelled)
+        worker.signals.progress.connect(self.update_progress)
+        worker.signals.preview.connect(self.append_preview)
+        self.workers[row] = worker
+        self.thread_pool.start(worker)
+
+    def unique_output_path(self, file_name, output_dir):
+        """One output per input: report.docx -> report.html, then report_2.html if that name is already taken"""
+        stem = os.path.splitext(os.path.basename(file_name))[0]
+        output_path = os.path.join(output_dir, f'{stem}.html')
+        counter = 2
+        while output_path in self.output_paths:
+            output_path = os.path.join(output_dir, f'{stem}_{counter}.html')
+            counter += 1
+        self.output_paths.add(output_path)
+        return output_path
+
+    def cancel_selected(self):
+        rows = {index.row() for index in self.queue_table.selectionModel().selectedRows()}
+        for row in sorted(rows):
+            worker = self.workers.get(row)
+            if worker is None:
+                continue
+            # Items that have not started yet are taken back from the pool, running ones stop at their next check
+            if self.thread_pool.tryTake(worker):
+                worker.cancelled = True
+                self.workers.pop(row)
+                self.set_status(row, 'Cancelled')
+            else:
+                worker.token.cancel()
+                self.set_status(row, 'Cancelling')
+        self.update_status()
+
+    def set_status(self, row, status, tooltip=''):
+        item = self.queue_table.item(row, self.STATUS_COLUMN)
+        item.setText(status)
+        item.setToolTip(tooltip)
+
+    def update_status(self):
+        if self.workers:
+            self.status_label.setText(f'Processing... {len(self.workers)} file(s) remaining')
+        else:
+            self.status_label.setText('All conversions completed')
+
+    def selection_changed(self):
+        rows = sorted({index.row() for index in self.queue_table.selectionModel().selectedRows()})
+        if rows:
+            self.show_preview(rows[0])
+
+    def show_preview(self, row):
+        """
+        Show what row has produced so far: the received chunks while it runs, its output file once done
+        Both go through insert_preview a chunk at a time, the file is read by a PreviewLoader
+        """
+        loader = self.preview_loaders.get(self.preview_generation)
+        if loader is not None:
+            loader.cancelled = True
+        self.preview_row = row
+        self.preview_generation += 1
+        self.preview.clear()
+        self.preview_shown = 0
+        self.preview_feeding = False
+        if row in self.previews:
+            # The same list the worker's chunks are appended to, so they keep arriving in order
+            self.preview_chunks = self.previews[row]
+            self.feed_preview()
+            return
+        self.preview_chunks = []
+        output_path = self.finished_outputs.get(row)
+        if output_path is not None:
+            loader = PreviewLoader(row, self.preview_generation, output_path)
+            loader.signals.loaded.connect(self.preview_loaded)
+            loader.signals.finished.connect(self.preview_loaders.pop)
+            self.preview_loaders[self.preview_generation] = loader
+            # Not the conversion pool, the preview must not wait behind queued conversions
+            QThreadPool.globalInstance().start(loader)
+
+    def preview_loaded(self, row, generation, html):
+        if generation != self.preview_generation:
+            return
+        self.preview_chunks.append(html)
+        self.feed_preview()
+
+    def feed_preview(self):
+        """Insert the chunks not shown yet, one per turn of the event loop so the window stays responsive"""
+        if not self.preview_feeding:
+            self.preview_feeding = True
+            generation = self.preview_generation
+            QTimer.singleShot(0, lambda: self.insert_preview(generation))
+
+    def insert_preview(self, generation):
+        if generation != self.preview_generation:
+            return
+        if self.preview_shown >= len(self.preview_chunks):
+            self.preview_feeding = False
+            return
+        # Insert only the new chunk, re-setting the whole document would get slower as the preview grows
+        cursor = self.preview.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertHtml(self.preview_chunks[self.preview_shown])
+        self.preview_shown += 1
+        QTimer.singleShot(0, lambda: self.insert_preview(generation))
+
+    def append_preview(self, row, html):
+        chunks = self.previews.get(row)
+        if chunks is None:
+            return
+        size = self.preview_sizes.get(row, 0)
+        if size + len(html) > PREVIEW_LIMIT:
+            # Chunks are complete blocks, the preview ends before the first one that does not fit instead of cutting it
+            self.preview_sizes[row] = PREVIEW_LIMIT
+            return
+        self.preview_sizes[row] = size + len(html)
+        chunks.append(html)
+        if row == self.preview_row:
+            self.feed_preview()
+
+    def conversion_started(self, row):
+        self.set_status(row, 'Converting')
+        self.previews[row] = []
+        # Follow new conversions until the user picks an item, and an item picked while it was still queued
+        if (row == self.preview_row or self.preview_row is None
+                or (self.preview_row not in self.workers and not self.queue_table.selectedItems())):
+            self.show_preview(row)
+
+    def conversion_finished(self, row, output_path):
+        self.workers.pop(row, None)
+        chunks = self.previews.pop(row, None)
+        self.preview_sizes.pop(row, None)
+        self.finished_outputs[row] = output_path
+        self.set_status(row, f'Done: {os.path.basename(output_path)}', output_path)
+        if row == self.preview_row and not chunks:
+            # Spreadsheets send no chunks, show their output file
+            self.show_preview(row)
+        self.update_status()
+
+    def conversion_error(self, row, error_message):
+        self.workers.pop(row, None)
+        self.previews.pop(row, None)
+        self.preview_sizes.pop(row, None)
+        self.set_status(row, f'Error: {error_message}', error_message)
+        self.queue_table.cellWidget(row, self.PROGRESS_COLUMN).setValue(0)
+        self.update_status()
+
+    def conversion_cancelled(self, row, message):
+        self.workers.pop(row, None)
+        self.previews.pop(row, None)
+        self.preview_sizes.pop(row, None)
+        self.set_status(row, 'Cancelled', message)
+        self.queue_table.cellWidget(row, self.PROGRESS_COLUMN).setValue(0)
+        self.update_status()
+
+    def update_progress(self, row, value):
+        self.queue_table.cellWidget(row, self.PROGRESS_COLUMN).setValue(value)
 
 def main():
     app = QApplication(sys.argv)
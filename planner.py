@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import time
+import zipfile
+import argparse
+import posixpath
+from uuid import uuid4
+from update import DocxProcessor
+from fast_text import FAST_CONTENT_TYPES
+from limits import ResourceLimits
+
+MB = 1024 * 1024
+# Start tags counted by the pre-scan, w: is the prefix Word and every library we have seen write
+SCAN_PATTERN = re.compile(rb'<w:(p|tbl|tr|tc|hyperlink)[\s/>]')
+# Longest start tag SCAN_PATTERN matches, a tag cut by a chunk boundary is counted with the next chunk
+SCAN_OVERLAP = 16
+
+class TagCounter:
+    """File-like target for DocumentBudget.copy_member that counts the scanned tags in what is written to it"""
+    def __init__(self):
+        self.counts = {b'p': 0, b'tbl': 0, b'tr': 0, b'tc': 0, b'hyperlink': 0}
+        self._tail = b''
+
+    def write(self, chunk):
+        data = self._tail + chunk
+        end = len(data) - SCAN_OVERLAP
+        for match in SCAN_PATTERN.finditer(data):
+            if match.start() >= end:
+                break
+            self.counts[match.group(1)] += 1
+        self._tail = data[max(end, 0):]
+
+    def close(self):
+        for match in SCAN_PATTERN.finditer(self._tail + b' '):
+            self.counts[match.group(1)] += 1
+        self._tail = b''
+
+class DocumentScan:
+    """What the planner knows about a document: sizes from the zip directory and tag counts of document.xml"""
+    def __init__(self, docx_path):
+        self.docx_path = docx_path
+        self.compressed_bytes = 0
+        self.total_bytes = 0
+        self.document_bytes = 0
+        self.parts = 0  # Headers, footers and note parts
+        self.part_bytes = 0
+        self.paragraphs = 0
+        self.tables = 0
+        self.rows = 0
+        self.cells = 0
+        self.hyperlinks = 0
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+class ConversionPlan:
+    """
+    How one conversion runs
+    strategy: 'in_memory' (process_docx), 'streaming' (iter_docx, written chunk by chunk), 'shared'
+    (process_docx_outputs, one parse for several content types) or 'fast' (fast_text, no styling)
+    part_workers: threads for the body and the header, footer and note parts, 1 renders them in turn
+    """
+    def __init__(self, strategy, content_types, part_workers=1, estimated_seconds=None, reasons=None):
+        self.strategy = strategy
+        self.content_types = content_types
+        self.part_workers = part_workers
+        self.estimated_seconds = estimated_seconds
+        self.reasons = reasons or []
+
+    def to_dict(self):
+        return dict(vars(self))
+
+class ConversionPlanner:
+    """
+    Pick the execution strategy of each conversion from a cheap pre-scan of the document
+    The thresholds are the defaults measured on CPython with the GIL, `python benchmark.py --calibrate planner.json`
+    measures them on the machine and documents at hand and ConversionPlanner.load reads them back
+    Every strategy produces the same output (see equivalence.py), the plan only changes time and memory
+    """
+    THRESHOLDS = {
+        # Peak bytes of an in-memory conversion per byte of document.xml (the parsed tree dominates)
+        'memory_per_byte': 12.0,
+        # Stream once an in-memory conversion is expected to need more than this
+        'memory_budget': 256 * MB,
+        # Bytes of header, footer and note parts from which they get threads of their own, None for never:
+        # with the GIL the pool costs more than it saves on any document measured
+        'parallel_part_bytes': None,
+        # Seconds of styled rendering per paragraph (in cells too) and table cell, for the estimate in the plan
+        'seconds_per_element': 0.00007,
+    }
+
+    def __init__(self, limits=None, max_workers=4, **thresholds):
+        unknown = set(thresholds) - set(self.THRESHOLDS)
+        if unknown:
+            raise ValueError(f'Unknown planner thresholds: {", ".join(sorted(unknown))}')
+        self.limits = limits or ResourceLimits()
+        self.max_workers = max_workers
+        self.thresholds = {**self.THRESHOLDS, **thresholds}
+        self._processors = {}  # part_workers -> DocxProcessor, they keep no per-document state
+
+    @classmethod
+    def load(cls, path, limits=None, max_workers=4):
+        """Planner with the thresholds benchmark.py --calibrate wrote to path"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(limits, max_workers, **json.load(f))
+
+    def processor(self, part_workers):
+        if part_workers not in self._processors:
+            self._processors[part_workers] = DocxProcessor(max_workers=part_workers, limits=self.limits)
+        return self._processors[part_workers]
+
+    def scan(self, docx_path, token=None):
+        """
+        Sizes from the zip central directory and one counting pass over the bytes of document.xml,
+        without parsing any XML. The pass runs under the resource limits like any other read
+        """
+        start = time.perf_counter()
+        scan = DocumentScan(docx_path)
+        budget = self.limits.start(token)
+        with zipfile.ZipFile(docx_path, 'r') as zip_ref:
+            infos = zip_ref.infolist()
+            scan.compressed_bytes = sum(info.compress_size for info in infos)
+            scan.total_bytes = sum(info.file_size for info in infos)
+            sizes = {posixpath.basename(info.filename): info.file_size
+                     for info in infos if posixpath.dirname(info.filename) == 'word'}
+            parts = self.processor(1).order_parts(list(sizes))
+            scan.parts = len(parts)
+            scan.part_bytes = sum(sizes[name] for _, name in parts)
+            info = zip_ref.getinfo('word/document.xml')
+            scan.document_bytes = info.file_size
+            counter = TagCounter()
+            budget.copy_member(zip_ref, info, counter)
+            counter.close()
+        scan.paragraphs = counter.counts[b'p']
+        scan.tables = counter.counts[b'tbl']
+        scan.rows = counter.counts[b'tr']
+        scan.cells = counter.counts[b'tc']
+        scan.hyperlinks = counter.counts[b'hyperlink']
+        scan.seconds = time.perf_counter() - start
+        return scan
+
+    def plan(self, scan, content_types=('auto',), search_index=False, to_file=False):
+        """
+        Choose how to convert the scanned document to content_types
+        search_index: whether an index is built, it needs the whole body before rendering so rules out streaming
+        to_file: the output goes straight to a file, which is what streaming saves memory on
+        """
+        thresholds = self.thresholds
+        content_types = list(dict.fromkeys(content_types))
+        reasons = []
+        estimated_seconds = (scan.paragraphs + scan.cells) * thresholds['seconds_per_element']
+
+        if all(content_type in FAST_CONTENT_TYPES for content_type in content_types):
+            reasons.append('text extraction only, no styling to compute')
+            return ConversionPlan('fast', content_types, 1, None, reasons)
+
+        part_workers = 1
+        parallel_part_bytes = thresholds['parallel_part_bytes']
+        if scan.parts and parallel_part_bytes is not None and scan.part_bytes >= parallel_part_bytes:
+            part_workers = min(self.max_workers, scan.parts + 1)
+            reasons.append(f'{scan.part_bytes} bytes of header, footer and note parts, rendered beside the body')
+
+        if len(content_types) > 1:
+            if any(content_type in FAST_CONTENT_TYPES for content_type in content_types):
+                reasons.append('text extraction runs on its own, the styled outputs share one parse')
+                return ConversionPlan('in_memory', content_types, part_workers, estimated_seconds, reasons)
+            reasons.append(f'{len(content_types)} outputs share one parse')
+            return ConversionPlan('shared', content_types, part_workers, estimated_seconds, reasons)
+
+        expected_memory = scan.document_bytes * thresholds['memory_per_byte']
+        if to_file and not search_index and expected_memory > thresholds['memory_budget']:
+            reasons.append(f'about {expected_memory / MB:.0f} MB in memory, over the '
+                           f'{thresholds["memory_budget"] / MB:.0f} MB budget')
+            return ConversionPlan('streaming', content_types, part_workers, estimated_seconds, reasons)
+        reasons.append(f'about {expected_memory / MB:.0f} MB in memory')
+        return ConversionPlan('in_memory', content_types, part_workers, estimated_seconds, reasons)
+
+    def execute(self, plan, docx_path, output_paths, table_data=None, search_index=None, token=None):
+        """
+        Run plan, writing each content type to output_paths[content_type] through a temporary file
+        so readers only ever see complete files
+        """
+        processor = self.processor(plan.part_workers)
+        if plan.strategy == 'streaming':
+            content_type = plan.content_types[0]
+            self.write(output_paths[content_type],
+                       processor.iter_docx(docx_path, content_type, table_data, token))
+            return
+        if plan.strategy == 'shared':
+            outputs = processor.process_docx_outputs(docx_path, plan.content_types, table_data, search_index, token)
+        else:
+            # 'in_memory' and 'fast': the styled outputs in one pass, the only one table_data and search_index see,
+            # then each fast content type through fast_text
+            styled = [content_type for content_type in plan.content_types if content_type not in FAST_CONTENT_TYPES]
+            outputs = {}
+            if styled:
+                outputs = processor.process_docx_outputs(docx_path, styled, table_data, search_index, token)
+            for content_type in plan.content_types:
+                if content_type in FAST_CONTENT_TYPES:
+                    outputs[content_type] = processor.process_fast(docx_path, content_type, token)
+        for content_type, html in outputs.items():
+            self.write(output_paths[content_type], [html])
+
+    def write(self, path, chunks):
+        # A temporary name of its own, two writers of the same output never share one
+        tmp_path = f'{path}.{os.getpid()}.{uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def convert(self, docx_path, output_paths, table_data=None, search_index=None, token=None):
+        """
+        Scan, plan and convert docx_path to output_paths (content_type -> path)
+        Returns the conversion report: the scan, the plan and how long each step took
+        """
+        scan = self.scan(docx_path, token)
+        plan = self.plan(scan, list(output_paths), search_index is not None, to_file=True)
+        start = time.perf_counter()
+        self.execute(plan, docx_path, output_paths, table_data, search_index, token)
+        return {
+            'document': docx_path,
+            'outputs': dict(output_paths),
+            'scan': scan.to_dict(),
+            'plan': plan.to_dict(),
+            'seconds': time.perf_counter() - start,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the conversion plan of DOCX files, optionally converting them')
+    parser.add_argument('docx_files', nargs='+')
+    parser.add_argument('--content-type', nargs='+', default=['auto'],
+                        choices=['auto', 'table', 'text'] + FAST_CONTENT_TYPES)
+    parser.add_argument('--thresholds', help='JSON file written by benchmark.py --calibrate')
+    parser.add_argument('--convert', action='store_true', help='also convert, next to each DOCX file')
+    args = parser.parse_args()
+
+    planner = ConversionPlanner.load(args.thresholds) if args.thresholds else ConversionPlanner()
+    for docx_path in args.docx_files:
+        if args.convert:
+            stem = os.path.splitext(docx_path)[0]
+            suffix = '' if len(args.content_type) == 1 else '_{}'
+            output_paths = {content_type: f'{stem}{suffix.format(content_type)}.html'
+                            for content_type in args.content_type}
+            report = planner.convert(docx_path, output_paths)
+        else:
+            scan = planner.scan(docx_path)
+            report = {'document': docx_path, 'scan': scan.to_dict(),
+                      'plan': planner.plan(scan, args.content_type, to_file=True).to_dict()}
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import re
+import heapq
+import argparse
+from contextlib import ExitStack
+
+# Words and amounts: 'Revenue', '1,234.5' and "company's" are single terms
+TERM_PATTERN = re.compile(r"\w+(?:[.,'’]\w+)*")
+
+def tokenize(text):
+    return [term.casefold() for term in TERM_PATTERN.findall(text)]
+
+class SearchIndex:
+    """
+    Collect an inverted index (term -> element anchors) of the document body while it is rendered.
+    The rendered body paragraphs get id="p<n>" and table cells id="t<table>-<row>-<cell>", numbered in document
+    order over the whole body, so an element gets the same anchor in every conversion mode and on every run.
+    """
+    def __init__(self, document):
+        self.document = document  # Name the postings point to, usually the HTML file name
+        self.postings = {}  # term -> {anchor: None}, an ordered set of anchors
+        self._paragraphs = {}
+        self._tables = {}
+
+    def start_document(self, body, ns):
+        """Number the body paragraphs and every table at any depth before anything is rendered"""
+        self._paragraphs = {p: n for n, p in enumerate(body.findall('w:p', ns), 1)}
+        self._tables = {tbl: n for n, tbl in enumerate(body.iter(f'{{{ns["w"]}}}tbl'), 1)}
+
+    def add(self, anchor, text):
+        for term in tokenize(text):
+            self.postings.setdefault(term, {})[anchor] = None
+
+    def _text(self, element, ns):
+        return ''.join(t.text or '' for t in element.iter(f'{{{ns["w"]}}}t'))
+
+    def paragraph(self, p, ns):
+        """Index a body paragraph, returns its anchor (None for paragraphs outside the numbered body)"""
+        n = self._paragraphs.get(p)
+        if n is None:
+            return None
+        anchor = f'p{n}'
+        self.add(anchor, self._text(p, ns))
+        return anchor
+
+    def cells(self, tbl, row, tcs, ns, nested_tables=False):
+        """
+        Index the cells of one table row, returns their anchors
+        nested_tables: also index the text of the tables nested in each cell under the cell's anchor, for outputs
+        that do not render nested tables (auto). Otherwise they are indexed under their own cells when rendered.
+        """
+        n = self._tables.get(tbl)
+        if n is None:
+            return [None] * len(tcs)
+        anchors = []
+        for col, tc in enumerate(tcs):
+            anchor = f't{n}-{row}-{col}'
+            paragraphs = tc.iter(f'{{{ns["w"]}}}p') if nested_tables else tc.findall('w:p', ns)
+            self.add(anchor, ' '.join(self._text(p, ns) for p in paragraphs))
+            anchors.append(anchor)
+        return anchors
+
+    def write(self, path):
+        """
+        One line per term, sorted: term, then document and comma separated anchors, tab separated
+        A merged index keeps the same layout with one document/anchors pair per document on each line
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            for term in sorted(self.postings):
+                f.write(f'{term}\t{self.document}\t{",".join(self.postings[term])}\n')
+
+def merge_indexes(paths, output_path):
+    """Merge index files written by SearchIndex.write (or by this function) in one streaming pass"""
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(path, 'r', encoding='utf-8')) for path in paths]
+        with open(output_path, 'w', encoding='utf-8') as out:
+            term, postings = None, []
+            for line in heapq.merge(*files, key=lambda line: line.partition('\t')[0]):
+                line_term, _, line_postings = line.rstrip('\n').partition('\t')
+                if line_term != term:
+                    if term is not None:
+                        out.write('\t'.join([term] + postings) + '\n')
+                    term, postings = line_term, []
+                postings.append(line_postings)
+            if term is not None:
+                out.write('\t'.join([term] + postings) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge per-document search indexes into one')
+    parser.add_argument('output', help='Merged index file to write')
+    parser.add_argument('indexes', nargs='+', help='Index files written alongside the HTML')
+    args = parser.parse_args()
+    merge_indexes(args.indexes, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -1,107 +1,57 @@
-import os
 import zipfile
-import xml.etree.ElementTree as ET
-import re
-from util import clean_text
+from util import clean_text, is_note_reference, note_reference, run_note_references, load_relationships
 
 class TableProcessor:
-    def __init__(self):
+    """
+    Stateless apart from the namespaces, safe to share between threads converting different documents
+    coalesce: merge neighbouring runs of a cell that get the same style, False renders every run on its own
+    """
+    def __init__(self, coalesce=True):
+        self.coalesce = coalesce
         self.namespaces = {
             'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
             'tbl': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
             'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
         }
 
-    def process_table(self, docx_path):
-        """Extract and parse document.xml directly, build HTML table with dynamic structure and inline styles"""
-        document_xml = os.path.join(docx_path, 'word', 'document.xml')
-        tree = ET.parse(document_xml)
-        root = tree.getroot()
-        ns = self.namespaces
-
-        html_tables = []
-        for tbl in root.findall('.//w:tbl', ns):
-            tbl_pr = tbl.find('w:tblPr', ns)
-            total_width_twips = None
-            tbl_cellmar = {}
-            style = []
-            if tbl_pr is not None:
-                tblw = tbl_pr.find('w:tblW', ns)
-                if tblw is not None and tblw.get(f'{{{ns["w"]}}}type') == 'dxa':
-                    w = tblw.get(f'{{{ns["w"]}}}w')
-                    if w and w.isdigit():
-                        total_width_twips = int(w)
-                # Parse table-wide default cell margins
-                tblcellmar = tbl_pr.find('w:tblCellMar', ns)
-                if tblcellmar is not None:
-                    for side in ['top', 'bottom', 'left', 'right']:
-                        mar = tblcellmar.find(f'w:{side}', ns)
-                        if mar is not None:
-                            w_val = mar.get(f'{{{ns["w"]}}}w')
-                            if w_val and w_val.isdigit():
-                                tbl_cellmar[side] = int(w_val) / 20.0  # pt
-            if self._is_page_table(tbl, ns):
-                style.append('border-bottom: solid black 1.0pt;')
-            style = ' '.join(style)
-            html_table = [
-                f'<table cellpadding="0" cellspacing="0" style="font: 10pt Times New Roman, Times, Serif; border-collapse: collapse; width: 100%; {style}">'
-            ]
-            for tr_idx, tr in enumerate(tbl.findall('w:tr', ns)):
-                row_style = self._get_row_style(tr, ns)
-                # Add row height if present
-                tr_pr = tr.find('w:trPr', ns)
-                if tr_pr is not None:
-                    tr_height = tr_pr.find('w:trHeight', ns)
-                    if tr_height is not None:
-                        val = tr_height.get(f'{{{ns["w"]}}}val')
-                        if val and val.isdigit():
-                            pt = int(val) / 20.0
-                            row_style += f' min-height: {pt:.1f}pt;'
-                if row_style:
-                    row_style = f'vertical-align: bottom; {row_style}'
-                else:
-                    row_style = 'vertical-align: bottom;'
-                tcs = tr.findall('w:tc', ns)
-                row_cells = []
-                last_cell_double_underline = False
-                for tc_idx, tc in enumerate(tcs):
-                    cell_text = self._get_cell_text(tc, ns, docx_path)
-                    row_cells.append(cell_text)
-                all_empty = all(cell.strip() == '' for cell in row_cells)
-                tr_style = row_style
-                if all_empty:
-                    tr_style += ' min-height: 12pt;'
-                    row_cells = ['&#160;' for _ in row_cells]
-                html_table.append(f'<tr{f" style=\"{tr_style}\"" if tr_style else ""}>')
-                for tc_idx, tc in enumerate(tcs):
-                    cell_text = row_cells[tc_idx]
-                    cell_style, colspan = self._get_cell_style(tc, ns, total_width_twips, tc_idx, cell_text, tbl_cellmar)
-                    tag = 'td'
-                    attrs = []
-                    if colspan > 1:
-                        attrs.append(f'colspan="{colspan}"')
-                    if cell_style:
-                        attrs.append(f'style="{cell_style}"')
-                    attr_str = ' '.join(attrs)
-                    html_table.append(f'<{tag} {attr_str}>{cell_text}</{tag}>')
-                    if tc_idx == len(tcs) - 1:
-                        props = tc.find('w:tcPr', ns)
-                        if props is not None:
-                            borders = props.find('w:tcBorders', ns)
-                            if borders is not None:
-                                bottom = borders.find('w:bottom', ns)
-                                if bottom is not None and bottom.get(f'{{{ns["w"]}}}val') == 'double':
-                                    last_cell_double_underline = True
-                if last_cell_double_underline:
-                    html_table.append('<td style="border-bottom: Black 2.5pt double;"></td>')
+    def render_table(self, tbl, ns, extract_dir, rels_name='document.xml.rels', table_data=None, layouts=('element',),
+                     search_index=None, budget=None):
+        """
+        Render a <w:tbl> once and assemble its HTML for each requested layout:
+        'element' is the table as it appears in auto conversions, 'table' as in tables-only conversions (keeps row heights)
+        Cells are rendered once and shared, only the <tr> tags and line separators differ between layouts
+        If search_index (a search_index.SearchIndex) is given, the cells are indexed and get id anchors
+        If budget (a limits.DocumentBudget) is given, it is checked after every row
+        """
+        table_tag, total_width_twips, tbl_cellmar = self._get_table_tag(tbl, ns)
+        html_tables = {layout: [table_tag] for layout in layouts}
+        templates = {}  # Cell style templates, long tables repeat the same few cell shapes on every row
+        if table_data is not None:
+            table_data.start_table()
+        for tr_idx, tr in enumerate(tbl.findall('w:tr', ns)):
+            anchors = None
+            if search_index is not None:
+                # The auto layout ('element') leaves nested tables out, their text is found under the outer cell
+                anchors = search_index.cells(tbl, tr_idx, tr.findall('w:tc', ns), ns, 'element' in layouts)
+            cells, all_empty = self.process_row_cells(
+                tr, ns, extract_dir, total_width_twips, rels_name, table_data, tbl_cellmar, anchors, templates)
+            for layout in layouts:
+                html_table = html_tables[layout]
+                html_table.append(self._get_row_tag(tr, ns, all_empty, layout == 'table'))
+                html_table.extend(cells)
                 html_table.append('</tr>')
-            html_table.append('</table>')
-            html_tables.append('\n'.join(html_table))
-        return '\n\n'.join(html_tables)
-    
-    def process_table_element(self, tbl, ns, extract_dir):
+            if budget is not None:
+                budget.rendered(rows=1)
+        if table_data is not None:
+            table_data.end_table()
+        separators = {'element': '\n\n', 'table': '\n'}
+        return {layout: separators[layout].join(html_tables[layout] + ['</table>']) for layout in layouts}
+
+    def _get_table_tag(self, tbl, ns):
+        """Returns the <table> tag, the table width in twips (None unless given in dxa) and the default cell margins"""
         tbl_pr = tbl.find('w:tblPr', ns)
         total_width_twips = None
+        tbl_cellmar = {}
         style = []
         if tbl_pr is not None:
             tblw = tbl_pr.find('w:tblW', ns)
@@ -109,60 +59,98 @@ class TableProcessor:
                 w = tblw.get(f'{{{ns["w"]}}}w')
                 if w and w.isdigit():
                     total_width_twips = int(w)
+            # Parse table-wide default cell margins
+            tblcellmar = tbl_pr.find('w:tblCellMar', ns)
+            if tblcellmar is not None:
+                for side in ['top', 'bottom', 'left', 'right']:
+                    mar = tblcellmar.find(f'w:{side}', ns)
+                    if mar is not None:
+                        w_val = mar.get(f'{{{ns["w"]}}}w')
+                        if w_val and w_val.isdigit():
+                            tbl_cellmar[side] = int(w_val) / 20.0  # pt
         if self._is_page_table(tbl, ns):
             style.append('border-bottom: solid black 1.0pt;')
         style = ' '.join(style)
-        html_table = [
-            f'<table cellpadding="0" cellspacing="0" style="font: 10pt Times New Roman, Times, Serif; border-collapse: collapse; width: 100%; {style}">'
-        ]
-        for tr_idx, tr in enumerate(tbl.findall('w:tr', ns)):
-            row_style = self._get_row_style(tr, ns)
-            # Always add vertical-align: bottom for every row
-            if row_style:
-                row_style = f'vertical-align: bottom; {row_style}'
-            else:
-                row_style = 'vertical-align: bottom;'
-            tcs = tr.findall('w:tc', ns)
-            row_cells = []
-            last_cell_double_underline = False
-            for tc_idx, tc in enumerate(tcs):
-                cell_text = self._get_cell_text(tc, ns, extract_dir)
-                row_cells.append(cell_text)
-            # Check if all cells are empty
-            all_empty = all(cell.strip() == '' for cell in row_cells)
-            # Add min-height if all cells are empty and fill with &nbsp;
-            tr_style = row_style
-            if all_empty:
-                tr_style += ' min-height: 12pt;'
-                row_cells = ['&#160;' for _ in row_cells]
-            html_table.append(f'<tr{f" style=\"{tr_style}\"" if tr_style else ""}>')
-            for tc_idx, tc in enumerate(tcs):
-                cell_text = row_cells[tc_idx]
-                cell_style, colspan = self._get_cell_style(tc, ns, total_width_twips, tc_idx, cell_text)
-                tag = 'td'
-                attrs = []
-                if colspan > 1:
-                    attrs.append(f'colspan="{colspan}"')
-                if cell_style:
-                    attrs.append(f'style="{cell_style}"')
-                attr_str = ' '.join(attrs)
-                html_table.append(f'<{tag} {attr_str}>{cell_text}</{tag}>')
-                # Check for double underline in last cell
-                if tc_idx == len(tcs) - 1:
-                    props = tc.find('w:tcPr', ns)
-                    if props is not None:
-                        borders = props.find('w:tcBorders', ns)
-                        if borders is not None:
-                            bottom = borders.find('w:bottom', ns)
-                            if bottom is not None and bottom.get(f'{{{ns["w"]}}}val') == 'double':
-                                last_cell_double_underline = True
-            # Add extra <td> with double border if needed
-            if last_cell_double_underline:
-                html_table.append('<td style="border-bottom: Black 2.5pt double;"></td>')
-            html_table.append('</tr>')
-        html_table.append('</table>')
-        return '\n\n'.join(html_table)
-    
+        table_tag = f'<table cellpadding="0" cellspacing="0" style="font: 10pt Times New Roman, Times, Serif; border-collapse: collapse; width: 100%; {style}">'
+        return table_tag, total_width_twips, tbl_cellmar
+
+    def process_row(self, tr, ns, extract_dir, total_width_twips=None, rels_name='document.xml.rels', table_data=None,
+                    templates=None):
+        """
+        Render one <w:tr> and return its HTML lines
+        templates: optional dict of cell style templates shared by the rows of one table (see _get_cell_template)
+        """
+        cells, all_empty = self.process_row_cells(
+            tr, ns, extract_dir, total_width_twips, rels_name, table_data, templates=templates)
+        return [self._get_row_tag(tr, ns, all_empty)] + cells + ['</tr>']
+
+    def process_row_cells(self, tr, ns, extract_dir, total_width_twips=None, rels_name='document.xml.rels', table_data=None, tbl_cellmar=None, anchors=None, templates=None):
+        """
+        Render the cells of one <w:tr>, returns the <td> lines and whether every cell was empty
+        anchors: optional id attribute of each <w:tc>
+        templates: optional dict of cell style templates shared by the rows of one table (see _get_cell_template)
+        """
+        tcs = tr.findall('w:tc', ns)
+        if table_data is not None:
+            table_data.add_row(tcs, ns)
+        html_cells = []
+        row_cells = []
+        last_cell_double_underline = False
+        for tc_idx, tc in enumerate(tcs):
+            cell_text = self._get_cell_text(tc, ns, extract_dir, rels_name)
+            row_cells.append(cell_text)
+        # Check if all cells are empty
+        all_empty = all(cell.strip() == '' for cell in row_cells)
+        # Fill with &nbsp; if all cells are empty, the row gets a min-height in _get_row_tag
+        if all_empty:
+            row_cells = ['&#160;' for _ in row_cells]
+        for tc_idx, tc in enumerate(tcs):
+            cell_text = row_cells[tc_idx]
+            cell_style, colspan, double_bottom = self._get_cell_template(
+                tc, ns, total_width_twips, tc_idx, cell_text, tbl_cellmar, templates)
+            tag = 'td'
+            attrs = []
+            if anchors and anchors[tc_idx]:
+                attrs.append(f'id="{anchors[tc_idx]}"')
+            if colspan > 1:
+                attrs.append(f'colspan="{colspan}"')
+            if cell_style:
+                attrs.append(f'style="{cell_style}"')
+            attr_str = ' '.join(attrs)
+            html_cells.append(f'<{tag} {attr_str}>{cell_text}</{tag}>')
+            # Check for double underline in last cell
+            if tc_idx == len(tcs) - 1:
+                last_cell_double_underline = double_bottom
+        # Add extra <td> with double border if needed
+        if last_cell_double_underline:
+            html_cells.append('<td style="border-bottom: Black 2.5pt double;"></td>')
+        return html_cells, all_empty
+
+    def _get_row_tag(self, tr, ns, all_empty, row_height=False, extra_style=''):
+        row_style = self._get_row_style(tr, ns)
+        # Add row height if present
+        if row_height:
+            tr_pr = tr.find('w:trPr', ns)
+            if tr_pr is not None:
+                tr_height = tr_pr.find('w:trHeight', ns)
+                if tr_height is not None:
+                    val = tr_height.get(f'{{{ns["w"]}}}val')
+                    if val and val.isdigit():
+                        pt = int(val) / 20.0
+                        row_style += f' min-height: {pt:.1f}pt;'
+        # Always add vertical-align: bottom for every row
+        if row_style:
+            row_style = f'vertical-align: bottom; {row_style}'
+        else:
+            row_style = 'vertical-align: bottom;'
+        # Add min-height if all cells are empty
+        tr_style = row_style
+        if all_empty:
+            tr_style += ' min-height: 12pt;'
+        if extra_style:
+            tr_style += f' {extra_style}'
+        return f'<tr{f" style=\"{tr_style}\"" if tr_style else ""}>'
+
     def _is_page_table(self, tbl, ns):
         """Check if the table is a page table (header/footer)"""
         tbl_pr = tbl.find('w:tblPr', ns)
@@ -194,34 +182,24 @@ class TableProcessor:
                     style.append(f'background-color: #{fill};')
         return ' '.join(style)
 
-    def _get_cell_text(self, tc, ns, extract_dir):
+    def _get_cell_text(self, tc, ns, extract_dir, rels_name='document.xml.rels'):
         # Output plain text unless inline style is needed
         html = []
         for p in tc.findall('w:p', ns):
             para_text = []
+            runs = []  # Consecutive runs, rendered together by process_runs
             for child in list(p):
                 tag = child.tag
                 if tag == f'{{{ns["w"]}}}pPr':
                     continue
                 if tag == f'{{{ns["w"]}}}r':
-                    run_style = self._get_run_style(child, ns)
-                    run_text = ''
-                    for rchild in list(child):
-                        rtag = rchild.tag
-                        if rtag == f'{{{ns["w"]}}}t':
-                            run_text += clean_text(rchild.text or '')
-                        elif rtag == f'{{{ns["w"]}}}br':
-                            run_text += '<br/>'
-                    if run_text == '':
-                        run_text = '&#160;'
-                    # Only wrap in <span> if there is actual style
-                    if run_style and run_text.strip() != '&#160;':
-                        para_text.append(f'<span style="{run_style}">{run_text}</span>')
-                    else:
-                        para_text.append(run_text)
+                    runs.append(child)
                 elif tag == f'{{{ns["w"]}}}hyperlink':
-                    hyperlink_html = self.process_hyperlink(child, ns, extract_dir)
+                    para_text.append(self.process_runs(runs, ns))
+                    runs = []
+                    hyperlink_html = self.process_hyperlink(child, ns, extract_dir, rels_name)
                     para_text.append(hyperlink_html)
+            para_text.append(self.process_runs(runs, ns))
             html.append(''.join(para_text))
         text = ''.join(html)
         text = text.replace('–', '&#8211;').replace('—', '&#8212;')
@@ -230,6 +208,34 @@ class TableProcessor:
             text = '&#160;'
         return text
 
+    def _get_cell_template(self, tc, ns, total_width_twips=None, tc_idx=0, cell_text=None, tbl_cellmar=None, templates=None):
+        """
+        Style, colspan and whether the bottom border is double of a cell, computed by _get_cell_style once per
+        distinct shape of cell in templates: the tcPr subtree, the indentation and alignment of the first paragraph
+        and whether the cell is empty (empty cells get transparent borders). Nothing else goes into the style,
+        so the rows of a regular table all reuse the templates of their first row
+        """
+        props = tc.find(f'{{{ns["w"]}}}tcPr')
+        first_p = tc.find(f'{{{ns["w"]}}}p')
+        ppr = first_p.find(f'{{{ns["w"]}}}pPr') if first_p is not None else None
+        ind = ppr.find(f'{{{ns["w"]}}}ind') if ppr is not None else None
+        jc = ppr.find(f'{{{ns["w"]}}}jc') if ppr is not None else None
+        key = (
+            tuple((el.tag, tuple(el.attrib.items())) for el in props.iter()) if props is not None else None,
+            ind.get(f'{{{ns["w"]}}}left') if ind is not None else None,
+            jc.get(f'{{{ns["w"]}}}val') if jc is not None else None,
+            None if cell_text is None else cell_text.strip() == '&#160;',
+        )
+        template = templates.get(key) if templates is not None else None
+        if template is None:
+            cell_style, colspan = self._get_cell_style(tc, ns, total_width_twips, tc_idx, cell_text, tbl_cellmar)
+            bottom = props.find(f'{{{ns["w"]}}}tcBorders/{{{ns["w"]}}}bottom') if props is not None else None
+            double_bottom = bottom is not None and bottom.get(f'{{{ns["w"]}}}val') == 'double'
+            template = (cell_style, colspan, double_bottom)
+            if templates is not None:
+                templates[key] = template
+        return template
+
     def _get_cell_style(self, tc, ns, total_width_twips=None, tc_idx=0, cell_text=None, tbl_cellmar=None):
         props = tc.find('w:tcPr', ns)
         style_parts = []
@@ -344,16 +350,9 @@ class TableProcessor:
                             align_style = 'text-align: start;'
                         elif align == 'end':
                             align_style = 'text-align: end;'
-        # Default alignment based on cell content
-        if align_style is None:
-            if cell_text is not None:
-                # Remove HTML tags and whitespace to check actual content
-                clean_text = re.sub(r'<[^>]+>', '', cell_text).strip()
-                if clean_text == '$' or clean_text == ')':
-                    align_style = 'text-align: left;'
-                else:
-                    # Default to left alignment as per Word's default
-                    align_style = 'text-align: left;'
+        # Default to left alignment as per Word's default, whatever the content of the cell
+        if align_style is None and cell_text is not None:
+            align_style = 'text-align: left;'
         # Compose style in the order: width, background-color, text-align, border, padding-bottom
         if width_style:
             style_parts.append(width_style)
@@ -525,33 +524,66 @@ class TableProcessor:
                     style.append('text-decoration: underline double;')
         return ' '.join(style) 
     
-    def process_hyperlink(self, hyperlink, ns, extract_dir):
-        # TODO: Generate link URL from r:ID in <w:hyperlink>, find the link in document.xml.rels
-        document_xml_rels = os.path.join(extract_dir, 'word', '_rels', 'document.xml.rels')
-        rels_tree = ET.parse(document_xml_rels)
-        rels_root = rels_tree.getroot()
-        relationships = rels_root.findall('.//{http://schemas.openxmlformats.org/package/2006/relationships}Relationship')
-        r_id = hyperlink.get(f'{{{ns["r"]}}}id')
-        link = ''
-        for rel in relationships:
-            if rel.get('Id') == r_id:
-                link = rel.get('Target')
-                break
-        html = ''
-        for run in hyperlink.findall('w:r', ns):
-            run_style = self._get_run_style(run, ns)
-            run_text = ''
-            for rchild in list(run):
-                rtag = rchild.tag
-                if rtag == f'{{{ns["w"]}}}t':
-                    run_text += clean_text(rchild.text or '')
-                elif rtag == f'{{{ns["w"]}}}br':
-                    run_text += '<br/>'
-            if run_text == '':
-                run_text = '&#160;'
-            if run_style and run_text.strip() != '&#160;':
-                html += f'<span style="{run_style}">{run_text}</span>'
+    def process_runs(self, runs, ns, note_references=True):
+        """
+        Render consecutive runs of a cell, merging neighbours that get the same style into one <span>
+        Plain text needs no <span>, and a blank run renders a non-breaking space that is not wrapped on its own.
+        Between two runs of the same style, blank runs join their <span> if formatted the same way. A run without
+        any text shows no formatting in Word, so it joins whatever its style
+        """
+        html = []
+        group_style = None
+        group_text = []
+        spaces = []  # (style, None for a run without text) of the blank runs since the last run with text
+        for run in runs:
+            run_style, run_text = self._run_content(run, ns, note_references)
+            if not run_text or run_text.strip() == '&#160;':
+                spaces.append((run_style if run_text else None, run_text or '&#160;'))
+                continue
+            if not self.coalesce:
+                html.extend(text for _, text in spaces)
+                html.append(self._wrap_runs(run_text, run_style))
+                spaces = []
+                continue
+            same_spaces = all(style in [None, run_style] for style, _ in spaces)
+            if group_text and (run_style != group_style or not same_spaces):
+                html.append(self._wrap_runs(''.join(group_text), group_style))
+                group_text = []
+            if group_text:
+                group_text.extend(text for _, text in spaces)
             else:
-                html += run_text
-        html = f'<a href="{link}">{html}</a>'
+                html.extend(text for _, text in spaces)
+            spaces = []
+            group_style = run_style
+            group_text.append(run_text)
+        if group_text:
+            html.append(self._wrap_runs(''.join(group_text), group_style))
+        html.extend(text for _, text in spaces)
+        return ''.join(html)
+
+    def _run_content(self, run, ns, note_references=True):
+        """Returns the style of a run and its text, '' for a run without text"""
+        run_style = self._get_run_style(run, ns)
+        run_text = ''
+        for rchild in list(run):
+            rtag = rchild.tag
+            if rtag == f'{{{ns["w"]}}}t':
+                run_text += clean_text(rchild.text or '')
+            elif rtag == f'{{{ns["w"]}}}br':
+                run_text += '<br/>'
+            elif note_references and is_note_reference(rchild, ns):
+                run_text += note_reference(rchild, ns)
+        return run_style, run_text
+
+    def _wrap_runs(self, run_text, run_style):
+        # Only wrap in <span> if there is actual style
+        return f'<span style="{run_style}">{run_text}</span>' if run_style else run_text
+
+    def process_hyperlink(self, hyperlink, ns, extract_dir, rels_name='document.xml.rels'):
+        relationships = load_relationships(extract_dir, rels_name)
+        r_id = hyperlink.get(f'{{{ns["r"]}}}id')
+        link = relationships.get(r_id, '')
+        runs = hyperlink.findall('w:r', ns)
+        html = self.process_runs(runs, ns, note_references=False)
+        html = f'<a href="{link}">{html}</a>{run_note_references(runs, ns)}'
         return html
\ No newline at end of file
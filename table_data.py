@@ -0,0 +1,144 @@
+import csv
+import json
+import re
+import numpy as np
+
+# A cell holding a single amount: 1,234 / (1,234) / $ 1,234.5 / 12% / a dash standing for zero
+NUMBER_PATTERN = re.compile(r'^\(?\$?\s*\(?\s*(\d{1,3}(,\d{3})+|\d+)?(\.\d+)?\s*\)?\s*%?\)?$')
+DASHES = ['—', '–', '-']
+# Cells that only carry the currency sign or the closing parenthesis of the neighbouring amount
+PUNCTUATION = ['$', '(', ')', '%', ')%', '%)', '$(']
+STRIP_TABLE = str.maketrans('', '', '$,()%  ')
+
+def parse_numbers(raw_values):
+    """Convert raw amounts to floats in one vectorised pass: '(1,234)' -> -1234.0, '—' -> 0.0"""
+    raw = np.asarray(raw_values, dtype=str)
+    if raw.size == 0:
+        return np.zeros(0, dtype=float)
+    negative = np.char.find(raw, '(') >= 0
+    digits = np.char.translate(raw, STRIP_TABLE)
+    digits = np.where(np.isin(digits, DASHES + ['']), '0', digits)
+    values = digits.astype(float)
+    values[negative] *= -1
+    return values
+
+def is_number(text):
+    text = text.strip()
+    return text in DASHES or (any(c.isdigit() for c in text) and NUMBER_PATTERN.match(text) is not None)
+
+class TableData:
+    """
+    Collect the numbers of each table while TableProcessor renders it, so no second pass over the document is needed.
+    Every table is stored column-wise: one entry per amount with its row label, column label and grid position.
+    """
+    def __init__(self):
+        self.tables = []
+        self._current = None
+
+    def start_table(self):
+        self._current = {
+            'header_rows': [],
+            'row_label': [],
+            'column_label': [],
+            'row': [],
+            'column': [],
+            'raw': [],
+            'row_index': 0,
+            'has_data': False,
+        }
+
+    def add_row(self, tcs, ns):
+        """Record one <w:tr> given its <w:tc> elements"""
+        table = self._current
+        cells = []
+        grid_col = 0
+        for tc in tcs:
+            span = 1
+            props = tc.find('w:tcPr', ns)
+            if props is not None:
+                gridspan = props.find('w:gridSpan', ns)
+                if gridspan is not None:
+                    span = int(gridspan.get(f'{{{ns["w"]}}}val', '1'))
+            text = ''.join(t.text or '' for t in tc.iter(f'{{{ns["w"]}}}t')).replace(' ', ' ').strip()
+            cells.append((grid_col, span, text))
+            grid_col += span
+
+        label = cells[0][2] if cells and not is_number(cells[0][2]) else ''
+        values = []  # (grid column, raw text)
+        prefix = ''
+        for grid_col, span, text in cells[1 if label else 0:]:
+            if text in PUNCTUATION:
+                if text.startswith(')') or text.startswith('%'):
+                    # Closing parenthesis or percent sign in its own cell belongs to the previous amount
+                    if values:
+                        values[-1] = (values[-1][0], values[-1][1] + text)
+                else:
+                    prefix += text
+                continue
+            if text and is_number(text):
+                values.append((grid_col, prefix + text))
+            prefix = ''
+
+        row_index = table['row_index']
+        table['row_index'] += 1
+        if not values or not label:
+            # Rows above the first amount with an empty label cell are column headings (years, periods, units)
+            if not table['has_data'] and not label:
+                table['header_rows'].append(cells)
+            return
+        table['has_data'] = True
+        for grid_col, raw in values:
+            table['row_label'].append(label)
+            table['column_label'].append(self._column_label(grid_col))
+            table['row'].append(row_index)
+            table['column'].append(grid_col)
+            table['raw'].append(raw)
+
+    def _column_label(self, grid_col):
+        parts = []
+        for cells in self._current['header_rows']:
+            for start, span, text in cells:
+                if start <= grid_col < start + span and text:
+                    parts.append(text)
+        return ' '.join(parts)
+
+    def end_table(self):
+        table = self._current
+        self._current = None
+        if not table['raw']:
+            return
+        self.tables.append({
+            'row_label': table['row_label'],
+            'column_label': table['column_label'],
+            'row': np.asarray(table['row'], dtype=int),
+            'column': np.asarray(table['column'], dtype=int),
+            'raw': table['raw'],
+            'value': parse_numbers(table['raw']),
+        })
+
+    def to_records(self):
+        for table_index, table in enumerate(self.tables):
+            for i in range(len(table['raw'])):
+                yield {
+                    'table': table_index,
+                    'row': int(table['row'][i]),
+                    'column': int(table['column'][i]),
+                    'row_label': table['row_label'][i],
+                    'column_label': table['column_label'][i],
+                    'raw': table['raw'][i],
+                    'value': float(table['value'][i]),
+                }
+
+    def to_json(self, path):
+        """Write one object per table, each field stored as a column array"""
+        tables = [{key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in table.items()}
+                  for table in self.tables]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'tables': tables}, f, ensure_ascii=False)
+
+    def to_csv(self, path):
+        fields = ['table', 'row', 'column', 'row_label', 'column_label', 'raw', 'value']
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.to_records())
@@ -0,0 +1,36 @@
+import os
+import sys
+import zipfile
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+W_NAMESPACE = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+R_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+RELS_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+def relationships_xml(targets):
+    rels = ''.join(f'<Relationship Id="{r_id}" Target="{target}" TargetMode="External" Type="hyperlink"/>'
+                   for r_id, target in targets.items())
+    return f'<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="{RELS_NAMESPACE}">{rels}</Relationships>'
+
+@pytest.fixture
+def make_docx(tmp_path):
+    """
+    Write a minimal DOCX: body is the XML inside <w:body>, footnotes the <w:footnote> elements of footnotes.xml,
+    links {r:id: target} the hyperlink relationships of document.xml
+    """
+    def make(body, name='test.docx', footnotes=None, links=None):
+        path = tmp_path / name
+        with zipfile.ZipFile(path, 'w') as zip_file:
+            zip_file.writestr('[Content_Types].xml', '<?xml version="1.0" encoding="UTF-8"?>'
+                              '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>')
+            zip_file.writestr('word/document.xml', f'<w:document xmlns:w="{W_NAMESPACE}" xmlns:r="{R_NAMESPACE}">'
+                                                   f'<w:body>{body}</w:body></w:document>')
+            zip_file.writestr('word/_rels/document.xml.rels', relationships_xml(links or {}))
+            if footnotes is not None:
+                zip_file.writestr('word/footnotes.xml', f'<w:footnotes xmlns:w="{W_NAMESPACE}" '
+                                                        f'xmlns:r="{R_NAMESPACE}">{footnotes}</w:footnotes>')
+        return str(path)
+    return make
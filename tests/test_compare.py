@@ -0,0 +1,39 @@
+from compare import DocumentComparer
+
+def paragraph(text, list_item=False):
+    num_pr = '<w:pPr><w:numPr><w:ilvl w:val="0"/><w:numId w:val="1"/></w:numPr></w:pPr>' if list_item else ''
+    return f'<w:p>{num_pr}<w:r><w:t>{text}</w:t></w:r></w:p>'
+
+def counting_comparer():
+    comparer = DocumentComparer()
+    rendered = []
+    render_blocks = comparer.processor.render_blocks
+
+    def counting_render_blocks(container, *args, **kwargs):
+        rendered.append(len(container))
+        return render_blocks(container, *args, **kwargs)
+
+    comparer.processor.render_blocks = counting_render_blocks
+    return comparer, rendered
+
+def test_unchanged_blocks_reused_when_diff_boundaries_shift(make_docx):
+    blocks = [paragraph(f'Paragraph {i}') for i in range(6)]
+    v1 = make_docx(''.join(blocks), 'v1.docx')
+    # The change moves from the end of the document to its middle, splitting the unchanged stretch
+    v2 = make_docx(''.join(blocks) + paragraph('Added'), 'v2.docx')
+    v3 = make_docx(''.join(blocks[:3] + [paragraph('Inserted')] + blocks[3:]), 'v3.docx')
+    comparer, rendered = counting_comparer()
+    comparer.compare(v1, v2)
+    rendered.clear()
+    html = comparer.compare(v1, v3)
+    assert rendered == [1]  # only the inserted paragraph
+    assert html == DocumentComparer().compare(v1, v3)
+
+def test_list_rendered_as_one_fragment(make_docx):
+    items = [paragraph(f'Item {i}', list_item=True) for i in range(3)]
+    v1 = make_docx(paragraph('Intro') + ''.join(items) + paragraph('Outro'), 'v1.docx')
+    v2 = make_docx(paragraph('Intro changed') + ''.join(items) + paragraph('Outro'), 'v2.docx')
+    comparer, rendered = counting_comparer()
+    html = comparer.compare(v1, v2)
+    assert sorted(rendered) == [1, 1, 1, 3]
+    assert html.count('<ul') + html.count('<ol') == 1
@@ -0,0 +1,27 @@
+import pytest
+from update import DocxProcessor
+
+HIDDEN_BODY = (
+    '<w:p><w:r><w:rPr><w:vanish/></w:rPr><w:t>false 2024 FY</w:t></w:r>'
+    '<w:r><w:t>Revenue grew</w:t></w:r></w:p>'
+    '<w:p><w:hyperlink><w:r><w:rPr><w:vanish/></w:rPr><w:t>hidden link</w:t></w:r></w:hyperlink></w:p>'
+    '<w:tbl><w:tr><w:tc><w:p><w:r><w:rPr><w:vanish/></w:rPr><w:t>hidden cell</w:t></w:r>'
+    '<w:r><w:t>398,137</w:t></w:r></w:p></w:tc></w:tr></w:tbl>'
+)
+
+@pytest.mark.parametrize('content_type', ['plain', 'markdown', 'semantic'])
+def test_hidden_runs_are_left_out(make_docx, content_type):
+    output = DocxProcessor().process_docx(make_docx(HIDDEN_BODY), content_type)
+    assert 'Revenue grew' in output
+    assert '398,137' in output
+    for hidden in ['false 2024 FY', 'hidden link', 'hidden cell']:
+        assert hidden not in output
+
+def test_fast_text_matches_visible_text_of_text_mode(make_docx):
+    processor = DocxProcessor()
+    path = make_docx(HIDDEN_BODY)
+    plain = processor.process_docx(path, 'plain')
+    # The styled renderer keeps hidden runs in the HTML, display: none
+    text = processor.process_docx(path, 'text')
+    assert 'display: none;' in text
+    assert plain.split('\n\n')[0] == 'Revenue grew'
@@ -0,0 +1,19 @@
+import pytest
+from ir import DocumentIR, IRVersionError, HEADER
+
+BODY = '<w:p><w:r><w:t>Revenue grew</w:t></w:r></w:p>'
+
+@pytest.mark.parametrize('keep', [0, HEADER.size - 1, HEADER.size, HEADER.size + 10])
+def test_truncated_file_raises_ir_error(make_docx, tmp_path, keep):
+    path = tmp_path / 'document.ir'
+    DocumentIR.from_docx(make_docx(BODY)).save(path)
+    data = path.read_bytes()
+    path.write_bytes(data[:keep])
+    with pytest.raises(IRVersionError):
+        DocumentIR.load(path)
+
+def test_saved_file_loads(make_docx, tmp_path):
+    path = tmp_path / 'document.ir'
+    document_ir = DocumentIR.from_docx(make_docx(BODY))
+    document_ir.save(path)
+    assert DocumentIR.load(path).strings == document_ir.strings
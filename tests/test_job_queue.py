@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+import time
+import pytest
+import job_queue
+from job_queue import JobQueue, QueueWorker
+from limits import ConversionCancelled, ElementLimitError
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'queue.db'), backoff=0.0)
+
+def job_status(queue, job_id):
+    with queue.transaction() as conn:
+        return conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+def converted(*args):
+    return {'plan': {'strategy': 'test'}, 'seconds': 0.0}
+
+def test_complete_requires_the_lease(queue):
+    job_id = queue.enqueue('a.docx')
+    job = queue.lease('first', lease_seconds=-1.0)
+    # The lease expired, so another worker takes the job over
+    assert queue.lease('second')['id'] == job_id
+    assert not queue.heartbeat(job['id'], 'first')
+    queue.complete(job['id'], 'first')
+    assert job_status(queue, job_id)['status'] == 'leased'
+    queue.complete(job['id'], 'second')
+    assert job_status(queue, job_id)['status'] == 'done'
+
+def test_resource_limit_errors_are_not_retried(queue, monkeypatch):
+    def too_large(*args):
+        raise ElementLimitError('Document has more than 10 XML elements')
+
+    monkeypatch.setattr(job_queue, 'convert_file', too_large)
+    job_id = queue.enqueue('a.docx')
+    worker = QueueWorker(queue)
+    worker.process(queue.lease(worker.owner))
+    job = job_status(queue, job_id)
+    assert (job['status'], job['attempts']) == ('dead', 1)
+    assert job['last_error'].startswith('ElementLimitError')
+
+def test_transient_errors_are_retried(queue, monkeypatch):
+    def unreadable(*args):
+        raise OSError('share unavailable')
+
+    monkeypatch.setattr(job_queue, 'convert_file', unreadable)
+    job_id = queue.enqueue('a.docx')
+    worker = QueueWorker(queue)
+    worker.process(queue.lease(worker.owner))
+    assert job_status(queue, job_id)['status'] == 'queued'
+
+def test_lost_lease_stops_the_conversion(queue, monkeypatch):
+    def wait_for_cancel(docx_path, output_path, content_type, write_index, max_seconds, thresholds, token):
+        deadline = time.monotonic() + 10
+        while not token.cancelled:
+            assert time.monotonic() < deadline, 'conversion was not cancelled'
+            time.sleep(0.01)
+        raise ConversionCancelled('Conversion cancelled')
+
+    monkeypatch.setattr(job_queue, 'convert_file', wait_for_cancel)
+    job_id = queue.enqueue('a.docx')
+    worker = QueueWorker(queue, lease_seconds=0.3)
+    job = queue.lease(worker.owner, worker.lease_seconds)
+    with queue.transaction() as conn:
+        conn.execute("UPDATE jobs SET lease_owner = 'other' WHERE id = ?", (job_id,))
+    worker.process(job)
+    # Abandoned, not failed: the job stays with the worker that holds the lease
+    job = job_status(queue, job_id)
+    assert (job['status'], job['lease_owner'], job['last_error']) == ('leased', 'other', None)
+
+def run_heartbeat(worker, queue, job):
+    stop = threading.Event()
+    lease_lost = job_queue.CancellationToken()
+    thread = threading.Thread(target=worker.heartbeat, args=(job['id'], job['lease_expires'], stop, lease_lost))
+    thread.start()
+    return stop, lease_lost, thread
+
+def test_heartbeat_retries_a_locked_database(queue, monkeypatch):
+    renew = queue.heartbeat
+    failures = []
+
+    def locked_once(*args):
+        if not failures:
+            failures.append(time.time())
+            raise sqlite3.OperationalError('database is locked')
+        return renew(*args)
+
+    monkeypatch.setattr(queue, 'heartbeat', locked_once)
+    queue.enqueue('a.docx')
+    worker = QueueWorker(queue, lease_seconds=0.6)
+    stop, lease_lost, thread = run_heartbeat(worker, queue, queue.lease(worker.owner, worker.lease_seconds))
+    time.sleep(1.5)
+    stop.set()
+    thread.join()
+    assert failures
+    assert not lease_lost.cancelled
+
+def test_heartbeat_gives_up_when_the_lease_expires(queue, monkeypatch):
+    def locked(*args):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(queue, 'heartbeat', locked)
+    queue.enqueue('a.docx')
+    worker = QueueWorker(queue, lease_seconds=0.6)
+    job = queue.lease(worker.owner, worker.lease_seconds)
+    stop, lease_lost, thread = run_heartbeat(worker, queue, job)
+    thread.join(timeout=5)
+    # The thread survives the errors and cancels the conversion once the lease has run out, not before
+    assert not thread.is_alive()
+    assert lease_lost.cancelled
+    assert time.time() >= job['lease_expires']
@@ -0,0 +1,66 @@
+import re
+from html.parser import HTMLParser
+import pytest
+from update import DocxProcessor
+
+FOOTNOTES = (
+    '<w:footnote w:type="separator" w:id="-1"><w:p><w:r><w:separator/></w:r></w:p></w:footnote>'
+    '<w:footnote w:id="1"><w:p><w:r><w:t>Linked note</w:t></w:r></w:p></w:footnote>'
+    '<w:footnote w:id="2"><w:p><w:r><w:t>Cell note</w:t></w:r></w:p></w:footnote>'
+    '<w:footnote w:id="3"><w:p><w:r><w:t>Plain note</w:t></w:r></w:p></w:footnote>'
+)
+BODY = (
+    '<w:p><w:r><w:t xml:space="preserve">See </w:t></w:r><w:hyperlink r:id="rId1">'
+    '<w:r><w:t>the filing</w:t></w:r><w:r><w:footnoteReference w:id="1"/></w:r></w:hyperlink>'
+    '<w:r><w:t xml:space="preserve"> and more</w:t></w:r><w:r><w:footnoteReference w:id="3"/></w:r></w:p>'
+    '<w:tbl><w:tr><w:tc><w:p><w:hyperlink r:id="rId1"><w:r><w:t>Revenue</w:t></w:r>'
+    '<w:r><w:footnoteReference w:id="2"/></w:r></w:hyperlink></w:p></w:tc></w:tr></w:tbl>'
+)
+
+class AnchorChecker(HTMLParser):
+    """Collects the ids and note backlinks of a document and the deepest nesting of <a> elements"""
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.max_depth = 0
+        self.ids = set()
+        self.backlinks = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if 'id' in attrs:
+            self.ids.add(attrs['id'])
+        if tag == 'a':
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            if re.fullmatch(r'#footnote-ref-\d+', attrs.get('href', '')):
+                self.backlinks.append(attrs['href'][1:])
+
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self.depth -= 1
+
+@pytest.fixture
+def docx_path(make_docx):
+    return make_docx(BODY, footnotes=FOOTNOTES, links={'rId1': 'https://example.com/filing'})
+
+@pytest.mark.parametrize('content_type', ['auto', 'text'])
+def test_note_references_in_links_are_not_nested(docx_path, content_type):
+    checker = AnchorChecker()
+    checker.feed(DocxProcessor().process_docx(docx_path, content_type))
+    assert checker.max_depth == 1
+    # The notes link back to their references, including the ones made inside a link.
+    # Text conversions leave tables out, and with them the reference in the cell
+    references = ['footnote-ref-1', 'footnote-ref-2', 'footnote-ref-3']
+    if content_type == 'text':
+        references.remove('footnote-ref-2')
+    assert sorted(checker.backlinks) == ['footnote-ref-1', 'footnote-ref-2', 'footnote-ref-3']
+    assert set(references) <= checker.ids
+
+def test_note_reference_follows_the_link(docx_path):
+    html = DocxProcessor().process_docx(docx_path, 'auto')
+    assert ('<a href="https://example.com/filing">the filing</a>'
+            '<sup><a href="#footnote-1" id="footnote-ref-1">1</a></sup>') in html
+    assert '<sup><a href="#footnote-3" id="footnote-ref-3">3</a></sup>' in html
+    assert re.search(r'<a href="https://example.com/filing">Revenue[^<]*</a>'
+                     r'<sup><a href="#footnote-2" id="footnote-ref-2">2</a></sup>', html)
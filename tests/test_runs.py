@@ -0,0 +1,24 @@
+import pytest
+from update import DocxProcessor
+
+UNDERLINE = '<w:rPr><w:u w:val="single"/></w:rPr>'
+
+def cell(runs):
+    return f'<w:tbl><w:tr><w:tc><w:p>{runs}</w:p></w:tc></w:tr></w:tbl>'
+
+def run(text, properties=''):
+    return f'<w:r>{properties}<w:t xml:space="preserve">{text}</w:t></w:r>'
+
+@pytest.mark.parametrize('runs, expected', [
+    # The same formatting on both sides and in between: one span
+    (run('Net', UNDERLINE) + run(' ', UNDERLINE) + run('income', UNDERLINE),
+     '<span style="text-decoration: underline;">Net&#160;income</span>'),
+    # A space formatted differently keeps the underline from running across it
+    (run('Net', UNDERLINE) + run(' ') + run('income', UNDERLINE),
+     '<span style="text-decoration: underline;">Net</span>&#160;<span style="text-decoration: underline;">income</span>'),
+    # A run without text shows nothing of its formatting, so it does not split the span
+    (run('Net', UNDERLINE) + '<w:r><w:rPr><w:b/></w:rPr></w:r>' + run('income', UNDERLINE),
+     '<span style="text-decoration: underline;">Net&#160;income</span>'),
+])
+def test_table_runs_merge_only_identical_formatting(make_docx, runs, expected):
+    assert expected in DocxProcessor().process_docx(make_docx(cell(runs)), 'table')
@@ -0,0 +1,27 @@
+import re
+from search_index import SearchIndex
+from update import DocxProcessor
+
+BODY = (
+    '<w:p><w:r><w:t>Summary</w:t></w:r></w:p>'
+    '<w:tbl><w:tr><w:tc><w:p><w:r><w:t>Segment</w:t></w:r></w:p>'
+    '<w:tbl><w:tr><w:tc><w:p><w:r><w:t>Goodwill</w:t></w:r></w:p></w:tc></w:tr></w:tbl>'
+    '<w:p/></w:tc></w:tr></w:tbl>'
+)
+
+def index(docx_path, content_type):
+    search_index = SearchIndex('filing.html')
+    html = DocxProcessor().process_docx(docx_path, content_type, search_index=search_index)
+    return search_index.postings, set(re.findall(r'id="([^"]+)"', html))
+
+def test_nested_table_text_indexed_in_auto_mode(make_docx):
+    postings, ids = index(make_docx(BODY), 'auto')
+    assert list(postings['goodwill']) == ['t1-0-0']
+    assert list(postings['segment']) == ['t1-0-0']
+    assert all(anchor in ids for anchors in postings.values() for anchor in anchors)
+
+def test_nested_table_indexed_under_its_own_cells_in_table_mode(make_docx):
+    postings, ids = index(make_docx(BODY), 'table')
+    assert list(postings['goodwill']) == ['t2-0-0']
+    assert list(postings['segment']) == ['t1-0-0']
+    assert all(anchor in ids for anchors in postings.values() for anchor in anchors)
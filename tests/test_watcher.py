@@ -0,0 +1,94 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import watcher
+from limits import ConversionTimeoutError
+
+def fake_convert(docx_path, html_path, *args):
+    """Stands in for watcher.convert_file: kills its worker process for files named crash*"""
+    if os.path.basename(docx_path).startswith('crash'):
+        os._exit(1)
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write('<p>converted</p>')
+    return {'outputs': {'auto': html_path}, 'plan': {'strategy': 'test', 'reasons': []}, 'seconds': 0.0}
+
+def make_watcher(tmp_path, directories=None, **kwargs):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir(exist_ok=True)
+    kwargs.setdefault('settle_time', 0.0)
+    return watcher.FolderWatcher(directories or [str(inbox)], state_file=str(tmp_path / 'state.json'), **kwargs), inbox
+
+def run_until(folder_watcher, condition, timeout=30.0):
+    """Poll until condition() holds, with a fresh scan time on every poll"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'watcher did not settle'
+        folder_watcher.poll()
+        time.sleep(0.05)
+
+def test_damaged_file_is_recorded_once(tmp_path):
+    folder_watcher, inbox = make_watcher(tmp_path)
+    folder_watcher.executor = ThreadPoolExecutor(1)
+    damaged = inbox / 'damaged.docx'
+    damaged.write_bytes(b'not a zip file')
+    path = str(damaged)
+    run_until(folder_watcher, lambda: path in folder_watcher.state)
+    assert 'error' in folder_watcher.state[path]
+    # Touching the file does not convert it again, changing its content does
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    folder_watcher.poll()
+    folder_watcher.poll()
+    assert not folder_watcher.in_flight
+    damaged.write_bytes(b'still not a zip file')
+    folder_watcher.poll()
+    folder_watcher.poll()
+    assert folder_watcher.in_flight
+    folder_watcher.executor.shutdown()
+
+def test_transient_failure_is_retried(tmp_path, monkeypatch):
+    calls = []
+
+    def timing_out_once(docx_path, html_path, *args):
+        calls.append(docx_path)
+        if len(calls) == 1:
+            raise ConversionTimeoutError('over the time budget')
+        return fake_convert(docx_path, html_path)
+
+    monkeypatch.setattr(watcher, 'convert_file', timing_out_once)
+    folder_watcher, inbox = make_watcher(tmp_path)
+    folder_watcher.executor = ThreadPoolExecutor(1)
+    (inbox / 'slow.docx').write_bytes(b'content')
+    path = str(inbox / 'slow.docx')
+    run_until(folder_watcher, lambda: path in folder_watcher.state)
+    assert len(calls) == 2
+    assert 'output' in folder_watcher.state[path]
+    folder_watcher.executor.shutdown()
+
+def test_crashed_worker_does_not_fail_its_neighbours(tmp_path, monkeypatch):
+    monkeypatch.setattr(watcher, 'convert_file', fake_convert)
+    folder_watcher, inbox = make_watcher(tmp_path, max_workers=2)
+    folder_watcher.start_executor()
+    for name in ['a.docx', 'crash.docx']:
+        (inbox / name).write_bytes(b'content')
+    innocent, crashing, later = str(inbox / 'a.docx'), str(inbox / 'crash.docx'), str(inbox / 'b.docx')
+    try:
+        run_until(folder_watcher, lambda: innocent in folder_watcher.state and crashing in folder_watcher.state)
+        # A file dropped in after the crash is converted by the new pool
+        (inbox / 'b.docx').write_bytes(b'content')
+        run_until(folder_watcher, lambda: later in folder_watcher.state)
+    finally:
+        folder_watcher.executor.shutdown()
+    assert 'output' in folder_watcher.state[innocent]
+    assert 'error' in folder_watcher.state[crashing]
+    assert 'output' in folder_watcher.state[later]
+    assert os.path.exists(inbox / 'b.html')
+
+def test_outputs_mirror_the_watched_directories(tmp_path):
+    for name in ['a', 'b']:
+        (tmp_path / name).mkdir()
+    folder_watcher, _ = make_watcher(tmp_path, [str(tmp_path / 'a'), str(tmp_path / 'b')],
+                                     output_dir=str(tmp_path / 'html'))
+    first = folder_watcher.output_path(str(tmp_path / 'a' / 'report.docx'))
+    second = folder_watcher.output_path(str(tmp_path / 'b' / 'report.docx'))
+    assert first == str(tmp_path / 'html' / 'a' / 'report.html')
+    assert second == str(tmp_path / 'html' / 'b' / 'report.html')
@@ -0,0 +1,54 @@
+import zipfile
+import pytest
+from xlsx import XlsxProcessor, format_number
+from limits import ResourceLimits, DecompressedSizeError, ElementLimitError
+
+X_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+R_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+def write_xlsx(path, rows, shared_strings=()):
+    """One sheet of rows, each a list of <c> elements' XML"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('xl/workbook.xml', f'<workbook xmlns="{X_NAMESPACE}" xmlns:r="{R_NAMESPACE}"><sheets>'
+                                             f'<sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        zip_file.writestr('xl/_rels/workbook.xml.rels',
+                          '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                          '<Relationship Id="rId1" Target="worksheets/sheet1.xml"/></Relationships>')
+        zip_file.writestr('xl/sharedStrings.xml', f'<sst xmlns="{X_NAMESPACE}">'
+                          + ''.join(f'<si><t>{text}</t></si>' for text in shared_strings) + '</sst>')
+        sheet_rows = ''.join(f'<row r="{n}">{"".join(cells)}</row>' for n, cells in enumerate(rows, 1))
+        zip_file.writestr('xl/worksheets/sheet1.xml',
+                          f'<worksheet xmlns="{X_NAMESPACE}"><sheetData>{sheet_rows}</sheetData></worksheet>')
+    return str(path)
+
+@pytest.fixture
+def large_shared_strings(tmp_path):
+    return write_xlsx(tmp_path / 'strings.xlsx', [['<c r="A1" t="s"><v>7</v></c>']],
+                      [f'string {i}' for i in range(50_000)])
+
+def test_shared_strings_are_resolved(large_shared_strings):
+    assert '>string 7</td>' in XlsxProcessor().process_xlsx(large_shared_strings)
+
+@pytest.mark.parametrize('limits, error', [
+    (ResourceLimits(max_part_bytes=100_000), DecompressedSizeError),
+    (ResourceLimits(max_elements=10_000), ElementLimitError),
+])
+def test_workbook_parts_are_read_under_the_limits(large_shared_strings, limits, error):
+    with pytest.raises(error):
+        XlsxProcessor(limits).process_xlsx(large_shared_strings)
+
+@pytest.mark.parametrize('value, code, text', [
+    ('1234.5', '#,##0.00', '1,234.50'),
+    ('-1234.5', '#,##0.00;(#,##0.00)', '(1,234.50)'),
+    ('0.25', '0.00%', '25.00%'),
+    ('45000', 'mm-dd-yy', '3/15/2023'),
+    ('123456', '0.00E+00', '1.23E+05'),
+    ('0.000123', '0.00E+00', '1.23E-04'),
+    ('1234', '0.0E-0', '1.2E3'),
+])
+def test_number_formats(value, code, text):
+    assert format_number(value, code) == text
+
+@pytest.mark.parametrize('value', ['1e10', '-1e9'])
+def test_date_serial_out_of_range_is_shown_as_a_number(value):
+    assert format_number(value, 'mm-dd-yy') == format_number(value, 'General')
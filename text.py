@@ -1,46 +1,70 @@
-import os
-import xml.etree.ElementTree as ET
 import re
-from util import clean_text
+from util import clean_text, is_note_reference, note_reference, run_note_references, load_relationships
 
-class TextProcessor:
+class ListState:
+    """
+    Nesting of the lists around consecutive list paragraphs: open returns the tags to emit before a list item
+    at level ilvl, close the tags that end every open list. Shared by the styled and the fast renderers
+    """
     def __init__(self):
+        self.stack = []  # Open lists as (list_tag, ilvl)
+        self.prev_ilvl = -1
+        self.prev_list_tag = None
+
+    def open(self, ilvl, list_tag):
+        tags = []
+        while self.prev_ilvl < ilvl:
+            tags.append(f'<{list_tag}>')
+            self.stack.append((list_tag, ilvl))
+            self.prev_ilvl += 1
+            self.prev_list_tag = list_tag
+        while self.prev_ilvl > ilvl:
+            tag, _ = self.stack.pop()
+            tags.append(f'</{tag}>')
+            self.prev_ilvl -= 1
+        if self.prev_list_tag is not None and self.prev_list_tag != list_tag:
+            if self.stack:
+                tag, _ = self.stack.pop()
+                tags.append(f'</{tag}>')
+            tags.append(f'<{list_tag}>')
+            self.stack.append((list_tag, ilvl))
+            self.prev_list_tag = list_tag
+        return tags
+
+    def close(self):
+        tags = []
+        while self.stack:
+            tag, _ = self.stack.pop()
+            tags.append(f'</{tag}>')
+        self.prev_ilvl = -1
+        self.prev_list_tag = None
+        return tags
+
+class TextProcessor:
+    """
+    Stateless apart from the namespaces, safe to share between threads converting different documents
+    coalesce: merge neighbouring runs with the same formatting, False wraps every run on its own, empty ones too
+    """
+    def __init__(self, coalesce=True):
+        self.coalesce = coalesce
         self.namespaces = {
             'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
             'tbl': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
             'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
         }
 
-    def process_text(self, extract_dir):
-        document_xml = os.path.join(extract_dir, 'word', 'document.xml')
-        tree = ET.parse(document_xml)
-        root = tree.getroot()
-        body = root.find('w:body', self.namespaces)
-        ns = self.namespaces
-
-        nodes = []
-        for child in list(body):
-            tag = child.tag
-            if tag == f'{{{ns["w"]}}}p':
-                para_html = self.process_paragraph(child, ns, extract_dir)
-                nodes.append(para_html)
-            elif tag == f'{{{ns["w"]}}}sectPr':
-                # Skip section properties
-                continue
-            # TODO: Handle headers, footers, textboxes/shapes, comments, endnotes, fieldcodes, special elements, etc.
-        return '\n\n'.join(nodes)
-
+    # The list helpers run for every body paragraph: full tag names keep find on its fast path, without the prefix lookup
     def is_list_paragraph(self, p, ns):
-        p_pr = p.find('w:pPr', ns)
-        if p_pr is not None and p_pr.find('w:numPr', ns) is not None:
+        p_pr = p.find(f'{{{ns["w"]}}}pPr')
+        if p_pr is not None and p_pr.find(f'{{{ns["w"]}}}numPr') is not None:
             return True
         return False
     
     def get_list_level(self, p, ns):
-        p_pr = p.find('w:pPr', ns)
-        if p_pr is not None and p_pr.find('w:numPr', ns) is not None:
-            numPr = p_pr.find('w:numPr', ns)
-            ilvl = numPr.find('w:ilvl', ns)
+        p_pr = p.find(f'{{{ns["w"]}}}pPr')
+        if p_pr is not None and p_pr.find(f'{{{ns["w"]}}}numPr') is not None:
+            numPr = p_pr.find(f'{{{ns["w"]}}}numPr')
+            ilvl = numPr.find(f'{{{ns["w"]}}}ilvl')
             if ilvl is not None:
                 return int(ilvl.get(f'{{{ns["w"]}}}val', '0'))
         return 0
@@ -50,44 +74,84 @@ class TextProcessor:
         # For now, treat all lists as unordered lists
         return 'ul'
     
-    def process_paragraph(self, p, ns, extract_dir):
+    def process_paragraph(self, p, ns, extract_dir, rels_name='document.xml.rels', content=None, anchor=None):
+        """
+        content: the paragraph's runs if already rendered with process_paragraph_content
+        anchor: id attribute of the paragraph, see search_index.SearchIndex
+        """
         p_pr = p.find('w:pPr', ns)
         style = self._get_paragraph_style(p, ns) if p_pr is not None else ''
-        paragraph = [f'<p style="{style}">']
+        if content is None:
+            content = self.process_paragraph_content(p, ns, extract_dir, rels_name)
+        id_attr = f' id="{anchor}"' if anchor else ''
+        return f'<p{id_attr} style="{style}">{content}</p>'
+
+    def process_paragraph_content(self, p, ns, extract_dir, rels_name='document.xml.rels'):
+        """Render the runs and hyperlinks of a paragraph, without the enclosing tag"""
+        paragraph = []
+        runs = []  # Consecutive runs, rendered together by process_runs
         for child in list(p):
             tag = child.tag
             if tag == f'{{{ns["w"]}}}pPr':
                 continue
             if tag == f'{{{ns["w"]}}}r':
-                run_html = self.process_run(child, ns)
-                paragraph.append(run_html)
+                runs.append(child)
             elif tag == f'{{{ns["w"]}}}hyperlink':
-                hyperlink_html = self.process_hyperlink(child, ns, extract_dir)
+                paragraph.append(self.process_runs(runs, ns))
+                runs = []
+                hyperlink_html = self.process_hyperlink(child, ns, extract_dir, rels_name)
                 paragraph.append(hyperlink_html)
-        paragraph.append('</p>')
+        paragraph.append(self.process_runs(runs, ns))
         text = ''.join(paragraph)
         return text
 
-    def process_hyperlink(self, hyperlink, ns, extract_dir):
-        # TODO: Generate link URL from r:ID in <w:hyperlink>, find the link in document.xml.rels
-        document_xml_rels = os.path.join(extract_dir, 'word', '_rels', 'document.xml.rels')
-        rels_tree = ET.parse(document_xml_rels)
-        rels_root = rels_tree.getroot()
-        relationships = rels_root.findall('.//{http://schemas.openxmlformats.org/package/2006/relationships}Relationship')
+    def process_hyperlink(self, hyperlink, ns, extract_dir, rels_name='document.xml.rels'):
+        relationships = load_relationships(extract_dir, rels_name)
         r_id = hyperlink.get(f'{{{ns["r"]}}}id')
-        link = ''
-        for rel in relationships:
-            if rel.get('Id') == r_id:
-                link = rel.get('Target')
-                break
-        html = ''
-        for run in hyperlink.findall('w:r', ns):
-            html += self.process_run(run, ns)
-        html = f'<a href="{link}">{html}</a>'
+        link = relationships.get(r_id, '')
+        runs = hyperlink.findall('w:r', ns)
+        html = self.process_runs(runs, ns, note_references=False)
+        html = f'<a href="{link}">{html}</a>{run_note_references(runs, ns)}'
         return html
 
     def process_run(self, run, ns):
-        # Refactor code from process_plain_text into this function
+        return self.process_runs([run], ns)
+
+    def process_runs(self, runs, ns, note_references=True):
+        """
+        Render consecutive runs, merging neighbours with the same formatting into one <span>/<b>
+        Word splits text into runs for spell checking and revision marks, most neighbours look the same
+        note_references: False leaves out the links to footnotes, endnotes and comments (see process_hyperlink)
+        """
+        html = []
+        group_key = None
+        group_text = []
+        for run in runs:
+            key, run_text = self._run_content(run, ns, note_references)
+            if not self.coalesce:
+                html.append(self._wrap_run(run_text, *key))
+                continue
+            # A run without text renders nothing, so its formatting must not split the runs around it
+            if not run_text:
+                continue
+            if group_text and key != group_key:
+                html.append(self._wrap_run(''.join(group_text), *group_key))
+                group_text = []
+            group_key = key
+            group_text.append(run_text)
+        if group_text:
+            html.append(self._wrap_run(''.join(group_text), *group_key))
+        return ''.join(html)
+
+    def _wrap_run(self, run_text, run_style, is_bold):
+        if is_bold:
+            run_text = f'<b>{run_text}</b>'
+        if run_style:
+            run_text = f'<span style="{run_style}">{run_text}</span>'
+        return run_text
+
+    def _run_content(self, run, ns, note_references=True):
+        """Returns the formatting of a run, (style, bold), and its text"""
         run_style = self._get_run_style(run, ns)
         runpr = run.find('w:rPr', ns)
         is_bold = runpr is not None and runpr.find('w:b', ns) is not None
@@ -100,11 +164,9 @@ class TextProcessor:
                 run_text += clean_text(child.text or '')
             elif tag == f'{{{ns["w"]}}}br':
                 run_text += '<br/>'
-        if is_bold:
-            run_text = f'<b>{run_text}</b>'
-        if run_style:
-            run_text = f'<span style="{run_style}">{run_text}</span>'
-        return run_text
+            elif note_references and is_note_reference(child, ns):
+                run_text += note_reference(child, ns)
+        return (run_style, is_bold), run_text
 
     def _get_paragraph_style(self, p, ns):
         props = p.find('w:pPr', ns)
@@ -1,14 +1,26 @@
-import os
+import re
 import zipfile
-import xml.etree.ElementTree as ET
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
 from docx import Document
 from table import TableProcessor
-from text import TextProcessor
+from text import TextProcessor, ListState
+from limits import ResourceLimits
+from fast_text import FastTextProcessor, FAST_CONTENT_TYPES
 
 class DocxProcessor:
-    def __init__(self):
-        self.table_processor = TableProcessor()
-        self.text_processor = TextProcessor()
+    """
+    Convert DOCX files to HTML. Every conversion keeps its state (budget, parsed parts, relationships) in locals
+    and TableProcessor and TextProcessor hold none, so one instance can serve any number of threads at once
+    """
+    def __init__(self, max_workers=4, limits=None, coalesce=True):
+        # coalesce: merge neighbouring runs with the same formatting, False renders every run as Word split it
+        self.table_processor = TableProcessor(coalesce)
+        self.text_processor = TextProcessor(coalesce)
+        self.fast_text_processor = FastTextProcessor()
+        self.max_workers = max_workers
+        # Decompressed size, compression ratio, element count, nesting depth and time allowed per document
+        self.limits = limits or ResourceLimits()
         self.namespaces = {
             # TODO: This dictionary is hardcoded, it may be necessary to use the docx XML  to process all namespaces
             'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
@@ -16,98 +28,338 @@ class DocxProcessor:
             'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
         }
 
-    def extract_docx_to_xml(self, docx_path):
-        """Extract DOCX file to XML files"""
-        extract_dir = os.path.splitext(docx_path)[0] + '_extracted'
-        if not os.path.exists(extract_dir):
-            os.makedirs(extract_dir)
-        with zipfile.ZipFile(docx_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        return extract_dir
-    
-
-    def process_docx(self, docx_path, content_type='auto'):
+    def process_docx(self, docx_path, content_type='auto', table_data=None, search_index=None, token=None):
         """
         Process DOCX file based on content type
         content_type can be: 'auto', 'table', 'text'
+        table_data: optional table_data.TableData that collects the numbers of every body table while it is rendered
+        search_index: optional search_index.SearchIndex that indexes the body text, adding id anchors to the HTML
+        token: optional limits.CancellationToken, cancelling it stops the conversion with limits.ConversionCancelled
+        Raises a limits.ResourceLimitError as soon as the document exceeds self.limits
+        'plain', 'markdown' and 'semantic' extract the body text without any formatting, see process_fast
+        """
+        if content_type in FAST_CONTENT_TYPES:
+            return self.process_fast(docx_path, content_type, token)
+        if content_type not in ['auto', 'table', 'text']:
+            raise ValueError("Invalid content type. Must be 'auto', 'table', 'text', 'plain', 'markdown' or 'semantic'")
+        return self.process_docx_outputs(docx_path, [content_type], table_data, search_index, token)[content_type]
+
+    def process_docx_outputs(self, docx_path, content_types=('auto', 'table', 'text'), table_data=None, search_index=None,
+                             token=None):
+        """
+        Produce several outputs of one DOCX file from a single read of the zip, a single parse of each part
+        and a single render of each paragraph and table, each fragment routed to every output that needs it
+        Returns a dict content_type -> HTML, the same HTML process_docx returns for that content_type
         """
-        extract_dir = self.extract_docx_to_xml(docx_path)
-        document_xml = os.path.join(extract_dir, 'word', 'document.xml')
-        tree = ET.parse(document_xml)
-        root = tree.getroot()
+        content_types = self.check_content_types(content_types)
+        budget = self.limits.start(token)
         ns = self.namespaces
+        # Only auto and text conversions include headers, footers and notes
+        document_xml, part_sources, relationships = self.read_docx(docx_path, budget, content_types != ['table'])
+        load_body = lambda: budget.parse(document_xml).find(f'{{{ns["w"]}}}body', ns)
+        parts = [
+            # Hyperlinks in a part resolve against that part's own relationships file
+            (kind, lambda source=source: budget.parse(source), f'{name}.rels')
+            for kind, name, source in part_sources
+        ]
+        return self.render_outputs(load_body, parts, relationships, content_types, table_data, search_index, budget)
+
+    def iter_docx(self, docx_path, content_type='auto', table_data=None, token=None):
+        """
+        Convert like process_docx, yielding the HTML in chunks while document.xml is still being parsed,
+        ''.join of the chunks is exactly what process_docx returns. Every chunk is complete HTML on its own
+        (a list is held back until it is closed), so a preview can display each chunk as it arrives
+        Headers are rendered before the first body chunk, notes and footers after the last one
+        """
+        if content_type not in ['auto', 'table', 'text']:
+            raise ValueError("Invalid content type. Must be 'auto', 'table', or 'text'")
+        budget = self.limits.start(token)
+        document_xml, part_sources, relationships = self.read_docx(docx_path, budget, content_type != 'table')
+        # Same order and separators as assemble_parts
+        order = ['header', 'body', 'footnotes', 'endnotes', 'comments', 'footer']
+        part_sources.sort(key=lambda part: order.index(part[0]))
+        separator = '\n' if content_type == 'auto' else '\n\n'
+        render = lambda kind, name, source: self.render_part(
+            kind, budget.parse(source), [content_type], relationships, f'{name}.rels', budget)[content_type]
+
+        prefix = ''  # Separator owed before the next section
+        for kind, name, source in part_sources:
+            if kind == 'header':
+                html = render(kind, name, source)
+                if html:
+                    yield prefix + html
+                    prefix = separator
+        # The body is a section even when it is empty
+        for chunk in self.iter_body(document_xml, content_type, relationships, table_data, budget):
+            yield prefix + chunk
+            prefix = ''
+        if prefix:
+            yield prefix
+        for kind, name, source in part_sources:
+            if kind != 'header':
+                html = render(kind, name, source)
+                if html:
+                    yield separator + html
 
+    def iter_body(self, document_xml, content_type, extract_dir, table_data=None, budget=None):
+        """Render the body of document_xml block by block while it is parsed, see iter_docx"""
+        budget = budget or self.limits.start()
+        ns = self.namespaces
+        block_separator = '\n' if content_type == 'auto' else '\n\n'
+        html_parts = {content_type: []}
+        fragments = html_parts[content_type]
+        list_state = ListState()
+        prefix = ''
+        depth = 0
+        body = None
+        for event, element in budget.iterparse(document_xml):
+            if event == 'start':
+                depth += 1
+                if depth == 2 and element.tag == f'{{{ns["w"]}}}body':
+                    body = element
+                continue
+            depth -= 1
+            # Only the end of a block directly under the body, by then the whole block is parsed
+            if depth != 2 or body is None:
+                continue
+            self.render_block(element, ns, extract_dir, html_parts, list_state, table_data=table_data, budget=budget)
+            # A rendered block is not needed again, the tree never holds more than the block being parsed
+            body.remove(element)
+            if fragments and not list_state.stack:
+                yield prefix + block_separator.join(fragments)
+                prefix = block_separator
+                fragments.clear()
         if content_type == 'auto':
-            # Parse the entire XML file and route each paragraph or table to the appropriate processor
-            html_parts = []
-            body = root.find(f'{{{ns["w"]}}}body', self.namespaces)
-
-            # Define business logic for handling nested lists
-            list_stack = [] # Stack to manage nested lists consisting of a tuple (list_tag, ilvl)
-            prev_ilvl = -1
-            prev_list_tag = None
-
-
-            for element in list(body):
-                if element.tag == f'{{{ns["w"]}}}p':
-
-                    # TODO: List handling logic
-                    # It is pretty complex and will need to be repeated in cells
-                    # Further research to see if this can be refactored into a separate reusable function
-
-                    if self.text_processor.is_list_paragraph(element, ns):
-                        ilvl = self.text_processor.get_list_level(element, ns)
-                        list_tag = self.text_processor.get_list_tag(element, ns)
-                        while (prev_ilvl < ilvl):
-                            html_parts.append(f'<{list_tag}>')
-                            list_stack.append((list_tag, ilvl))
-                            prev_ilvl += 1
-                            prev_list_tag = list_tag
-                        while (prev_ilvl > ilvl):
-                            tag, _ = list_stack.pop()
-                            html_parts.append(f'</{tag}>')
-                            prev_ilvl -= 1
-                        if prev_list_tag != None and prev_list_tag != list_tag:
-                            if list_stack:
-                                tag, _ = list_stack.pop()
-                                html_parts.append(f'</{tag}>')
-                            html_parts.append(f'<{list_tag}>')
-                            list_stack.append((list_tag, ilvl))
-                            prev_list_tag = list_tag
-                        li_content = []
-                        for child in list(element):
-                            if child.tag == f'{{{ns["w"]}}}r':
-                                li_content.append(self.text_processor.process_run(child, ns))
-                            elif child.tag == f'{{{ns["w"]}}}hyperlink':
-                                li_content.append(self.text_processor.process_hyperlink(child, ns, extract_dir))
-                      
-                        html_parts.append(f'<li>{"".join(li_content)}</li>')
-                        continue
-                    else:
-                        while list_stack:
-                            tag, _ = list_stack.pop()
-                            html_parts.append(f'</{tag}>')
-                        prev_ilvl = -1
-                        prev_list_tag = None
-                        html_parts.append(self.text_processor.process_paragraph(element, ns, extract_dir))
-                elif element.tag == f'{{{ns["tbl"]}}}tbl':
-                    # Assuming list starts outside of table and ends before table starts
-                    # May need more robust logic if this assumption does not hold and tables can be inside lists
-                    while list_stack:
-                        tag, _ = list_stack.pop()
-                        html_parts.append(f'</{tag}>')
-                    prev_ilvl = -1
-                    prev_list_tag = None
-                    html_parts.append(self.table_processor.process_table_element(element, ns, extract_dir))
-            while list_stack:
-                tag, _ = list_stack.pop()
-                html_parts.append(f'</{tag}>')
-            prev_ilvl = -1
-            prev_list_tag = None
-            return '\n'.join(html_parts)
-        elif content_type == 'table':
-            return self.table_processor.process_table(extract_dir)
-        elif content_type == 'text':
-            return self.text_processor.process_text(extract_dir)
-        else:
-            raise ValueError("Invalid content type. Must be 'auto', 'table', or 'text'") 
\ No newline at end of file
+            fragments.extend(list_state.close())
+        if fragments:
+            yield prefix + block_separator.join(fragments)
+
+    def process_fast(self, docx_path, content_type='plain', token=None):
+        """
+        Text and block structure of the body as plain text, Markdown or HTML without styles (fast_text.FastTextProcessor)
+        Skips the formatting, headers, footers, notes and relationships, so it is several times faster than 'text'
+        """
+        budget = self.limits.start(token)
+        with zipfile.ZipFile(docx_path, 'r') as zip_ref:
+            document_xml = budget.read(zip_ref, 'word/document.xml')
+        return self.fast_text_processor.process_document(document_xml, self.namespaces, content_type, budget)
+
+    def read_docx(self, docx_path, budget=None, include_parts=True):
+        """
+        Read document.xml, the header/footer/note parts and the relationships of a DOCX file into memory
+        Returns (document.xml file object, [(kind, name, file object)], relationships) ready for budget.parse
+        """
+        budget = budget or self.limits.start()
+        # Nothing is written next to the input file, so concurrent conversions of the same document cannot see each other's files
+        with zipfile.ZipFile(docx_path, 'r') as zip_ref:
+            document_xml = budget.read(zip_ref, 'word/document.xml')
+            part_sources = []
+            if include_parts:
+                names = zip_ref.namelist()
+                word_names = [posixpath.basename(name) for name in names if posixpath.dirname(name) == 'word']
+                part_sources = [(kind, name, budget.read(zip_ref, f'word/{name}'))
+                                for kind, name in self.order_parts(word_names)]
+            relationships = self.read_relationships(zip_ref, budget)
+        return document_xml, part_sources, relationships
+
+    def read_relationships(self, zip_ref, budget=None):
+        """
+        Read every word/_rels/*.rels file of an open DOCX zip, returns a dict rels_name -> {id: target}
+        The renderers accept it in place of an extract directory (see util.load_relationships)
+        """
+        budget = budget or self.limits.start()
+        relationships = {}
+        for name in zip_ref.namelist():
+            if re.fullmatch(r'word/_rels/[^/]+\.rels', name):
+                rels_root = budget.parse(budget.read(zip_ref, name))
+                targets = {}
+                # First entry wins for duplicated ids
+                for rel in rels_root.iter('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'):
+                    targets.setdefault(rel.get('Id'), rel.get('Target'))
+                relationships[posixpath.basename(name)] = targets
+        return relationships
+
+    def process_ir(self, document_ir, content_types=('auto', 'table', 'text'), table_data=None, search_index=None,
+                   token=None):
+        """
+        Render from a parsed document (ir.DocumentIR) instead of a DOCX file, without any zip or XML work
+        Returns a dict content_type -> HTML, as process_docx_outputs does
+        The time limit of self.limits and token apply to the rendering
+        """
+        content_types = self.check_content_types(content_types)
+        budget = self.limits.start(token)
+        parts = [
+            (kind, lambda tree=tree: document_ir.to_element(tree), rels_name)
+            for kind, rels_name, tree in document_ir.parts
+        ]
+        load_body = lambda: document_ir.to_element(document_ir.body)
+        return self.render_outputs(
+            load_body, parts, document_ir.relationships, content_types, table_data, search_index, budget)
+
+    def check_content_types(self, content_types):
+        content_types = list(dict.fromkeys(content_types))
+        for content_type in content_types:
+            if content_type not in ['auto', 'table', 'text']:
+                raise ValueError("Invalid content type. Must be 'auto', 'table', or 'text'")
+        return content_types
+
+    def render_outputs(self, load_body, parts, extract_dir, content_types, table_data=None, search_index=None,
+                       budget=None):
+        """
+        Load and render the body and each (kind, load_root, rels_name) part concurrently for every content type,
+        then assemble each output. The loaders run on the worker pool so parsing is spread across it too
+        budget (a limits.DocumentBudget) is checked after every block and table row; once one thread stops
+        on a timeout or cancellation the others stop at their next check
+        """
+        # Only auto and text conversions include headers, footers and notes
+        part_types = [content_type for content_type in content_types if content_type != 'table']
+        ns = self.namespaces
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            body_future = pool.submit(
+                lambda: self.render_blocks(load_body(), ns, extract_dir, content_types, table_data=table_data,
+                                           search_index=search_index, budget=budget))
+            part_futures = []
+            if part_types:
+                part_futures = [
+                    (kind, pool.submit(lambda kind=kind, load_root=load_root, rels_name=rels_name:
+                                       self.render_part(kind, load_root(), part_types, extract_dir, rels_name, budget)))
+                    for kind, load_root, rels_name in parts
+                ]
+            body_outputs = body_future.result()
+            parts_outputs = [(kind, future.result()) for kind, future in part_futures]
+
+        outputs = {}
+        for content_type in content_types:
+            if content_type == 'table':
+                outputs[content_type] = body_outputs[content_type]
+                continue
+            separator = '\n' if content_type == 'auto' else '\n\n'
+            parts_html = [(kind, part_outputs[content_type]) for kind, part_outputs in parts_outputs]
+            outputs[content_type] = self.assemble_parts(body_outputs[content_type], parts_html, separator)
+        return outputs
+
+    def render_blocks(self, container, ns, extract_dir, content_types, rels_name='document.xml.rels', table_data=None,
+                      search_index=None, budget=None):
+        """
+        Render the blocks under container once for several outputs, returns a dict content_type -> HTML
+        'auto' gets paragraphs, lists and top-level tables, 'text' every paragraph, 'table' every table at any depth
+        search_index is only given for the body, the anchors are numbered over the whole container
+        budget: optional limits.DocumentBudget, checked after every block and table row
+        """
+        if search_index is not None:
+            search_index.start_document(container, ns)
+        html_parts = {content_type: [] for content_type in content_types}
+        auto_parts = html_parts.get('auto')
+
+        # Opens and closes the nested <ul>/<ol> tags around list paragraphs
+        list_state = ListState()
+        for element in list(container):
+            self.render_block(element, ns, extract_dir, html_parts, list_state, rels_name, table_data, search_index,
+                              budget)
+        if auto_parts is not None:
+            auto_parts.extend(list_state.close())
+        separators = {'auto': '\n', 'text': '\n\n', 'table': '\n\n'}
+        return {content_type: separators[content_type].join(html_parts[content_type]) for content_type in content_types}
+
+    def render_block(self, element, ns, extract_dir, html_parts, list_state, rels_name='document.xml.rels',
+                     table_data=None, search_index=None, budget=None):
+        """
+        Render one paragraph or table of a container, appending its fragments to html_parts (content_type -> list)
+        list_state: the container's ListState, lists stay open across calls until a block that is not a list item
+        """
+        auto_parts = html_parts.get('auto')
+        if budget is not None:
+            budget.rendered(blocks=1)
+        if element.tag == f'{{{ns["w"]}}}p':
+            content = None
+            p_html = None
+            # Paragraphs are only anchored and indexed in outputs that contain them, the tables-only output has none
+            anchor = None
+            if search_index is not None and (auto_parts is not None or 'text' in html_parts):
+                anchor = search_index.paragraph(element, ns)
+            if auto_parts is not None:
+                if self.text_processor.is_list_paragraph(element, ns):
+                    ilvl = self.text_processor.get_list_level(element, ns)
+                    list_tag = self.text_processor.get_list_tag(element, ns)
+                    auto_parts.extend(list_state.open(ilvl, list_tag))
+                    content = self.text_processor.process_paragraph_content(element, ns, extract_dir, rels_name)
+                    auto_parts.append(f'<li id="{anchor}">{content}</li>' if anchor else f'<li>{content}</li>')
+                else:
+                    auto_parts.extend(list_state.close())
+                    p_html = self.text_processor.process_paragraph(element, ns, extract_dir, rels_name, anchor=anchor)
+                    auto_parts.append(p_html)
+            if 'text' in html_parts:
+                # Reuse whatever the auto output already rendered of this paragraph
+                if p_html is None:
+                    p_html = self.text_processor.process_paragraph(element, ns, extract_dir, rels_name, content, anchor)
+                html_parts['text'].append(p_html)
+
+        rendered = None
+        if element.tag == f'{{{ns["tbl"]}}}tbl' and auto_parts is not None:
+            # Assuming list starts outside of table and ends before table starts
+            # May need more robust logic if this assumption does not hold and tables can be inside lists
+            auto_parts.extend(list_state.close())
+            layouts = ['element', 'table'] if 'table' in html_parts else ['element']
+            rendered = self.table_processor.render_table(
+                element, ns, extract_dir, rels_name, table_data, layouts, search_index, budget)
+            auto_parts.append(rendered['element'])
+        if 'table' in html_parts:
+            # Tables-only output includes nested tables, in document order
+            for tbl in element.iter(f'{{{ns["tbl"]}}}tbl'):
+                if tbl is element and rendered is not None:
+                    html_parts['table'].append(rendered['table'])
+                else:
+                    rendered_tbl = self.table_processor.render_table(
+                        tbl, ns, extract_dir, rels_name, table_data, ['table'], search_index, budget)
+                    html_parts['table'].append(rendered_tbl['table'])
+
+    def order_parts(self, names):
+        """Pick the header, footer and note parts out of the file names in word/, in the order they are rendered"""
+        parts = []
+        for kind in ['header', 'footer']:
+            part_names = [name for name in names if re.fullmatch(rf'{kind}\d*\.xml', name)]
+            # Order header1, header2, ..., header10 numerically rather than lexically
+            part_names.sort(key=lambda name: int(re.sub(r'\D', '', name) or 0))
+            parts.extend((kind, name) for name in part_names)
+        for kind in ['footnotes', 'endnotes', 'comments']:
+            if f'{kind}.xml' in names:
+                parts.append((kind, f'{kind}.xml'))
+        return parts
+
+    def render_part(self, kind, root, content_types, extract_dir, rels_name, budget=None):
+        ns = self.namespaces
+
+        if kind in ['header', 'footer']:
+            outputs = {}
+            for content_type, content in self.render_blocks(
+                    root, ns, extract_dir, content_types, rels_name, budget=budget).items():
+                outputs[content_type] = f'<div class="{kind}">\n{content}\n</div>' if content.strip() else ''
+            return outputs
+
+        note_tag = kind[:-1]  # footnotes -> footnote, endnotes -> endnote, comments -> comment
+        notes = {content_type: [] for content_type in content_types}
+        for note in root.findall(f'w:{note_tag}', ns):
+            # Skip the separator pseudo-notes Word keeps at the start of footnotes.xml and endnotes.xml
+            if note.get(f'{{{ns["w"]}}}type') in ['separator', 'continuationSeparator', 'continuationNotice']:
+                continue
+            note_id = note.get(f'{{{ns["w"]}}}id')
+            backlink = f'<a href="#{note_tag}-ref-{note_id}">{note_id}</a>'
+            for content_type, content in self.render_blocks(
+                    note, ns, extract_dir, content_types, rels_name, budget=budget).items():
+                notes[content_type].append(f'<div class="{note_tag}" id="{note_tag}-{note_id}">\n{backlink}\n{content}\n</div>')
+        outputs = {}
+        for content_type in content_types:
+            notes_html = '\n'.join(notes[content_type])
+            outputs[content_type] = f'<div class="{kind}">\n{notes_html}\n</div>' if notes[content_type] else ''
+        return outputs
+
+    def assemble_parts(self, body_html, parts_html, separator):
+        """Place headers before the body and notes, comments and footers after it"""
+        order = ['header', 'body', 'footnotes', 'endnotes', 'comments', 'footer']
+        sections = {kind: [] for kind in order}
+        sections['body'].append(body_html)
+        for kind, html in parts_html:
+            if html:
+                sections[kind].append(html)
+        return separator.join(html for kind in order for html in sections[kind])
@@ -1,3 +1,5 @@
+import os
+import xml.etree.ElementTree as ET
 from unidecode import unidecode
 
 def clean_text(text):
@@ -10,4 +12,44 @@ def clean_text(text):
     text = text.replace('<', '&lt;')
     text = text.replace('>', '&gt;')
     text = text.replace('___BR___', '<br/>')
-    return text 
\ No newline at end of file
+    return text
+
+# Reference elements inside runs, mapped to the kind of note they point at
+NOTE_REFERENCE_KINDS = {
+    'footnoteReference': 'footnote',
+    'endnoteReference': 'endnote',
+    'commentReference': 'comment',
+}
+
+def is_note_reference(element, ns):
+    """Check if a run child is a footnote, endnote or comment reference"""
+    namespace, _, local_name = element.tag.partition('}')
+    return namespace == f'{{{ns["w"]}' and local_name in NOTE_REFERENCE_KINDS
+
+def note_reference(ref, ns):
+    """Link a footnote, endnote or comment reference to its rendered note"""
+    kind = NOTE_REFERENCE_KINDS[ref.tag.partition('}')[2]]
+    note_id = ref.get(f'{{{ns["w"]}}}id')
+    return f'<sup><a href="#{kind}-{note_id}" id="{kind}-ref-{note_id}">{note_id}</a></sup>'
+
+def run_note_references(runs, ns):
+    """
+    Links to the notes referenced in runs, for runs rendered inside a hyperlink without their references:
+    the links go after the </a>, anchors cannot be nested
+    """
+    return ''.join(note_reference(child, ns) for run in runs for child in run if is_note_reference(child, ns))
+
+def load_relationships(extract_dir, rels_name='document.xml.rels'):
+    """
+    Map relationship ids to targets for one part, read from word/_rels/<rels_name> under extract_dir
+    extract_dir can also be a dict rels_name -> {id: target} of relationships loaded beforehand (see ir.py)
+    """
+    if isinstance(extract_dir, dict):
+        return extract_dir.get(rels_name, {})
+    rels_tree = ET.parse(os.path.join(extract_dir, 'word', '_rels', rels_name))
+    relationships = rels_tree.getroot().findall('.//{http://schemas.openxmlformats.org/package/2006/relationships}Relationship')
+    # First entry wins for duplicated ids, as in the lookup this replaces
+    targets = {}
+    for rel in relationships:
+        targets.setdefault(rel.get('Id'), rel.get('Target'))
+    return targets
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import signal
+import hashlib
+import logging
+import zipfile
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from search_index import SearchIndex
+from limits import ResourceLimits, ResourceLimitError, ConversionTimeoutError
+from planner import ConversionPlanner
+
+logger = logging.getLogger(__name__)
+
+def convert_file(docx_path, html_path, content_type='auto', write_index=False, max_seconds=None, thresholds=None,
+                 token=None):
+    """
+    Convert one DOCX file and write its HTML to html_path (runs in a worker process)
+    With write_index, the search index of the body is written next to it as <name>.idx
+    max_seconds: time budget of the conversion, limits.ConversionTimeoutError once exceeded
+    thresholds: planner.ConversionPlanner thresholds, as written by benchmark.py --calibrate
+    token: optional limits.CancellationToken, cancelling it stops the conversion with limits.ConversionCancelled
+    Returns the conversion report of ConversionPlanner.convert, with the plan the document was converted with
+    """
+    planner = ConversionPlanner(ResourceLimits(max_seconds=max_seconds), **(thresholds or {}))
+    search_index = SearchIndex(os.path.basename(html_path)) if write_index else None
+    # The planner writes through a temporary file, readers of the output folder only ever see complete files
+    report = planner.convert(docx_path, {content_type: html_path}, search_index=search_index, token=token)
+    if search_index is not None:
+        search_index.write(os.path.splitext(html_path)[0] + '.idx')
+    return report
+
+def is_permanent_error(error):
+    """
+    Whether converting the same content again raises error again: a damaged document or one over the resource
+    limits. Timeouts, OSError, crashed workers and anything else that depends on the machine are worth retrying
+    """
+    if isinstance(error, ConversionTimeoutError):
+        return False
+    # ResourceLimitError is a ValueError, KeyError is a part missing from the zip
+    return isinstance(error, (ResourceLimitError, ValueError, KeyError, zipfile.BadZipFile, ET.ParseError))
+
+def load_thresholds(path):
+    """Planner thresholds from a JSON file written by benchmark.py --calibrate, None for the defaults"""
+    if path is None:
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def init_worker():
+    # Ctrl+C reaches the whole process group, let the daemon decide when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of the file content, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FolderWatcher:
+    """
+    Poll directories for new or modified DOCX files and convert them on a bounded process pool.
+    A file is only converted once its size and mtime have been stable for settle_time seconds,
+    and only if its content hash differs from the one recorded in the state file.
+    A conversion that fails for a transient reason is tried again, up to max_attempts times in a row.
+    """
+    def __init__(self, directories, output_dir=None, content_type='auto', max_workers=2,
+                 poll_interval=2.0, settle_time=2.0, state_file='.docx_watch_state.json', recursive=False,
+                 write_index=False, max_seconds=None, thresholds=None, max_attempts=3):
+        self.directories = [os.path.abspath(d) for d in directories]
+        # Outputs mirror the paths below this directory, so files of the same name in different folders do not clash
+        self.root = os.path.commonpath(self.directories)
+        self.output_dir = os.path.abspath(output_dir) if output_dir else None
+        self.content_type = content_type
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.state_file = state_file
+        self.recursive = recursive
+        self.write_index = write_index
+        self.max_seconds = max_seconds
+        self.thresholds = thresholds
+        self.max_attempts = max_attempts
+        self.state = self.load_state()
+        self.pending = {}  # path -> ([size, mtime_ns], time the signature was first seen)
+        self.in_flight = {}  # future -> (path, signature, hash)
+        self.attempts = {}  # path -> transient failures in a row
+        # Files that were converting when a worker process died. One of them may have killed it, so each is
+        # converted on its own until it succeeds or runs out of attempts, and the others are not taken down again
+        self.suspects = set()
+        self.executor = None
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable state file %s: %s', self.state_file, e)
+            return {}
+
+    def save_state(self):
+        # Write to a temporary file first so a crash never leaves a truncated state file behind
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_file)
+
+    def output_path(self, docx_path):
+        name = os.path.splitext(docx_path)[0] + '.html'
+        if self.output_dir is None:
+            return name
+        return os.path.join(self.output_dir, os.path.relpath(name, self.root))
+
+    def start_executor(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker)
+
+    def restart_executor(self):
+        """Replace a pool broken by a dead worker process, the conversions it was running are tried again"""
+        logger.warning('A conversion process died, restarting the pool')
+        # Every future of a broken pool fails with BrokenProcessPool, collect puts their files back in line
+        self.collect(wait=True)
+        self.executor.shutdown()
+        self.start_executor()
+
+    def scan(self):
+        """Yield every DOCX file in the watched directories"""
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    # Skip the ~$ lock files Word keeps next to open documents
+                    if name.lower().endswith('.docx') and not name.startswith('~$'):
+                        yield os.path.join(root, name)
+                if not self.recursive:
+                    break
+
+    def poll(self, now=None):
+        """Run one scan: collect finished conversions, then submit files that have settled and changed"""
+        now = time.monotonic() if now is None else now
+        if self.collect():
+            self.restart_executor()
+        busy = {path for path, _, _ in self.in_flight.values()}
+        for path in self.scan():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted or renamed between the scan and the stat
+                self.pending.pop(path, None)
+                self.attempts.pop(path, None)
+                self.suspects.discard(path)
+                continue
+            signature = [stat.st_size, stat.st_mtime_ns]
+            recorded = self.state.get(path)
+            if recorded is not None and recorded['signature'] == signature:
+                continue
+            # Debounce partial writes: wait until the signature stops changing
+            seen = self.pending.get(path)
+            if seen is None or seen[0] != signature:
+                self.pending[path] = (signature, now)
+                continue
+            if now - seen[1] < self.settle_time or path in busy:
+                continue
+            if len(self.in_flight) >= self.max_workers or busy & self.suspects:
+                # Leave the rest pending, they are picked up once a worker frees up
+                break
+            if path in self.suspects and busy:
+                # Let the running conversions drain so it can run on its own
+                break
+            digest = file_hash(path)
+            del self.pending[path]
+            if recorded is not None and recorded['hash'] == digest:
+                # Touched but not changed, remember the new signature so it isn't hashed again.
+                # Failures are only recorded when the same content would fail the same way
+                recorded['signature'] = signature
+                self.save_state()
+                continue
+            html_path = self.output_path(path)
+            os.makedirs(os.path.dirname(html_path), exist_ok=True)
+            logger.info('Converting %s', path)
+            try:
+                future = self.executor.submit(convert_file, path, html_path, self.content_type,
+                                              self.write_index, self.max_seconds, self.thresholds)
+            except BrokenProcessPool:
+                # The pool broke since collect looked at it, path is seen again and submitted on a later scan
+                self.restart_executor()
+                break
+            self.in_flight[future] = (path, signature, digest)
+            busy.add(path)
+
+    def collect(self, wait=False):
+        """
+        Record the outcome of finished conversions in the state file
+        Returns whether the pool broke, it then has to be replaced before anything else is submitted
+        """
+        changed = False
+        broken = False
+        for future in list(self.in_flight):
+            if not wait and not future.done():
+                continue
+            path, signature, digest = self.in_flight.pop(future)
+            try:
+                report = future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    broken = True
+                    self.suspects.add(path)
+                attempts = self.attempts.get(path, 0) + 1
+                if not is_permanent_error(e) and attempts < self.max_attempts:
+                    # Not recorded, so poll sees the file again and converts it once it has settled
+                    logger.warning('Failed to convert %s, trying again: %s', path, e)
+                    self.attempts[path] = attempts
+                    continue
+                # Recorded with the error, so poll skips the file until its signature and content change
+                logger.error('Failed to convert %s: %s', path, e)
+                self.state[path] = {'signature': signature, 'hash': digest, 'error': str(e) or type(e).__name__}
+                self.attempts.pop(path, None)
+                self.suspects.discard(path)
+                changed = True
+                continue
+            self.attempts.pop(path, None)
+            self.suspects.discard(path)
+            html_path = report['outputs'][self.content_type]
+            plan = report['plan']
+            logger.info('Wrote %s (%s, %.2fs: %s)', html_path, plan['strategy'], report['seconds'],
+                        '; '.join(plan['reasons']))
+            self.state[path] = {'signature': signature, 'hash': digest, 'output': html_path, 'plan': plan['strategy']}
+            changed = True
+        if changed:
+            self.save_state()
+        return broken
+
+    def run(self):
+        logger.info('Watching %s', ', '.join(self.directories))
+        self.start_executor()
+        try:
+            while True:
+                self.poll()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            logger.info('Stopping, waiting for running conversions')
+        finally:
+            self.collect(wait=True)
+            self.executor.shutdown()
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch folders and convert new or modified DOCX files to HTML')
+    parser.add_argument('directories', nargs='+', help='directories to watch')
+    parser.add_argument('--output-dir', help='write HTML here instead of next to each DOCX file, '
+                                             'in the same subdirectories as below the watched directories')
+    parser.add_argument('--content-type', default='auto', choices=['auto', 'table', 'text'])
+    parser.add_argument('--workers', type=int, default=2, help='maximum concurrent conversions')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between scans')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds a file must stay unchanged before converting')
+    parser.add_argument('--state-file', default='.docx_watch_state.json')
+    parser.add_argument('--recursive', action='store_true', help='also watch subdirectories')
+    parser.add_argument('--search-index', action='store_true', help='write a search index next to each HTML file')
+    parser.add_argument('--timeout', type=float, help='seconds a single conversion may take')
+    parser.add_argument('--thresholds', help='conversion planner thresholds written by benchmark.py --calibrate')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='tries of a conversion that fails for a transient reason (timeout, I/O, crashed worker)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    watcher = FolderWatcher(args.directories, args.output_dir, args.content_type, args.workers,
+                            args.interval, args.settle, args.state_file, args.recursive,
+                            args.search_index, args.timeout, load_thresholds(args.thresholds), args.max_attempts)
+    # Stop cleanly under a service manager too, not only on Ctrl+C
+    signal.signal(signal.SIGTERM, stop)
+    watcher.run()
+
+if __name__ == '__main__':
+    main()
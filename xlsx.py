@@ -0,0 +1,359 @@
+import re
+import zipfile
+import datetime
+import posixpath
+import xml.etree.ElementTree as ET
+from table import TableProcessor
+from util import clean_text
+from limits import ResourceLimits
+
+# Built-in number formats that have no <numFmt> entry in styles.xml
+BUILTIN_NUM_FMTS = {
+    0: 'General', 1: '0', 2: '0.00', 3: '#,##0', 4: '#,##0.00',
+    9: '0%', 10: '0.00%', 11: '0.00E+00',
+    14: 'mm-dd-yy', 15: 'd-mmm-yy', 16: 'd-mmm', 17: 'mmm-yy',
+    18: 'h:mm AM/PM', 19: 'h:mm:ss AM/PM', 20: 'h:mm', 21: 'h:mm:ss', 22: 'm/d/yy h:mm',
+    37: '#,##0 ;(#,##0)', 38: '#,##0 ;[Red](#,##0)', 39: '#,##0.00;(#,##0.00)', 40: '#,##0.00;[Red](#,##0.00)',
+    49: '@',
+}
+# Excel border styles mapped to the w:val values TableProcessor understands, with a width in eighths of a point
+BORDER_STYLES = {
+    'hair': ('single', 2), 'thin': ('single', 4), 'dotted': ('single', 4), 'dashed': ('single', 4),
+    'medium': ('single', 12), 'mediumDashed': ('single', 12), 'thick': ('single', 18), 'double': ('double', 6),
+}
+ALIGNMENTS = {'left': 'left', 'center': 'center', 'centerContinuous': 'center', 'right': 'right', 'justify': 'both'}
+DEFAULT_COL_WIDTH = 8.43  # characters
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+
+def column_index(cell_ref):
+    """'C7' -> 2"""
+    index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord('A') + 1
+    return index - 1
+
+def format_number(value, code):
+    """Render a numeric cell value the way its number format displays it (common formats only)"""
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    if code is None or code in ['General', '@']:
+        return str(int(number)) if number.is_integer() else f'{number:.15g}'
+    sections = code.split(';')
+    section = sections[1] if number < 0 and len(sections) > 1 else sections[0]
+    # Strip colours, conditions, quoted literals and escapes before looking at the placeholders
+    pattern = re.sub(r'\[[^\]]*\]|"[^"]*"|\\.|_.|\*.', '', section)
+    if re.search(r'[yd]', pattern, re.IGNORECASE) or (re.search(r'm', pattern, re.IGNORECASE) and '0' not in pattern):
+        try:
+            moment = EXCEL_EPOCH + datetime.timedelta(days=number)
+        except (OverflowError, ValueError):
+            # Not a serial any date can have, shown as the number it is
+            return format_number(value, 'General')
+        if re.search(r'h', pattern, re.IGNORECASE) and not re.search(r'[yd]', pattern, re.IGNORECASE):
+            return moment.strftime('%H:%M')
+        return f'{moment.month}/{moment.day}/{moment.year}'
+    if '%' in pattern:
+        number *= 100
+    decimals = len(re.search(r'\.(0*)', pattern).group(1)) if '.' in pattern else 0
+    grouping = ',' if ',' in pattern else ''
+    shown = abs(number) if len(sections) > 1 else number
+    exponent_format = re.search(r'E([+-])(0+)', pattern, re.IGNORECASE)
+    if exponent_format:
+        # 0.00E+00: the exponent has at least as many digits as zeros, E- only shows the sign of negative exponents
+        mantissa, exponent = f'{shown:.{decimals}E}'.split('E')
+        exponent = int(exponent)
+        sign = '-' if exponent < 0 else '+' if exponent_format.group(1) == '+' else ''
+        text = f'{mantissa}E{sign}{abs(exponent):0{len(exponent_format.group(2))}d}'
+    else:
+        text = f'{shown:{grouping}.{decimals}f}'
+    if '%' in pattern:
+        text += '%'
+    if number < 0 and len(sections) > 1 and '(' in section:
+        text = f'({text})'
+    elif number < 0 and len(sections) > 1 and '-' in section:
+        text = f'-{text}'
+    return text
+
+class XlsxProcessor:
+    """
+    Convert XLSX worksheets to HTML tables with the same cell/row styling as DOCX tables.
+    Worksheets are streamed row by row: each <row> is turned into a <w:tr> with a cached <w:tcPr>/<w:rPr>
+    per cell format, rendered with TableProcessor.process_row and discarded, so memory is bounded by row.
+    """
+    def __init__(self, limits=None):
+        self.table_processor = TableProcessor()
+        # The workbook, shared strings and styles parts are read under every limit. The sheets are streamed a row
+        # at a time, so only the time limit applies to them
+        self.limits = limits or ResourceLimits()
+        self.namespaces = {
+            'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
+            'tbl': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
+            'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+            'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+            'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+        }
+
+    def process_xlsx(self, xlsx_path, token=None):
+        """
+        Convert every visible worksheet and return the HTML
+        token: optional limits.CancellationToken, cancelling it stops the conversion with limits.ConversionCancelled
+        """
+        return ''.join(self.iter_html(xlsx_path, token))
+
+    def convert(self, xlsx_path, html_path, token=None):
+        """Convert straight to a file, without holding the whole HTML in memory"""
+        with open(html_path, 'w', encoding='utf-8') as f:
+            for chunk in self.iter_html(xlsx_path, token):
+                f.write(chunk)
+
+    def iter_html(self, xlsx_path, token=None):
+        budget = self.limits.start(token)
+        with zipfile.ZipFile(xlsx_path, 'r') as zip_ref:
+            # Both indexes are built once per workbook and shared by all sheets
+            shared_strings = self.load_shared_strings(zip_ref, budget)
+            cell_formats = self.load_cell_formats(zip_ref, budget)
+            for name, part in self.find_sheets(zip_ref, budget):
+                yield f'<p style="font-weight: bold;">{clean_text(name)}</p>\n\n'
+                yield from self.iter_sheet_html(zip_ref, part, shared_strings, cell_formats, budget)
+
+    def find_sheets(self, zip_ref, budget=None):
+        """Return (name, part) for each visible sheet in workbook order"""
+        ns = self.namespaces
+        budget = budget or self.limits.start()
+        workbook = budget.parse(budget.read(zip_ref, 'xl/workbook.xml'))
+        rels = budget.parse(budget.read(zip_ref, 'xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels.findall('rel:Relationship', ns)}
+        sheets = []
+        for sheet in workbook.findall('x:sheets/x:sheet', ns):
+            if sheet.get('state') in ['hidden', 'veryHidden']:
+                continue
+            target = targets.get(sheet.get(f'{{{ns["r"]}}}id'), '')
+            part = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            sheets.append((sheet.get('name'), part))
+        return sheets
+
+    def load_shared_strings(self, zip_ref, budget=None):
+        """Index of sharedStrings.xml: position -> text"""
+        x = f'{{{self.namespaces["x"]}}}'
+        budget = budget or self.limits.start()
+        strings = []
+        if 'xl/sharedStrings.xml' not in zip_ref.namelist():
+            return strings
+        with budget.read(zip_ref, 'xl/sharedStrings.xml') as f:
+            for event, elem in budget.iterparse(f):
+                if event != 'end' or elem.tag != f'{x}si':
+                    continue
+                # Plain <t>, or rich text runs <r><t>; phonetic <rPh> hints are skipped
+                text = []
+                for child in elem:
+                    if child.tag == f'{x}t':
+                        text.append(child.text or '')
+                    elif child.tag == f'{x}r':
+                        t = child.find(f'{x}t')
+                        if t is not None:
+                            text.append(t.text or '')
+                strings.append(''.join(text))
+                elem.clear()
+        return strings
+
+    def load_cell_formats(self, zip_ref, budget=None):
+        """
+        Index of styles.xml cellXfs: style id -> dict with the number format code and
+        the Word properties (tcPr children and rPr) that reproduce its fill, alignment, borders and font
+        """
+        ns = self.namespaces
+        w = f'{{{ns["w"]}}}'
+        budget = budget or self.limits.start()
+        if 'xl/styles.xml' not in zip_ref.namelist():
+            return []
+        styles = budget.parse(budget.read(zip_ref, 'xl/styles.xml'))
+        num_fmts = dict(BUILTIN_NUM_FMTS)
+        for num_fmt in styles.findall('x:numFmts/x:numFmt', ns):
+            num_fmts[int(num_fmt.get('numFmtId'))] = num_fmt.get('formatCode')
+        fonts = styles.findall('x:fonts/x:font', ns)
+        fills = styles.findall('x:fills/x:fill', ns)
+        borders = styles.findall('x:borders/x:border', ns)
+
+        def attr(parent, path, name='val'):
+            el = parent.find(path, ns)
+            return el.get(name) if el is not None else None
+
+        def rgb(el):
+            # ARGB -> RGB; theme and indexed colours are not resolved
+            value = el.get('rgb') if el is not None else None
+            return value[-6:] if value else None
+
+        default_font = fonts[0] if fonts else None
+        cell_formats = []
+        for xf in styles.findall('x:cellXfs/x:xf', ns):
+            cell_format = {'num_fmt': num_fmts.get(int(xf.get('numFmtId', '0'))), 'align': None, 'tc': [], 'rpr': None}
+
+            alignment = xf.find('x:alignment', ns)
+            if alignment is not None:
+                cell_format['align'] = ALIGNMENTS.get(alignment.get('horizontal'))
+
+            fill = fills[int(xf.get('fillId', '0'))] if fills else None
+            if fill is not None and attr(fill, 'x:patternFill', 'patternType') == 'solid':
+                color = rgb(fill.find('x:patternFill/x:fgColor', ns))
+                if color:
+                    cell_format['tc'].append(ET.Element(f'{w}shd', {f'{w}fill': color.upper()}))
+
+            border = borders[int(xf.get('borderId', '0'))] if borders else None
+            if border is not None:
+                tc_borders = ET.Element(f'{w}tcBorders')
+                for side in ['top', 'bottom', 'left', 'right']:
+                    el = border.find(f'x:{side}', ns)
+                    if el is not None and el.get('style') in BORDER_STYLES:
+                        val, sz = BORDER_STYLES[el.get('style')]
+                        attrs = {f'{w}val': val, f'{w}sz': str(sz)}
+                        color = rgb(el.find('x:color', ns))
+                        if color:
+                            attrs[f'{w}color'] = color
+                        ET.SubElement(tc_borders, f'{w}{side}', attrs)
+                if len(tc_borders):
+                    cell_format['tc'].append(tc_borders)
+
+            font = fonts[int(xf.get('fontId', '0'))] if fonts else None
+            if font is not None:
+                # Only properties that differ from the workbook default font become run styles
+                rpr = ET.Element(f'{w}rPr')
+                name = attr(font, 'x:name')
+                if name and name != attr(default_font, 'x:name'):
+                    ET.SubElement(rpr, f'{w}rFonts', {f'{w}ascii': name})
+                size = attr(font, 'x:sz')
+                if size and size != attr(default_font, 'x:sz'):
+                    ET.SubElement(rpr, f'{w}sz', {f'{w}val': str(int(float(size) * 2))})
+                color = rgb(font.find('x:color', ns))
+                if color and color not in ['000000', rgb(default_font.find('x:color', ns))]:
+                    ET.SubElement(rpr, f'{w}color', {f'{w}val': color})
+                for tag, word_tag in [('strike', 'strike'), ('b', 'b'), ('i', 'i')]:
+                    el = font.find(f'x:{tag}', ns)
+                    if el is not None and el.get('val', '1') not in ['0', 'false']:
+                        ET.SubElement(rpr, f'{w}{word_tag}')
+                underline = font.find('x:u', ns)
+                if underline is not None:
+                    val = 'double' if underline.get('val', 'single').startswith('double') else 'single'
+                    ET.SubElement(rpr, f'{w}u', {f'{w}val': val})
+                if len(rpr):
+                    cell_format['rpr'] = rpr
+            cell_formats.append(cell_format)
+        return cell_formats
+
+    def iter_sheet_html(self, zip_ref, part, shared_strings, cell_formats, budget=None):
+        ns = self.namespaces
+        x = f'{{{ns["x"]}}}'
+        col_widths = {}
+        default_width = DEFAULT_COL_WIDTH
+        n_cols = 0
+        sheet_data = None
+        tc_pr_cache = {}
+        templates = {}  # Cell style templates, see TableProcessor._get_cell_template
+        with zip_ref.open(part) as f:
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == f'{x}sheetData':
+                        # <dimension>, <sheetFormatPr> and <cols> all precede the rows
+                        sheet_data = elem
+                        n_cols = max([n_cols] + list(col_widths))
+                        widths = [col_widths.get(i, default_width) for i in range(n_cols)]
+                        total_width_twips = self._twips(sum(widths))
+                        yield '<table cellpadding="0" cellspacing="0" style="font: 10pt Times New Roman, Times, Serif; border-collapse: collapse; width: 100%; ">\n\n'
+                    continue
+                if elem.tag == f'{x}dimension':
+                    last_ref = elem.get('ref', 'A1').split(':')[-1]
+                    n_cols = column_index(last_ref) + 1
+                elif elem.tag == f'{x}sheetFormatPr' and elem.get('defaultColWidth'):
+                    default_width = float(elem.get('defaultColWidth'))
+                elif elem.tag == f'{x}col':
+                    width = 0.0 if elem.get('hidden') == '1' else float(elem.get('width', default_width))
+                    for i in range(int(elem.get('min')) - 1, min(int(elem.get('max')), 16384)):
+                        col_widths[i] = width
+                elif elem.tag == f'{x}row':
+                    if elem.get('hidden') != '1':
+                        tr = self.build_row(elem, shared_strings, cell_formats, widths, tc_pr_cache)
+                        for line in self.table_processor.process_row(
+                                tr, ns, None, total_width_twips, templates=templates):
+                            yield line + '\n\n'
+                    # Drop the parsed row so the tree never grows beyond one row
+                    sheet_data.remove(elem)
+                    if budget is not None:
+                        budget.rendered(rows=1)
+                elif elem.tag == f'{x}sheetData':
+                    yield '</table>\n\n'
+                    break
+
+    def build_row(self, row, shared_strings, cell_formats, widths, tc_pr_cache):
+        """Turn a spreadsheet <row> into a <w:tr> that TableProcessor.process_row can render"""
+        ns = self.namespaces
+        w = f'{{{ns["w"]}}}'
+        tr = ET.Element(f'{w}tr')
+        cells = {}
+        for c in row.findall('x:c', ns):
+            ref = c.get('r')
+            cells[column_index(ref) if ref else len(cells)] = c
+        n_cols = max([len(widths)] + [i + 1 for i in cells])
+        for col in range(n_cols):
+            c = cells.get(col)
+            style_id = int(c.get('s', '0')) if c is not None else 0
+            cell_format = cell_formats[style_id] if style_id < len(cell_formats) else None
+            text, is_number = self._cell_text(c, shared_strings, cell_format)
+            tc = ET.SubElement(tr, f'{w}tc')
+            # Cell properties only depend on format, column and whether the value is numeric, build each once
+            key = (style_id, col, is_number)
+            tc_pr = tc_pr_cache.get(key)
+            if tc_pr is None:
+                tc_pr = self._build_tc_pr(cell_format, widths[col] if col < len(widths) else DEFAULT_COL_WIDTH, is_number)
+                tc_pr_cache[key] = tc_pr
+            tc.append(tc_pr)
+            p = ET.SubElement(tc, f'{w}p')
+            if text:
+                r = ET.SubElement(p, f'{w}r')
+                if cell_format is not None and cell_format['rpr'] is not None:
+                    r.append(cell_format['rpr'])
+                for i, line in enumerate(text.split('\n')):
+                    if i:
+                        ET.SubElement(r, f'{w}br')
+                    ET.SubElement(r, f'{w}t').text = line
+        return tr
+
+    def _build_tc_pr(self, cell_format, width, is_number):
+        w = f'{{{self.namespaces["w"]}}}'
+        tc_pr = ET.Element(f'{w}tcPr')
+        ET.SubElement(tc_pr, f'{w}tcW', {f'{w}w': str(self._twips(width)), f'{w}type': 'dxa'})
+        align = cell_format['align'] if cell_format is not None else None
+        if align is None and is_number:
+            # Excel's General alignment puts numbers on the right
+            align = 'right'
+        if align is not None:
+            ET.SubElement(tc_pr, f'{w}jc', {f'{w}val': align})
+        if cell_format is not None:
+            tc_pr.extend(cell_format['tc'])
+        return tc_pr
+
+    def _cell_text(self, c, shared_strings, cell_format):
+        """Return (displayed text, is_number) for a <c> element"""
+        if c is None:
+            return '', False
+        ns = self.namespaces
+        cell_type = c.get('t', 'n')
+        if cell_type == 'inlineStr':
+            return ''.join(t.text or '' for t in c.iter(f'{{{ns["x"]}}}t')), False
+        v = c.find('x:v', ns)
+        if v is None or v.text is None:
+            return '', False
+        if cell_type == 's':
+            index = int(v.text)
+            return (shared_strings[index] if index < len(shared_strings) else ''), False
+        if cell_type == 'b':
+            return ('TRUE' if v.text == '1' else 'FALSE'), False
+        if cell_type == 'n':
+            return format_number(v.text, cell_format['num_fmt'] if cell_format is not None else None), True
+        # 'str' (formula result), 'e' (error) and 'd' (ISO date) are shown as stored
+        return v.text, False
+
+    def _twips(self, width):
+        # Column width is in characters of the default font, roughly 7 pixels each at 96 dpi, 15 twips per pixel
+        return int(round(width * 7 * 15))